@@ -0,0 +1 @@
+"""Offline benchmarks of org_analysis pipeline."""
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Deterministic stand-in for `hercules` and `hercules combine` with configurable cost.
+
+Analysis burns `FAKE_HERCULES_COMMIT_COST` seconds of CPU per commit of repository, combine burns
+`FAKE_HERCULES_MERGE_COST` seconds per input. Output contains valid `AnalysisResults` header, so
+it passes validation of org_analysis, and a payload which grows with the number of commits.
+"""
+import os
+import subprocess
+import sys
+import time
+
+COMMIT_COST_ENV = "FAKE_HERCULES_COMMIT_COST"
+MERGE_COST_ENV = "FAKE_HERCULES_MERGE_COST"
+
+
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7f, value >> 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number: int, payload: bytes) -> bytes:
+    """Encode length-delimited field."""
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def header(repository: str, begin: int, end: int, commits: int) -> bytes:
+    """Encode `AnalysisResults.header`."""
+    metadata = field(3, repository.encode()) + varint(4 << 3) + varint(begin) + \
+        varint(5 << 3) + varint(end) + varint(6 << 3) + varint(commits)
+    return field(1, metadata)
+
+
+def burn(seconds: float) -> None:
+    """Busy loop - cost is CPU time, not sleep, like a real analysis."""
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def analyse(repo_loc: str) -> bytes:
+    timestamps = [int(ts) for ts in subprocess.run(
+        ["git", "--git-dir", repo_loc, "log", "--format=%ct"], check=True,
+        stdout=subprocess.PIPE).stdout.split()]
+    burn(len(timestamps) * float(os.getenv(COMMIT_COST_ENV, "0")))
+    contents = field(2, field(1, b"Devs") + field(2, b"\0" * 16 * len(timestamps)))
+    return header(repo_loc, min(timestamps), max(timestamps), len(timestamps)) + contents
+
+
+def combine(locations) -> bytes:
+    burn(len(locations) * float(os.getenv(MERGE_COST_ENV, "0")))
+    payload = bytearray()
+    for loc in locations:
+        with open(loc, "rb") as f:
+            data = f.read()
+        # skip header of input - it's the first field
+        pos = 1
+        size, shift = 0, 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        payload += data[pos + size:]
+    return header("combined", 1500000000, 1500000000, len(locations)) + bytes(payload)
+
+
+def main():
+    if sys.argv[1] == "version":
+        print("Version: fake")
+    elif sys.argv[1] == "combine":
+        sys.stdout.buffer.write(combine(sys.argv[2:]))
+    else:
+        repo = [arg for arg in sys.argv[1:] if not arg.startswith("--")][-1]
+        sys.stdout.buffer.write(analyse(repo))
+
+
+if __name__ == "__main__":
+    main()
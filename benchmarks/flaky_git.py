@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Stand-in for `git` which fails clones and fetches at random with transient network errors.
+
+Everything else (and the rest of clones and fetches) is passed to the real git. Put it on PATH
+under the name `git` in front of the real one and clone from `file://` URLs or from `git daemon`:
+
+    mkdir -p /tmp/flaky && ln -sf $PWD/benchmarks/flaky_git.py /tmp/flaky/git
+    git daemon --base-path=/tmp/bench --export-all --reuseaddr &
+    FLAKY_GIT_FAILURE_RATE=0.3 PATH=/tmp/flaky:$PATH python -m org_analysis download ...
+"""
+import os
+import random
+import sys
+import time
+
+FAILURE_RATE_ENV = "FLAKY_GIT_FAILURE_RATE"  # share of failed clones and fetches
+PERMANENT_RATE_ENV = "FLAKY_GIT_PERMANENT_RATE"  # share of failures which aren't transient
+DELAY_ENV = "FLAKY_GIT_DELAY"  # seconds to wait before failure (like a timed out connection)
+TRANSIENT_ERROR = "fatal: unable to access '{url}': Connection reset by peer"
+PERMANENT_ERROR = "fatal: repository '{url}' not found"
+
+
+def real_git() -> str:
+    """Find the next `git` on PATH which isn't this script."""
+    me = os.path.realpath(__file__)
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        candidate = os.path.join(directory, "git")
+        if os.access(candidate, os.X_OK) and os.path.realpath(candidate) != me:
+            return candidate
+    raise FileNotFoundError("git is not found on PATH")
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    if {"clone", "fetch"} & set(args) and \
+            random.random() < float(os.getenv(FAILURE_RATE_ENV, "0.3")):
+        time.sleep(float(os.getenv(DELAY_ENV, "0")))
+        url = next((arg for arg in args if "://" in arg), args[-1])
+        error = PERMANENT_ERROR if random.random() < float(os.getenv(PERMANENT_RATE_ENV, "0")) \
+            else TRANSIENT_ERROR
+        print(error.format(url=url), file=sys.stderr)
+        sys.exit(128)
+    git = real_git()
+    os.execv(git, [git] + args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Time every stage of the pipeline on synthetic repositories at several scales and core counts.
+
+Example:
+    python -m benchmarks.pipeline -w /tmp/bench -o results.jsonl --scales 10x50 100x20 --cores 1 4
+"""
+import argparse
+import json
+import logging as log
+import multiprocessing
+from multiprocessing import Pool
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from time import perf_counter
+from typing import Any, Dict, List
+
+from benchmarks.fake_hercules import COMMIT_COST_ENV, MERGE_COST_ENV
+from benchmarks.synthetic import generate_repositories
+from org_analysis.hercules_statistics import filter_valid_statistics, merge_statistics, \
+    repository_statistics_multiprocessing
+from org_analysis.triage import triage_repositories
+from org_analysis.utils import clone_repo
+
+FAKE_HERCULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_hercules.py")
+
+
+def clone_multiprocessing(kwargs) -> str:
+    return clone_repo(**kwargs)
+
+
+def revision() -> str:
+    """Git revision of benchmarked code."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              cwd=os.path.dirname(FAKE_HERCULES)).stdout.decode().strip()
+    except subprocess.CalledProcessError:
+        return ""
+
+
+def run_scale(work_dir: str, n_repos: int, n_commits: int, n_authors: int, n_cores: int,
+              n_samples: int) -> Dict[str, float]:
+    """
+    Run all stages of the pipeline once.
+
+    :param work_dir: directory for repositories and results.
+    :param n_repos: number of repositories.
+    :param n_commits: number of commits in each repository.
+    :param n_authors: number of authors in each repository.
+    :param n_cores: number of cores.
+    :param n_samples: fan-in of hierarchical merge.
+    :return: mapping from stage name to duration in seconds.
+    """
+    urls = generate_repositories(os.path.join(work_dir, "origin"), n_repos=n_repos,
+                                 n_commits=n_commits, n_authors=n_authors)
+    run_dir = os.path.join(work_dir, f"run_{n_repos}x{n_commits}_{n_cores}")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    clones_dir = os.path.join(run_dir, "clones")
+    stats_dir = os.path.join(run_dir, "statistics")
+    timings = {}
+
+    start = perf_counter()
+    with Pool(n_cores) as p:
+        clones = p.map(clone_multiprocessing,
+                       [{"repo_url": url, "dest": os.path.join(clones_dir, "bench",
+                                                               os.path.basename(url)),
+                         "force": True} for url in urls])
+    timings["download"] = perf_counter() - start
+
+    start = perf_counter()
+    triage = triage_repositories(clones, n_cores=n_cores)
+    timings["sizing"] = perf_counter() - start
+
+    start = perf_counter()
+    arguments = [{"repo_url": url, "repo_loc": loc, "output_dir": stats_dir,
+                  "hercules_exec": FAKE_HERCULES, "size_limit": -1, "force": True,
+                  "repo_size": triage[loc].size} for url, loc in zip(urls, clones)]
+    with Pool(n_cores) as p:
+        results = p.map(repository_statistics_multiprocessing, arguments)
+    timings["analysis"] = perf_counter() - start
+
+    start = perf_counter()
+    locations = filter_valid_statistics([loc for _, loc in results if loc])
+    timings["validation"] = perf_counter() - start
+
+    start = perf_counter()
+    merge_statistics([(None, loc) for loc in locations],
+                     output_filepath=os.path.join(run_dir, "aggregated_statistics.pb"),
+                     hercules_exec=FAKE_HERCULES, n_samples=n_samples, n_cores=n_cores,
+                     validate=False)
+    timings["merge"] = perf_counter() - start
+    return timings
+
+
+def main(args: List[str] = None) -> List[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-w", "--work-dir", required=True,
+                        help="Directory for synthetic repositories and intermediate results.")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSONL file to append results to.")
+    parser.add_argument("--scales", nargs="+", default=["10x50", "50x50"],
+                        help="Scales in format <number of repositories>x<number of commits>.")
+    parser.add_argument("--cores", nargs="+", type=int, default=[1, multiprocessing.cpu_count()],
+                        help="Numbers of cores to benchmark.")
+    parser.add_argument("--authors", type=int, default=5,
+                        help="Number of authors in each repository.")
+    parser.add_argument("--n-samples", type=int, default=8,
+                        help="Fan-in of hierarchical merge.")
+    parser.add_argument("--commit-cost", type=float, default=0.001,
+                        help="CPU seconds of fake analysis per commit.")
+    parser.add_argument("--merge-cost", type=float, default=0.01,
+                        help="CPU seconds of fake combine per input.")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of each setup.")
+    args = parser.parse_args(args)
+    log.getLogger().setLevel(log.WARNING)
+    os.environ[COMMIT_COST_ENV] = str(args.commit_cost)
+    os.environ[MERGE_COST_ENV] = str(args.merge_cost)
+    os.makedirs(args.work_dir, exist_ok=True)
+    common = {"revision": revision(), "python": platform.python_version(),
+              "cpu_count": multiprocessing.cpu_count(), "authors": args.authors,
+              "n_samples": args.n_samples, "commit_cost": args.commit_cost,
+              "merge_cost": args.merge_cost}
+    records = []
+    for scale in args.scales:
+        n_repos, n_commits = map(int, scale.split("x"))
+        for n_cores in args.cores:
+            for repeat in range(args.repeats):
+                timings = run_scale(args.work_dir, n_repos=n_repos, n_commits=n_commits,
+                                    n_authors=args.authors, n_cores=n_cores,
+                                    n_samples=args.n_samples)
+                record = dict(common, repos=n_repos, commits=n_commits, cores=n_cores,
+                              repeat=repeat, stages=timings, total=sum(timings.values()))
+                records.append(record)
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                print(f"{scale} cores={n_cores}: " +
+                      " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in timings.items()),
+                      file=sys.stderr)
+    return records
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Check that sharded statistics of a synthetic repository match a single `--first-parent` run and
+time both. Requires hercules and its message types (labours). Exits with status 1 on mismatch.
+
+Example:
+    python -m benchmarks.sharding -w /tmp/shard -o sharding.jsonl --commits 2000 --shards 4
+"""
+import argparse
+import json
+import logging as log
+import multiprocessing
+import os
+import platform
+import sys
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.pipeline import revision
+from benchmarks.synthetic import generate_repository
+from org_analysis.analyses import PROFILES
+from org_analysis.defaults import HERCULES_EXEC
+from org_analysis.sharding import sharded_statistics
+from org_analysis.utils import check_call_with_rusage
+
+
+def pop_devs(aggregate) -> Dict[Tuple[int, str, str], Tuple[int, ...]]:
+    """Remove developers statistics from aggregate and key them by (tick, developer, language)."""
+    devs = aggregate.analyses.pop("Devs", None)
+    if devs is None:
+        return {}
+    names = devs.index.names + ["<missing>"]
+    languages = devs.languages.names + [""]
+    return {(tick, names[dev], languages[lang]): tuple(values)
+            for tick, dev, lang, *values in devs.table().tolist()}
+
+
+def differences(single_loc: str, sharded_loc: str) -> List[str]:
+    """
+    Compare statistics of single run and sharded statistics.
+
+    :param single_loc: location of statistics of single run.
+    :param sharded_loc: location of sharded statistics.
+    :return: descriptions of differences.
+    """
+    from org_analysis.pb_merge import read_statistics
+
+    single, sharded = read_statistics([single_loc]), read_statistics([sharded_loc])
+    diffs = [f"{field}: {getattr(single, field)} != {getattr(sharded, field)}"
+             for field in ("begin", "end", "commits", "tick")
+             if getattr(single, field) != getattr(sharded, field)]
+    single_devs, sharded_devs = pop_devs(single), pop_devs(sharded)
+    for key in sorted(set(single_devs) | set(sharded_devs)):
+        if single_devs.get(key) != sharded_devs.get(key):
+            diffs.append(f"Devs {key}: {single_devs.get(key)} != {sharded_devs.get(key)}")
+    # the rest of analyses comes from the same run over the whole history
+    for aggregate in (single, sharded):
+        aggregate.run_time, aggregate.run_time_per_item = 0, {}
+        aggregate.repositories = []
+    if single.serialize() != sharded.serialize():
+        diffs.append(f"{', '.join(sorted(single.analyses))} differ")
+    return diffs
+
+
+def main(args: List[str] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-w", "--work-dir", required=True,
+                        help="Directory for synthetic repository and statistics.")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSONL file to append results to.")
+    parser.add_argument("--hercules", default=HERCULES_EXEC, help="Path to hercules executable.")
+    parser.add_argument("--commits", type=int, default=1000,
+                        help="Number of commits of repository (one per hour).")
+    parser.add_argument("--authors", type=int, default=5, help="Number of authors.")
+    parser.add_argument("--emails", type=int, default=3,
+                        help="Number of emails of each author, so identities are matched across "
+                             "segments.")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count(),
+                        help="Max number of segments of history.")
+    parser.add_argument("--profile", default="full", choices=sorted(PROFILES),
+                        help="Analysis profile.")
+    args = parser.parse_args(args)
+    log.getLogger().setLevel(log.WARNING)
+    repo_loc = os.path.abspath(os.path.join(
+        args.work_dir, f"repo_{args.commits}x{args.authors}x{args.emails}.git"))
+    if not os.path.isdir(repo_loc):
+        generate_repository(repo_loc, n_commits=args.commits, n_authors=args.authors,
+                            n_emails=args.emails)
+    cmd = [args.hercules, "--pb", *PROFILES[args.profile], "--hibernation-distance=1000",
+           "--skip-blacklist"]
+    single_loc = os.path.join(args.work_dir, "single.pb")
+    sharded_loc = os.path.join(args.work_dir, "sharded.pb")
+
+    start = perf_counter()
+    with open(single_loc, "wb") as f:
+        check_call_with_rusage(cmd + ["--first-parent", repo_loc], stdout=f)
+    single_time = perf_counter() - start
+    start = perf_counter()
+    sharded_statistics(cmd, repo_loc, sharded_loc, args.shards)
+    sharded_time = perf_counter() - start
+
+    diffs = differences(single_loc, sharded_loc)
+    record = {"revision": revision(), "python": platform.python_version(),
+              "cpu_count": multiprocessing.cpu_count(), "commits": args.commits,
+              "authors": args.authors, "emails": args.emails, "shards": args.shards,
+              "profile": args.profile, "single": single_time, "sharded": sharded_time,
+              "equivalent": not diffs}
+    with open(args.output, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    for diff in diffs:
+        print(diff, file=sys.stderr)
+    print(f"single={single_time:.2f}s sharded={sharded_time:.2f}s "
+          f"equivalent={not diffs}", file=sys.stderr)
+    if diffs:
+        sys.exit(1)
+    return record
+
+
+if __name__ == "__main__":
+    main()
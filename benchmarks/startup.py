@@ -0,0 +1,124 @@
+"""Measure CLI startup, import time of modules and startup of pool workers per start method.
+
+Example:
+    python -m benchmarks.startup -o startup.jsonl --repeats 5 --workers 4
+"""
+import argparse
+import json
+import logging as log
+import multiprocessing
+from multiprocessing import Pool
+import os
+import platform
+from statistics import median
+import subprocess
+import sys
+from time import perf_counter
+from typing import Any, Dict, List
+
+from org_analysis.defaults import WORKER_MODULES
+from org_analysis.utils import configure_workers
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["org_analysis.__main__", "org_analysis.hercules_statistics",
+           "org_analysis.download_repos", "org_analysis.pb_merge"]
+# start method and if worker modules are preloaded
+WORKER_SETUPS = [("fork", False), ("spawn", False), ("forkserver", False), ("forkserver", True)]
+
+
+def run_python(*args: str) -> float:
+    """Run Python in fresh interpreter and return wall time in seconds."""
+    start = perf_counter()
+    subprocess.run([sys.executable] + list(args), check=True, cwd=ROOT_DIR,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return perf_counter() - start
+
+
+def import_time(module: str) -> float:
+    """Import time of module (with its dependencies) in fresh interpreter in seconds."""
+    code = ("from time import perf_counter; start = perf_counter(); "
+            f"import {module}; print(perf_counter() - start)")
+    return float(subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT_DIR,
+                                stdout=subprocess.PIPE).stdout)
+
+
+def probe(_) -> Dict[str, Any]:
+    """Task of worker: import what workers need and report how long it took."""
+    start = perf_counter()
+    for module in WORKER_MODULES:
+        __import__(module)
+    return {"pid": os.getpid(), "import": perf_counter() - start, "modules": len(sys.modules)}
+
+
+def workers_startup(start_method: str, preload: bool, n_workers: int) -> Dict[str, Any]:
+    """
+    Start pool and wait until every worker imported worker modules (run in fresh interpreter).
+
+    :param start_method: start method of workers.
+    :param preload: preload worker modules in forkserver.
+    :param n_workers: number of workers.
+    :return: wall time of pool startup, mean import time and number of modules in workers.
+    """
+    configure_workers(start_method, preload=WORKER_MODULES if preload else [])
+    start = perf_counter()
+    with Pool(n_workers) as p:
+        results = p.map(probe, range(n_workers * 4), chunksize=1)
+    wall_time = perf_counter() - start
+    first = {}
+    for res in results:
+        first.setdefault(res["pid"], res)
+    return {"wall_time": wall_time,
+            "worker_import": sum(res["import"] for res in first.values()) / len(first),
+            "worker_modules": sum(res["modules"] for res in first.values()) / len(first)}
+
+
+def main(args: List[str] = None) -> List[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to append results to.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of measurements - median is reported.")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of pool workers.")
+    parser.add_argument("--probe", nargs=2, metavar=("START_METHOD", "PRELOAD"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.probe:
+        # measurement of workers in fresh interpreter, forkserver can be configured only once
+        print(json.dumps(workers_startup(args.probe[0], args.probe[1] == "1", args.workers)))
+        return []
+    # imported here, so workers started by the benchmark don't import the pipeline
+    from benchmarks.pipeline import revision
+
+    log.getLogger().setLevel(log.WARNING)
+    common = {"revision": revision(), "python": platform.python_version(),
+              "cpu_count": multiprocessing.cpu_count(), "workers": args.workers}
+    records = [dict(common, kind="cli", name="--help",
+                    wall_time=median(run_python("-m", "org_analysis", "--help")
+                                     for _ in range(args.repeats)))]
+    for module in MODULES:
+        records.append(dict(common, kind="import", name=module,
+                            wall_time=median(import_time(module) for _ in range(args.repeats))))
+    for start_method, preload in WORKER_SETUPS:
+        if start_method not in multiprocessing.get_all_start_methods():
+            continue
+        runs = [json.loads(subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "-o", args.output, "--workers",
+             str(args.workers), "--probe", start_method, str(int(preload))],
+            check=True, cwd=ROOT_DIR, stdout=subprocess.PIPE).stdout)
+            for _ in range(args.repeats)]
+        records.append(dict(common, kind="workers",
+                            name=start_method + (" + preload" if preload else ""),
+                            **{key: median(run[key] for run in runs) for key in runs[0]}))
+    with open(args.output, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    for record in records:
+        print(f"{record['kind']} {record['name']}: {record['wall_time']:.3f}s" +
+              (f" (import in worker {record['worker_import']:.3f}s)"
+               if "worker_import" in record else ""), file=sys.stderr)
+    return records
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Generate deterministic synthetic git repositories."""
+import os
+import random
+import subprocess
+from typing import List
+
+START_TIME = 1500000000  # timestamp of the first commit
+
+
+def generate_repository(dest: str, n_commits: int, n_authors: int, n_files: int = 20,
+                        file_size: int = 1024, seed: int = 0, n_emails: int = 1) -> str:
+    """
+    Generate bare repository with `git fast-import`. Result is the same for the same arguments.
+
+    :param dest: location of bare repository.
+    :param n_commits: number of commits.
+    :param n_authors: number of distinct authors.
+    :param n_files: number of files modified by commits.
+    :param file_size: size of each modification in bytes.
+    :param seed: random seed.
+    :param n_emails: number of emails of each author - hercules matches them by name.
+    :return: location of repository.
+    """
+    rng = random.Random(seed)
+    subprocess.run(["git", "init", "--quiet", "--bare", dest], check=True)
+    stream = []
+    for i in range(n_commits):
+        author = rng.randrange(n_authors)
+        timestamp = START_TIME + i * 3600
+        message = f"commit {i}".encode()
+        stream.append(b"commit refs/heads/master\n")
+        email = f"dev{author}.{rng.randrange(n_emails)}" if n_emails > 1 else f"dev{author}"
+        ident = f"dev{author} <{email}@example.com> {timestamp} +0000\n".encode()
+        stream.append(b"author " + ident)
+        stream.append(b"committer " + ident)
+        stream.append(b"data %d\n%s\n" % (len(message), message))
+        path = f"src/file{rng.randrange(n_files)}.py".encode()
+        lines = b"".join(b"line %d %d\n" % (i, rng.randrange(1 << 30))
+                         for _ in range(max(file_size // 24, 1)))
+        stream.append(b"M 644 inline %s\ndata %d\n%s\n" % (path, len(lines), lines))
+    subprocess.run(["git", "--git-dir", dest, "fast-import", "--quiet"], input=b"".join(stream),
+                   check=True)
+    return dest
+
+
+def generate_repositories(root_dir: str, n_repos: int, n_commits: int, n_authors: int,
+                          file_size: int = 1024) -> List[str]:
+    """
+    Generate repositories of organization `bench` (already generated ones are reused).
+
+    :param root_dir: directory to store repositories.
+    :param n_repos: number of repositories.
+    :param n_commits: number of commits in each repository.
+    :param n_authors: number of distinct authors in each repository.
+    :param file_size: size of each modification in bytes.
+    :return: `file://` URLs of repositories.
+    """
+    urls = []
+    for i in range(n_repos):
+        dest = os.path.abspath(os.path.join(root_dir, "bench", f"repo{i}.git"))
+        if not os.path.isdir(dest):
+            generate_repository(dest, n_commits=n_commits, n_authors=n_authors,
+                                file_size=file_size, seed=i)
+        urls.append(f"file://{dest}")
+    return urls
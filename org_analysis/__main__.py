@@ -1,14 +1,22 @@
 import argparse
 import logging as log
 
+from org_analysis.clone_store import add_store_args, store_handler
+from org_analysis.distributed import add_node_args, node_handler
 from org_analysis.download_repos import add_download_args, handler as download_handler
-from org_analysis.utils import ArgumentDefaultsHelpFormatterNoNone, filter_kwargs
+from org_analysis.export import add_export_args, export_handler
+from org_analysis.hercules_statistics import add_hercules_args, add_merge_args, \
+    hercules_handler, merge_handler
+from org_analysis.pipeline import add_pipeline_args, pipeline_handler
+from org_analysis.utils import add_start_method_args, ArgumentDefaultsHelpFormatterNoNone, \
+    configure_workers, filter_kwargs
 
 
 def prepare_parser():
     parser = argparse.ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatterNoNone)
     parser.add_argument("--log-level", default="INFO", choices=log._nameToLevel,
                         help="Logging verbosity.")
+    add_start_method_args(parser)
 
     cmds = parser.add_subparsers(help="Commands")
 
@@ -21,6 +29,41 @@ def prepare_parser():
     download.set_defaults(handler=download_handler)
     add_download_args(download)
 
+    # calculate statistics of cloned repositories and merge them
+    hercules = add_parser(name="hercules", help="Calculate and merge statistics of repositories "
+                                                "from CSV.")
+    hercules.set_defaults(handler=hercules_handler)
+    add_hercules_args(hercules)
+
+    # merge statistics again, resuming interrupted merge
+    merge = add_parser(name="merge", help="Merge statistics of repositories with checkpoints - "
+                                          "interrupted merge is resumed.")
+    merge.set_defaults(handler=merge_handler)
+    add_merge_args(merge)
+
+    # the same on several nodes sharing work queue
+    distributed = add_parser(name="distributed", help="Calculate statistics of repositories from "
+                                                      "CSV on several nodes.")
+    distributed.set_defaults(handler=node_handler)
+    add_node_args(distributed)
+
+    # clone, analyse and evict repositories of organization/user in one pass
+    pipeline = add_parser(name="pipeline", help="Clone and analyse repositories of "
+                                                "organization/user concurrently.")
+    pipeline.set_defaults(handler=pipeline_handler)
+    add_pipeline_args(pipeline)
+
+    # convert statistics to columnar store for queries
+    export = add_parser(name="export", help="Export statistics to columnar store for queries.")
+    export.set_defaults(handler=export_handler)
+    add_export_args(export)
+
+    # evict and repack clones of download output
+    store = add_parser(name="store", help="Evict clones over disk budget and repack fragmented "
+                                          "ones while the machine is idle.")
+    store.set_defaults(handler=store_handler)
+    add_store_args(store)
+
     return parser
 
 
@@ -28,6 +71,7 @@ def main():
     parser = prepare_parser()
     args = parser.parse_args()
     log.getLogger().setLevel(args.log_level)
+    configure_workers(args.start_method)
     try:
         handler = args.handler
         delattr(args, "handler")
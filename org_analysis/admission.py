@@ -0,0 +1,157 @@
+"""Memory-aware admission of hercules jobs to the process pool."""
+from functools import partial
+import logging as log
+from multiprocessing.pool import Pool
+import queue
+from statistics import median
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+
+from org_analysis.defaults import ADMISSION_LOOKAHEAD, ADMISSION_MAX_OVERTAKES, \
+    ADMISSION_MAX_WAIT, ADMISSION_POLL_INTERVAL, BASE_JOB_MEMORY, MEMORY_PER_BYTE
+from org_analysis.history import RunHistory
+
+
+def memory_per_byte(history: RunHistory, default: float = MEMORY_PER_BYTE) -> float:
+    """
+    Estimate memory consumption of hercules per byte of repository from previous runs.
+
+    :param history: observations from previous runs.
+    :param default: value to use if there are no observations.
+    :return: median peak RSS per byte of repository.
+    """
+    ratios = [record["peak_rss"] / record["repo_size"] for record in history.records.values()
+              if record.get("repo_size") and record.get("peak_rss")]
+    return median(ratios) if ratios else default
+
+
+def expected_memory(repository: str, repo_size: int, history: RunHistory, ratio: float,
+                    processes: int = 1) -> int:
+    """
+    Estimate peak memory of hercules run for repository.
+
+    :param repository: repository location.
+    :param repo_size: size of repository in bytes.
+    :param history: observations from previous runs.
+    :param ratio: bytes of memory per byte of repository for repositories without observations.
+    :param processes: number of concurrent hercules processes of job (observations already sum
+                      their peaks).
+    :return: expected peak RSS in bytes.
+    """
+    record = history.get(repository)
+    if record.get("peak_rss"):
+        if record.get("repo_size"):
+            return int(record["peak_rss"] * max(repo_size / record["repo_size"], 1))
+        return record["peak_rss"]
+    return int(BASE_JOB_MEMORY + repo_size * ratio) * processes
+
+
+_EXHAUSTED = object()
+
+
+def _put(results: queue.Queue, job_id: int, ok: bool, res: Any) -> None:
+    results.put((job_id, ok, res))
+
+
+def admit_jobs(pool: Pool, func: Callable[[Dict[str, Any]], Any],
+               jobs: Iterable[Tuple[Dict[str, Any], int]], budget: int, max_in_flight: int,
+               lookahead: int = ADMISSION_LOOKAHEAD,
+               max_overtakes: int = ADMISSION_MAX_OVERTAKES,
+               max_wait: float = ADMISSION_MAX_WAIT,
+               poll_interval: float = ADMISSION_POLL_INTERVAL,
+               processes: Callable[[Dict[str, Any]], int] = None) -> Iterator[Any]:
+    """
+    Run jobs on pool while sum of their memory estimates fits into budget - similar to
+    `Pool.imap_unordered` but aware of memory.
+
+    Jobs are admitted in the given order, smaller jobs may overtake the next one if it doesn't fit.
+    Once the next job was overtaken `max_overtakes` times or waits for `max_wait` seconds, nothing
+    else is admitted until it fits - so a stream of small jobs can't starve a large one. Job
+    larger than the whole budget (or with more processes than `max_in_flight`) is admitted alone
+    when nothing else is running. Jobs are pulled from `jobs` lazily, so it may be a generator over
+    arbitrary number of repositories. It may yield None when no job is ready yet (e.g.
+    repositories are still being cloned) - it's pulled again after a job finishes or
+    `poll_interval` seconds.
+
+    :param pool: process pool.
+    :param func: function to call with arguments of job.
+    :param jobs: arguments of jobs with expected peak memory of each job in bytes.
+    :param budget: total memory budget in bytes. If <= 0 - only `max_in_flight` is respected.
+    :param max_in_flight: max number of concurrently running hercules processes (size of pool).
+    :param lookahead: max number of jobs pulled from `jobs` which are waiting for admission.
+    :param max_overtakes: max number of jobs admitted ahead of the next one.
+    :param max_wait: max duration in seconds the next job waits while others are admitted.
+    :param poll_interval: seconds between pulls of `jobs` while it yields None.
+    :param processes: number of concurrent hercules processes of job by its arguments. If None -
+                      each job runs one.
+    :return: iterator over results in order of completion.
+    """
+    budget = budget if budget > 0 else float("inf")
+    processes = processes or (lambda kwargs: 1)
+    jobs = iter(jobs)
+    exhausted = False
+    pending = []
+    in_flight = {}
+    used = running = 0
+    results = queue.Queue()
+    job_id = 0
+    # the next job doesn't fit since then and was overtaken so many times
+    blocked_since = None
+    overtakes = 0
+
+    def fits(job: Tuple[Dict[str, Any], int]) -> bool:
+        return used + job[1] <= budget and running + processes(job[0]) <= max_in_flight
+
+    while True:
+        not_ready = False
+        while not exhausted and len(pending) < max(lookahead, 1):
+            job = next(jobs, _EXHAUSTED)
+            if job is _EXHAUSTED:
+                exhausted = True
+            elif job is None:
+                not_ready = True
+                break
+            else:
+                pending.append(job)
+        if exhausted and not pending and not in_flight:
+            return
+        while pending and running < max_in_flight:
+            if fits(pending[0]):
+                idx = 0
+            else:
+                blocked_since = blocked_since or monotonic()
+                if overtakes >= max_overtakes or monotonic() - blocked_since >= max_wait:
+                    # memory and processes are reserved for the next job - running ones release them
+                    idx = None
+                else:
+                    idx = next((i for i, job in enumerate(pending) if fits(job)), None)
+            if idx is None:
+                if in_flight:
+                    break
+                idx = 0
+                log.warning(f"Expected memory of {pending[0][0].get('repo_loc')} is "
+                            f"{pending[0][1]} bytes (budget {budget}), it runs "
+                            f"{processes(pending[0][0])} processes (max {max_in_flight}) - "
+                            f"running it alone")
+            if idx == 0:
+                blocked_since = None
+                overtakes = 0
+            else:
+                overtakes += 1
+            kwargs, estimate = pending.pop(idx)
+            in_flight[job_id] = estimate, processes(kwargs)
+            used += estimate
+            running += in_flight[job_id][1]
+            pool.apply_async(func, (kwargs,), callback=partial(_put, results, job_id, True),
+                             error_callback=partial(_put, results, job_id, False))
+            job_id += 1
+        try:
+            finished_id, ok, res = results.get(timeout=poll_interval if not_ready else None)
+        except queue.Empty:
+            continue
+        estimate, n_processes = in_flight.pop(finished_id)
+        used -= estimate
+        running -= n_processes
+        if not ok:
+            raise res
+        yield res
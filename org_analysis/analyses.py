@@ -0,0 +1,77 @@
+"""Analysis profiles of hercules and split of analyses between concurrent hercules runs.
+
+Analyses of different groups don't depend on each other, so they may be calculated by separate
+hercules processes over the same history at the same time. Concatenation of serialized protobuf
+messages is parsed as their merge: `contents` maps with results of analyses are united, fields of
+headers are equal (the same history and flags), `run_time_per_item` maps are united too. So
+outputs of the runs are spliced byte by byte without decoding them.
+"""
+import os
+import resource
+import shutil
+from typing import List, Sequence
+
+from org_analysis.utils import check_calls_with_rusage
+
+# hercules flags of each profile
+PROFILES = {
+    "full": ("--burndown", "--burndown-people", "--devs", "--couples"),
+    "devs": ("--devs",),
+    "burndown": ("--burndown", "--burndown-people"),
+    "couples": ("--couples",),
+    "people": ("--burndown", "--burndown-people", "--devs"),
+}
+# analyses which share one pass over history - flags of a group stay in one hercules run
+ANALYSIS_GROUPS = (("--burndown", "--burndown-people"), ("--devs",), ("--couples",))
+ANALYSIS_FLAGS = frozenset(flag for group in ANALYSIS_GROUPS for flag in group)
+
+
+def split_commands(cmd: Sequence[str]) -> List[List[str]]:
+    """
+    Split hercules command into commands with one group of analyses each.
+
+    :param cmd: hercules command.
+    :return: commands with the rest of arguments of `cmd`. Just `cmd` if it has a single group.
+    """
+    common = [arg for arg in cmd if arg not in ANALYSIS_FLAGS]
+    groups = [[flag for flag in group if flag in cmd] for group in ANALYSIS_GROUPS]
+    groups = [group for group in groups if group]
+    if len(groups) < 2:
+        return [list(cmd)]
+    return [common + group for group in groups]
+
+
+def splice_statistics(parts: Sequence[str], stat_loc: str) -> None:
+    """
+    Splice statistics of the same history with different analyses into one file.
+
+    :param parts: locations of statistics produced by hercules with `--pb`.
+    :param stat_loc: where to store spliced statistics.
+    """
+    with open(stat_loc, "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+
+def split_call_with_rusage(commands: Sequence[Sequence[str]], stat_loc: str,
+                           timeout: float = None) -> resource.struct_rusage:
+    """
+    Run hercules commands concurrently and splice their statistics.
+
+    :param commands: hercules commands with `--pb` over the same history (see `split_commands`).
+    :param stat_loc: where to store spliced statistics.
+    :param timeout: max duration of each hercules run in seconds. If None or <= 0 - no limit.
+    :return: resource usage summed over runs (`ru_maxrss` too - the runs are concurrent).
+    :raises subprocess.CalledProcessError: if one of hercules runs failed (the rest are killed).
+    :raises subprocess.TimeoutExpired: if one of hercules runs was killed because of timeout.
+    """
+    parts = [f"{stat_loc}.part_{i}" for i in range(len(commands))]
+    try:
+        rusages = check_calls_with_rusage(list(zip(commands, parts)), timeout=timeout)
+        splice_statistics(parts, stat_loc)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return resource.struct_rusage([sum(values) for values in zip(*rusages)])
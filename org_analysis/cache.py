@@ -0,0 +1,91 @@
+"""Content-addressed cache of per-repository statistics."""
+from functools import lru_cache
+import hashlib
+import os
+import subprocess
+from typing import Sequence
+
+from org_analysis.triage import git_output
+
+KEY_SUFFIX = ".key"
+
+
+@lru_cache(maxsize=None)
+def hercules_version(hercules_exec: str) -> str:
+    """
+    Get version of hercules executable (evaluated once per process).
+
+    :param hercules_exec: location of hercules executable.
+    :return: output of `hercules version` or empty string if it failed.
+    """
+    try:
+        return subprocess.run([hercules_exec, "version"], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).stdout.decode("utf-8", "replace")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def statistics_key(repo_loc: str, flags: Sequence[str], version: str) -> str:
+    """
+    Compute cache key of statistics: hash of repository refs and HEAD, hercules flags and version.
+
+    :param repo_loc: location of repository.
+    :param flags: hercules command line flags (without repository location).
+    :param version: hercules version.
+    :return: hex digest or empty string if repository state can't be read.
+    """
+    try:
+        refs = git_output(repo_loc, "for-each-ref", "--format=%(objectname) %(refname)")
+        head = git_output(repo_loc, "rev-parse", "HEAD")
+    except subprocess.CalledProcessError:
+        return ""
+    hasher = hashlib.sha256()
+    for part in (refs, head, "\0".join(flags), version):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def key_location(stat_loc: str) -> str:
+    """Location of file with cache key of statistics."""
+    return stat_loc + KEY_SUFFIX
+
+
+def is_cached(stat_loc: str, key: str) -> bool:
+    """
+    Check if statistics exist and were calculated for the same key.
+
+    :param stat_loc: location of statistics.
+    :param key: expected cache key.
+    :return: True if statistics could be reused.
+    """
+    if not key or not os.path.isfile(stat_loc):
+        return False
+    try:
+        with open(key_location(stat_loc)) as f:
+            return f.read().strip() == key
+    except OSError:
+        return False
+
+
+def invalidate(stat_loc: str) -> None:
+    """Remove cache key of statistics - it should be done before statistics are overwritten."""
+    try:
+        os.remove(key_location(stat_loc))
+    except FileNotFoundError:
+        pass
+
+
+def store_key(stat_loc: str, key: str) -> None:
+    """
+    Save cache key next to successfully calculated statistics.
+
+    :param stat_loc: location of statistics.
+    :param key: cache key.
+    """
+    if not key:
+        return
+    tmp_loc = key_location(stat_loc) + ".tmp"
+    with open(tmp_loc, "w") as f:
+        f.write(key)
+    os.replace(tmp_loc, key_location(stat_loc))
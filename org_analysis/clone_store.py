@@ -0,0 +1,362 @@
+"""Clones under disk budget: least recently used ones are evicted, fragmented ones are repacked.
+
+The store is the output directory of `download` with `CLONE_STORE_NAME` in it - JSON with URL,
+size on disk and the last time of use (clone or analysis) of each clone. Evicted clones keep
+their records, so the next `download` clones them again (borrowing objects from shared object
+stores with `--dedup`). Shared object stores under `SHARED_OBJECTS_DIR` count towards the budget
+but are never evicted - members borrow objects from them. Sizes are git's own accounting of
+objects (`git count-objects`), so measuring doesn't walk the clones.
+
+Analysis holds a shared lock on `<clone>.lease` next to each clone of a store while it reads the
+clone, eviction skips clones it can't lock exclusively - so a clone is never removed under
+hercules.
+
+Maintenance repacks clones with many loose objects or packs - hercules reads objects of
+fragmented repositories noticeably slower. Repacks run one by one with the lowest CPU and I/O
+priority and only while load average of the machine stays low.
+"""
+import argparse
+from contextlib import contextmanager
+import fcntl
+from functools import lru_cache
+import glob
+import json
+import logging as log
+import multiprocessing
+import os
+import shutil
+import subprocess
+from time import time
+from typing import Any, Dict, Iterable, Iterator, List, Sequence
+
+from org_analysis.defaults import CLONE_STORE_NAME, CSV_NAME, DIRECTORY_FIELD_NAME, DISK_BUDGET, \
+    IDLE_LOAD, LOOSE_OBJECTS_LIMIT, MAX_REPACKS, PACKS_LIMIT, REPACK_TIMEOUT, SHARED_OBJECTS_DIR, \
+    URL_FIELD_NAME
+from org_analysis.manifest import ManifestWriter, read_manifest
+from org_analysis.triage import git_output, packed_size
+
+NICENESS = 19
+LEASE_SUFFIX = ".lease"
+
+
+def lease_path(dest: str) -> str:
+    """Location of lock file which leases clone to analysis."""
+    return dest.rstrip(os.sep) + LEASE_SUFFIX
+
+
+def object_counts(repo_loc: str) -> Dict[str, int]:
+    """Numbers of loose objects (`count`) and packs (`packs`) of repository."""
+    stats = {}
+    for line in git_output(repo_loc, "count-objects", "-v").splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            stats[key.strip()] = int(value)
+    return stats
+
+
+def needs_repack(repo_loc: str, loose_objects_limit: int = LOOSE_OBJECTS_LIMIT,
+                 packs_limit: int = PACKS_LIMIT) -> bool:
+    """
+    Decide if repository is fragmented enough to repack it.
+
+    :param repo_loc: location of repository.
+    :param loose_objects_limit: repository with more loose objects is repacked.
+    :param packs_limit: repository with more packs is repacked.
+    :return: True if repository should be repacked.
+    """
+    counts = object_counts(repo_loc)
+    return counts.get("count", 0) > loose_objects_limit or counts.get("packs", 0) > packs_limit
+
+
+def _lower_priority() -> None:
+    os.nice(NICENESS)
+
+
+def repack(repo_loc: str, timeout: float = REPACK_TIMEOUT) -> None:
+    """
+    Repack repository with `git gc` at the lowest CPU (and I/O if `ionice` is available)
+    priority. Objects borrowed from alternates are not copied.
+
+    :param repo_loc: location of repository.
+    :param timeout: max duration in seconds. If None or <= 0 - no limit.
+    :raises subprocess.CalledProcessError: if git failed.
+    :raises subprocess.TimeoutExpired: if git didn't finish in time.
+    """
+    cmd = ["git", "--git-dir", repo_loc, "gc", "--quiet"]
+    if shutil.which("ionice"):
+        cmd = ["ionice", "-c", "3"] + cmd
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                   preexec_fn=_lower_priority,
+                   timeout=timeout if timeout is not None and timeout > 0 else None)
+
+
+def is_idle(idle_load: float = IDLE_LOAD) -> bool:
+    """Check if 1-minute load average per core is below `idle_load`."""
+    return os.getloadavg()[0] < idle_load * multiprocessing.cpu_count()
+
+
+class CloneStore:
+    """
+    Records of clones in store. Used as context manager: records are loaded under exclusive lock,
+    so `download`, `hercules` and maintenance may update the same store, and saved on exit.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: output directory of `download`.
+        """
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, CLONE_STORE_NAME)
+        self.records = {}
+        self._lock = None
+
+    def __enter__(self) -> "CloneStore":
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = open(self.path + ".lock", "w")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.records = json.load(f)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.records, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            self._lock.close()
+
+    def add(self, dest: str, repo_url: str, measure: bool = True) -> None:
+        """
+        Record clone made by `download`. The time of use is set only for new or evicted clones -
+        downloading doesn't make repository recently used.
+
+        :param dest: location of clone.
+        :param repo_url: repository URL.
+        :param measure: measure size of clone now. Otherwise it's measured by the next eviction.
+        """
+        dest = os.path.abspath(dest)
+        record = self.records.setdefault(dest, {})
+        if not record.get("last_used") or record.get("evicted"):
+            record["last_used"] = time()
+        record.update(url=repo_url, size=packed_size(dest) if measure else None, evicted=0)
+
+    def touch(self, dest: str) -> None:
+        """Record use of clone (analysis) now."""
+        record = self.records.setdefault(os.path.abspath(dest), {})
+        record.update(last_used=time(), evicted=0)
+
+    def shared_stores(self) -> List[str]:
+        """Locations of shared object stores."""
+        return sorted(glob.glob(os.path.join(self.root, SHARED_OBJECTS_DIR, "*.git")))
+
+    def present(self) -> Dict[str, Dict[str, Any]]:
+        """Records of clones which are on disk."""
+        return {dest: record for dest, record in self.records.items()
+                if not record.get("evicted") and os.path.isdir(dest)}
+
+    def evict(self, budget: int) -> List[str]:
+        """
+        Remove the least recently used clones until clones and shared object stores fit into
+        budget. Clones leased to analysis are skipped.
+
+        :param budget: total size in bytes. If <= 0 - nothing is evicted.
+        :return: locations of evicted clones.
+        """
+        if budget <= 0:
+            return []
+        present = self.present()
+        for dest, record in present.items():
+            if record.get("size") is None:
+                record["size"] = packed_size(dest)
+        total = sum(record["size"] for record in present.values()) + \
+            sum(packed_size(store) for store in self.shared_stores())
+        evicted = []
+        for dest, record in sorted(present.items(), key=lambda item: item[1].get("last_used", 0)):
+            if total <= budget:
+                break
+            with open(lease_path(dest), "w") as lease:
+                try:
+                    fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    log.info(f"{dest} is being analysed - not evicted")
+                    continue
+                shutil.rmtree(dest, ignore_errors=True)
+            total -= record["size"]
+            record.update(size=0, evicted=time())
+            evicted.append(dest)
+        if evicted:
+            log.info(f"{len(evicted)} least recently used clones are evicted from {self.root}")
+        if total > budget:
+            log.warning(f"Shared object stores and clones being analysed of {self.root} take "
+                        f"{total} bytes - more than disk budget {budget}")
+        return evicted
+
+    def repack_candidates(self) -> List[str]:
+        """
+        Clones and shared object stores in order of repacking. Recently used clones go first -
+        they are likely to be analysed again.
+        """
+        present = self.present()
+        return sorted(present, key=lambda dest: present[dest].get("last_used", 0),
+                      reverse=True) + self.shared_stores()
+
+    def repacked(self, repo_locs: Iterable[str]) -> None:
+        """Update sizes of repacked clones."""
+        for repo_loc in repo_locs:
+            if repo_loc in self.records:
+                self.records[repo_loc].update(size=packed_size(repo_loc), repacked=time())
+
+
+def repack_idle(candidates: Iterable[str], max_repacks: int = MAX_REPACKS,
+                idle_load: float = IDLE_LOAD, timeout: float = REPACK_TIMEOUT) -> List[str]:
+    """
+    Repack fragmented repositories one by one while the machine is idle.
+
+    :param candidates: locations of repositories in order of repacking.
+    :param max_repacks: max number of repacks. If <= 0 - no limit.
+    :param idle_load: repacks stop when 1-minute load average per core reaches it.
+    :param timeout: max duration of each repack in seconds. If <= 0 - no limit.
+    :return: locations of repacked repositories.
+    """
+    repacked = []
+    for repo_loc in candidates:
+        if 0 < max_repacks <= len(repacked):
+            break
+        if not is_idle(idle_load):
+            log.info("Machine is busy - the rest of repacks is postponed")
+            break
+        start = time()
+        try:
+            if not needs_repack(repo_loc):
+                continue
+            repack(repo_loc, timeout=timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            log.warning(f"Repack of {repo_loc} failed: {e}")
+            continue
+        log.info(f"{repo_loc} is repacked in {time() - start:.1f}s")
+        repacked.append(repo_loc)
+    return repacked
+
+
+@lru_cache(maxsize=None)
+def find_store(directory: str) -> str:
+    """
+    Find clone store which contains directory (like git finds `.git`).
+
+    :param directory: absolute location of directory.
+    :return: root of clone store or empty string.
+    """
+    if os.path.isfile(os.path.join(directory, CLONE_STORE_NAME)):
+        return directory
+    parent = os.path.dirname(directory)
+    return "" if parent == directory else find_store(parent)
+
+
+@contextmanager
+def lease_clone(repo_loc: str) -> Iterator[None]:
+    """
+    Protect clone from eviction while it's analysed. Clones outside of stores aren't leased.
+
+    :param repo_loc: location of repository.
+    """
+    repo_loc = os.path.abspath(repo_loc)
+    if not find_store(os.path.dirname(repo_loc)):
+        yield
+        return
+    with open(lease_path(repo_loc), "w") as lease:
+        fcntl.flock(lease, fcntl.LOCK_SH)
+        yield
+
+
+def touch_clones(repo_locs: Iterable[str]) -> None:
+    """
+    Record use of clones which belong to clone stores. Clones outside of stores are ignored.
+
+    :param repo_locs: locations of analysed repositories.
+    """
+    by_store = {}
+    for repo_loc in repo_locs:
+        repo_loc = os.path.abspath(repo_loc)
+        root = find_store(os.path.dirname(repo_loc))
+        if root:
+            by_store.setdefault(root, []).append(repo_loc)
+    for root, locations in by_store.items():
+        with CloneStore(root) as store:
+            for repo_loc in locations:
+                store.touch(repo_loc)
+
+
+def prune_manifest(csv_loc: str, url_field_name: str, directory_field_name: str,
+                   evicted: Sequence[str]) -> None:
+    """
+    Drop rows of evicted clones from CSV with repositories.
+
+    :param csv_loc: location of CSV. Nothing is done if it doesn't exist.
+    :param url_field_name: name of URL field in CSV.
+    :param directory_field_name: name of directory field in CSV.
+    :param evicted: locations of evicted clones.
+    """
+    if not evicted or not os.path.isfile(csv_loc):
+        return
+    evicted = set(evicted)
+    tmp_path = csv_loc + ".tmp"
+    with ManifestWriter(tmp_path, url_field_name, directory_field_name) as manifest:
+        for directory, repo_url in read_manifest(csv_loc, directory_field_name, url_field_name):
+            if os.path.abspath(directory) not in evicted:
+                manifest.write(repo_url, directory)
+    os.replace(tmp_path, csv_loc)
+
+
+def store_handler(output: str, disk_budget: int, max_repacks: int, idle_load: float,
+                  repack_timeout: float, csv_name: str, url_field_name: str,
+                  directory_field_name: str) -> None:
+    """
+    Maintain clone store: evict the least recently used clones over disk budget and repack
+    fragmented ones while the machine is idle (run it from cron).
+
+    :param output: output directory of `download`.
+    :param disk_budget: total size of clones and shared object stores in bytes. If <= 0 - no
+                        eviction.
+    :param max_repacks: max number of repacks. If <= 0 - no limit.
+    :param idle_load: repacks stop when 1-minute load average per core reaches it.
+    :param repack_timeout: max duration of each repack in seconds. If <= 0 - no limit.
+    :param csv_name: name of CSV with repositories in output directory - evicted clones are
+                     removed from it.
+    :param url_field_name: name of URL field in CSV.
+    :param directory_field_name: name of directory field in CSV.
+    """
+    with CloneStore(output) as store:
+        evicted = store.evict(disk_budget)
+        prune_manifest(os.path.join(output, csv_name), url_field_name, directory_field_name,
+                       evicted)
+        candidates = store.repack_candidates()
+    # store isn't locked during repacks, so analysis can record use of clones meanwhile
+    repacked = repack_idle(candidates, max_repacks=max_repacks, idle_load=idle_load,
+                           timeout=repack_timeout)
+    with CloneStore(output) as store:
+        store.repacked(repacked)
+    log.info(f"{len(evicted)} clones are evicted, {len(repacked)} repositories are repacked")
+
+
+def add_store_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output directory of download with clones.")
+    parser.add_argument("--disk-budget", default=DISK_BUDGET, type=int,
+                        help="Total size of clones and shared object stores in bytes - the least "
+                             "recently used clones are evicted over it. If <= 0 - no limit.")
+    parser.add_argument("--max-repacks", default=MAX_REPACKS, type=int,
+                        help="Max number of repacks of fragmented repositories. If <= 0 - no "
+                             "limit.")
+    parser.add_argument("--idle-load", default=IDLE_LOAD, type=float,
+                        help="Repacks stop when 1-minute load average per core reaches it.")
+    parser.add_argument("--repack-timeout", default=REPACK_TIMEOUT, type=float,
+                        help="Max duration of each repack in seconds. If <= 0 - no limit.")
+    parser.add_argument("--csv-name", default=CSV_NAME,
+                        help="Name of csv with repositories - evicted clones are removed from it.")
+    parser.add_argument("--url-field-name", default=URL_FIELD_NAME,
+                        help="Name of URL field in CSV (GitHub URL).")
+    parser.add_argument("--directory-field-name", default=DIRECTORY_FIELD_NAME,
+                        help="Name of directory field in CSV (it contains path to repository).")
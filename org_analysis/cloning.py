@@ -0,0 +1,231 @@
+"""Network-bound cloning on threads with retries and concurrency adapting to the remote."""
+from concurrent.futures import as_completed, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import json
+import logging as log
+import os
+import random
+import subprocess
+import threading
+from time import sleep, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from org_analysis.defaults import CLONE_BACKOFF, CLONE_MAX_BACKOFF, CLONE_RETRIES
+from org_analysis.utils import clone_repo
+
+# fragments of git errors which don't go away with retries (compared case-insensitively)
+PERMANENT_ERRORS = ("not found", "does not appear to be a git repository", "does not exist",
+                    "authentication failed", "could not read username", "permission denied",
+                    "already exists and is not an empty directory")
+DECREASE_FACTOR = 0.5  # limit is multiplied by it after transient failure or throughput drop
+THROUGHPUT_DROP = 0.75  # throughput of round below this share of previous one is a drop
+
+
+def is_transient(stderr: str) -> bool:
+    """
+    Decide if failed git command is worth retrying. Everything but errors which can't go away
+    (missing repository, authentication) is treated as transient: dropped connections, "early
+    EOF", timeouts, rate limits of server.
+
+    :param stderr: standard error of git.
+    :return: True if error is transient.
+    """
+    stderr = stderr.lower()
+    return not any(fragment in stderr for fragment in PERMANENT_ERRORS)
+
+
+class RetryPolicy(NamedTuple):
+    retries: int = CLONE_RETRIES  # retries after transient failure
+    backoff: float = CLONE_BACKOFF  # base delay in seconds, doubled with each attempt
+    max_backoff: float = CLONE_MAX_BACKOFF  # cap of delay in seconds
+
+    def delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter, so retries of many failed clones are spread in time
+        instead of hitting the server together.
+
+        :param attempt: number of failed attempts before (starting with 0).
+        :return: delay in seconds.
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class AdaptiveLimit:
+    """
+    Limit of concurrent clones with additive increase and multiplicative decrease (AIMD): each
+    successful clone raises the limit by 1 / limit (by one per round of `limit` clones), transient
+    failure cuts it by `DECREASE_FACTOR`. Permanent failures (missing repository, authentication)
+    say nothing about capacity of the remote and don't change it. Throughput is compared between
+    rounds too - if it dropped after the limit grew, more clones only compete for the same link
+    or server and the limit is cut as well.
+    """
+
+    def __init__(self, maximum: int, initial: int = None, minimum: int = 1):
+        """
+        :param maximum: max number of concurrent clones (number of threads).
+        :param initial: initial limit. Half of `maximum` by default.
+        :param minimum: min number of concurrent clones.
+        """
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = float(initial if initial is not None else max(minimum, maximum // 2))
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._round_start = time()
+        self._round_limit = self.limit
+        self._round_done = 0
+        self._previous_limit = self.limit
+        self._previous_throughput = 0.0
+
+    def acquire(self) -> None:
+        """Wait until one more clone fits into the limit."""
+        with self._cond:
+            while self._in_use >= int(self.limit):
+                self._cond.wait()
+            self._in_use += 1
+
+    def release(self, failed: bool = False, succeeded: bool = True) -> None:
+        """
+        Finish clone and adapt the limit.
+
+        :param failed: clone failed with transient error.
+        :param succeeded: clone succeeded. If neither - the limit is kept.
+        """
+        with self._cond:
+            self._in_use -= 1
+            if failed:
+                self._decrease("transient failure")
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._round_done += 1
+                if self._round_done >= int(self._round_limit):
+                    self._finish_round()
+            self._cond.notify_all()
+
+    def _finish_round(self) -> None:
+        now = time()
+        throughput = self._round_done / max(now - self._round_start, 1e-6)
+        if self._round_limit > self._previous_limit and \
+                throughput < self._previous_throughput * THROUGHPUT_DROP:
+            self._decrease(f"throughput dropped from {self._previous_throughput:.2f} to "
+                           f"{throughput:.2f} clones/s")
+        self._previous_limit, self._previous_throughput = self._round_limit, throughput
+        self._round_start, self._round_limit, self._round_done = now, self.limit, 0
+
+    def _decrease(self, reason: str) -> None:
+        before = int(self.limit)
+        self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+        if int(self.limit) < before:
+            log.info(f"Concurrency of clones is decreased to {int(self.limit)}: {reason}")
+
+
+class CloneOutcomes:
+    """
+    JSON file with outcome of the last clone of each repository, so failed repositories can be
+    retried alone. It's updated by clone threads and saved by the main thread.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: location of JSON file. It's created on `save()` if it doesn't exist.
+        """
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.records = json.load(f)
+
+    def update(self, repo_url: str, **values: Any) -> None:
+        """
+        Update outcome of repository.
+
+        :param repo_url: repository URL.
+        :param values: fields of outcome.
+        """
+        with self._lock:
+            self.records.setdefault(repo_url, {}).update(values)
+
+    def select(self, ok: bool) -> List[Tuple[str, str]]:
+        """
+        Select repositories by outcome.
+
+        :param ok: True - cloned repositories, False - failed ones.
+        :return: (repository URL, destination) of each repository.
+        """
+        with self._lock:
+            return [(repo_url, record["dest"]) for repo_url, record in self.records.items()
+                    if record.get("ok") == ok]
+
+    def save(self) -> None:
+        """Atomically write outcomes to disk."""
+        tmp_path = self.path + ".tmp"
+        with self._lock, open(tmp_path, "w") as f:
+            json.dump(self.records, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def clone_with_retries(repo_url: str, dest: str = "", force: bool = True, update: bool = False,
+                       reference: str = None, policy: RetryPolicy = RetryPolicy(),
+                       limit: AdaptiveLimit = None, outcomes: CloneOutcomes = None) -> str:
+    """
+    Clone repository and retry transient failures with exponential backoff and jitter.
+
+    :param repo_url: repository URL.
+    :param dest: destination directory.
+    :param force: force to clone repository even if it's exist already.
+    :param update: fetch new objects and refs into existing clone.
+    :param reference: shared object store to borrow objects from.
+    :param policy: how many times and how soon to retry.
+    :param limit: limit of concurrent clones to respect and adapt. If None - no limit.
+    :param outcomes: where to record outcome. If None - it's not recorded.
+    :return: destination location or None in case of errors (like `clone_repo`).
+    """
+    start = time()
+    for attempt in range(policy.retries + 1):
+        dest_dir, err, transient = None, "", False
+        if limit is not None:
+            limit.acquire()
+        try:
+            dest_dir = clone_repo(repo_url, dest=dest, force=force, update=update,
+                                  reference=reference, check=True)
+        except subprocess.CalledProcessError as e:
+            err = (e.stderr or b"").decode(errors="replace").strip() or str(e)
+            transient = is_transient(err)
+        finally:
+            if limit is not None:
+                limit.release(failed=transient, succeeded=dest_dir is not None)
+        if not transient or attempt == policy.retries:
+            break
+        delay = policy.delay(attempt)
+        log.warning(f"Repository {repo_url} failed with transient error "
+                    f"\"{err.splitlines()[-1]}\" - retry in {delay:.1f}s")
+        sleep(delay)
+    if err:
+        log.error(f"Repository {repo_url} failed after {attempt + 1} attempts: {err}")
+    if outcomes is not None:
+        outcomes.update(repo_url, dest=dest, ok=dest_dir is not None, attempts=attempt + 1,
+                        err=err, duration=time() - start, finished=datetime.now().isoformat())
+    return dest_dir
+
+
+def run_threaded(tasks: Iterable[Tuple[Callable[[Dict[str, Any]], Any], Dict[str, Any]]],
+                 n_threads: int) -> Iterator[Any]:
+    """
+    Run tasks on threads - at most `2 * n_threads` of them are submitted at once, so `tasks` may
+    be a lazy iterator.
+
+    :param tasks: (function, kwargs) - function is called with kwargs as the only argument.
+    :param n_threads: number of threads.
+    :return: iterator over results in order of completion.
+    """
+    with ThreadPoolExecutor(n_threads) as executor:
+        in_flight = set()
+        for func, kwargs in tasks:
+            if len(in_flight) >= 2 * n_threads:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            in_flight.add(executor.submit(func, kwargs))
+        for future in as_completed(in_flight):
+            yield future.result()
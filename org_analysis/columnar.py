@@ -0,0 +1,244 @@
+"""Columnar export of hercules statistics - protobuf is decoded once, queries are served from it.
+
+The store is a directory with `index.json` (names of repositories, developers and languages,
+time grids of burndowns, sizes and modification times of exported statistics) and two int64
+tables saved with NumPy. Queries memory-map tables and find rows with binary search over sorted
+columns, so rows of one developer or repository within a time range are a view without copying:
+
+- `devs.npy` - developer, language, time, repository, commits, added, removed, changed. Sorted
+  by the first four columns. Language `MISSING` - totals of developer, developer `MISSING` -
+  commits without identity.
+- `burndown.npy` - repository, sample time, band time, lines. Sorted by the first three
+  columns, zero lines are not stored.
+
+Times are unix timestamps of the beginning of ticks, so statistics with different tick sizes
+can be queried together.
+"""
+import json
+import logging as log
+import os
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from org_analysis.pb_merge import Aggregate, Index, message_types, MISSING, Term, \
+    UnsupportedStatistics
+
+INDEX_NAME = "index.json"
+DEVS_NAME = "devs.npy"
+BURNDOWN_NAME = "burndown.npy"
+DEVS_FIELDS = ("developer", "language", "time", "repository", "commits", "added", "removed",
+               "changed")
+BURNDOWN_FIELDS = ("repository", "sample_time", "band_time", "lines")
+EXPORTED_ANALYSES = ("Burndown", "Devs")
+FORMAT_VERSION = 1
+
+
+def source_stamps(stat_locs: Sequence[str]) -> Dict[str, List[int]]:
+    """Size and modification time of each statistics file to detect changes."""
+    stamps = {}
+    for stat_loc in stat_locs:
+        stat = os.stat(stat_loc)
+        stamps[os.path.abspath(stat_loc)] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+
+def decode_statistics(stat_loc: str) -> Aggregate:
+    """
+    Decode statistics of repository (or merged statistics) keeping only exported analyses.
+
+    :param stat_loc: location of statistics.
+    :return: Aggregate with statistics.
+    """
+    results_type, _ = message_types()
+    results = results_type()
+    with open(stat_loc, "rb") as f:
+        results.ParseFromString(f.read())
+    for name in set(results.contents) - set(EXPORTED_ANALYSES):
+        del results.contents[name]
+    aggregate = Aggregate()
+    aggregate.add(results)
+    return aggregate
+
+
+def burndown_rows(repository: int, term: Term, tick: int) -> np.ndarray:
+    """Non-zero cells of burndown matrix as rows of `burndown.npy`."""
+    samples, bands = np.nonzero(np.rint(term.matrix))
+    return np.column_stack([np.full(len(samples), repository, dtype=np.int64),
+                            (term.offset + samples * term.sampling) * tick,
+                            (term.offset + bands * term.granularity) * tick,
+                            np.rint(term.matrix[samples, bands])]).astype(np.int64)
+
+
+def _save(path: str, table: np.ndarray) -> None:
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(table))
+    os.replace(tmp_path, path)
+
+
+def export_statistics(stat_locs: Sequence[str], store_dir: str, force: bool = False) -> str:
+    """
+    Convert statistics to columnar store. Nothing is done if the store was exported from the
+    same files and they didn't change since then.
+
+    :param stat_locs: locations of statistics of repositories (or merged statistics).
+    :param store_dir: directory of the store.
+    :param force: export even if statistics didn't change.
+    :return: store_dir.
+    """
+    stamps = source_stamps(stat_locs)
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    if not force and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("version") == FORMAT_VERSION and index.get("sources") == stamps:
+            log.info(f"Columnar store {store_dir} is up to date")
+            return store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    developers, languages = Index(), Index()
+    repositories = []
+    devs_chunks = [np.zeros((0, len(DEVS_FIELDS)), dtype=np.int64)]
+    burndown_chunks = [np.zeros((0, len(BURNDOWN_FIELDS)), dtype=np.int64)]
+    for stat_loc in stat_locs:
+        try:
+            aggregate = decode_statistics(stat_loc)
+        except UnsupportedStatistics as e:
+            log.warning(f"Statistics {stat_loc} are not exported: {e}")
+            continue
+        repository = len(repositories)
+        meta = {"name": " & ".join(aggregate.repositories), "source": os.path.abspath(stat_loc),
+                "begin": aggregate.begin, "end": aggregate.end, "tick": aggregate.tick}
+        devs = aggregate.analyses.get("Devs")
+        if devs is not None:
+            table = devs.table()
+            # MISSING (-1) positions pick the appended MISSING
+            dev_positions = np.append(developers.map(devs.index.names), MISSING)
+            lang_positions = np.append(languages.map(devs.languages.names), MISSING)
+            devs_chunks.append(np.column_stack([
+                dev_positions[table[:, 1]], lang_positions[table[:, 2]],
+                table[:, 0] * aggregate.tick, np.full(len(table), repository, dtype=np.int64),
+                table[:, 3:]]))
+        burndown = aggregate.analyses.get("Burndown")
+        if burndown is not None and burndown.project:
+            term = burndown.project_terms()[0]
+            meta.update(origin=term.offset * aggregate.tick,
+                        sampling=term.sampling * aggregate.tick,
+                        granularity=term.granularity * aggregate.tick,
+                        samples=term.matrix.shape[0], bands=term.matrix.shape[1])
+            burndown_chunks.append(burndown_rows(repository, term, aggregate.tick))
+        repositories.append(meta)
+    devs = np.concatenate(devs_chunks)
+    devs = devs[np.lexsort(devs[:, 3::-1].T)]
+    burndown = np.concatenate(burndown_chunks)
+    burndown = burndown[np.lexsort(burndown[:, 2::-1].T)]
+    _save(os.path.join(store_dir, DEVS_NAME), devs)
+    _save(os.path.join(store_dir, BURNDOWN_NAME), burndown)
+    # index is written the last, so the store is never up to date with partially written tables
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": FORMAT_VERSION, "repositories": repositories,
+                   "developers": developers.names, "languages": languages.names,
+                   "sources": stamps}, f)
+    os.replace(tmp_path, index_path)
+    log.info(f"{len(repositories)} statistics, {len(devs)} rows of developers and "
+             f"{len(burndown)} rows of burndown are exported to {store_dir}")
+    return store_dir
+
+
+def _range(column: np.ndarray, low: int, high: int) -> Tuple[int, int]:
+    return tuple(np.searchsorted(column, [low, high]))
+
+
+class ColumnarStore:
+    """Queries over columnar store - tables are memory-mapped, results are views if possible."""
+
+    def __init__(self, store_dir: str):
+        """
+        :param store_dir: directory of the store created by `export_statistics`.
+        """
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.repositories = [meta["name"] for meta in self.index["repositories"]]
+        self.developers = self.index["developers"]
+        self.languages = self.index["languages"]
+        self.devs = np.load(os.path.join(store_dir, DEVS_NAME), mmap_mode="r")
+        self.burndown = np.load(os.path.join(store_dir, BURNDOWN_NAME), mmap_mode="r")
+        self._repositories = {name: pos for pos, name in enumerate(self.repositories)}
+        self._developers = {name: pos for pos, name in enumerate(self.developers)}
+        self._languages = {name: pos for pos, name in enumerate(self.languages)}
+
+    @staticmethod
+    def _position(positions: Dict[str, int], name: str, kind: str) -> int:
+        try:
+            return positions[name]
+        except KeyError:
+            raise ValueError(f"Unknown {kind} {name}") from None
+
+    def developer_activity(self, developer: str, begin: int = None, end: int = None,
+                           language: str = None) -> np.ndarray:
+        """
+        Activity of developer across repositories.
+
+        :param developer: name of developer.
+        :param begin: unix timestamp of the beginning of time range (inclusive).
+        :param end: unix timestamp of the end of time range (exclusive).
+        :param language: name of language. If None - totals of developer.
+        :return: rows of `devs.npy` (columns are `DEVS_FIELDS`) sorted by time - view of the table.
+        """
+        rows = self.devs
+        dev = self._position(self._developers, developer, "developer")
+        lang = MISSING if language is None else \
+            self._position(self._languages, language, "language")
+        for column, value in ((0, dev), (1, lang)):
+            low, high = _range(rows[:, column], value, value + 1)
+            rows = rows[low:high]
+        low, high = _range(rows[:, 2], np.iinfo(np.int64).min if begin is None else begin,
+                           np.iinfo(np.int64).max if end is None else end)
+        return rows[low:high]
+
+    def developer_timeline(self, developer: str, bucket: int, begin: int = None,
+                           end: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Activity of developer summed over repositories in time buckets.
+
+        :param developer: name of developer.
+        :param bucket: size of time bucket in seconds.
+        :param begin: unix timestamp of the beginning of time range (inclusive).
+        :param end: unix timestamp of the end of time range (exclusive).
+        :return: (beginning of each bucket, commits, added, removed, changed of each bucket).
+        """
+        rows = self.developer_activity(developer, begin, end)
+        buckets, inverse = np.unique(rows[:, 2] // bucket, return_inverse=True)
+        values = np.zeros((len(buckets), 4), dtype=np.int64)
+        np.add.at(values, inverse.ravel(), rows[:, 4:])
+        return buckets * bucket, values
+
+    def repository_burndown(self, repository: str, begin: int = None, end: int = None
+                            ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Burndown of repository.
+
+        :param repository: name of repository.
+        :param begin: unix timestamp of the beginning of time range of samples (inclusive).
+        :param end: unix timestamp of the end of time range of samples (exclusive).
+        :return: (time of each sample, time of beginning of each band, samples x bands matrix).
+        """
+        pos = self._position(self._repositories, repository, "repository")
+        meta = self.index["repositories"][pos]
+        if "sampling" not in meta:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), \
+                np.zeros((0, 0), dtype=np.int64)
+        times = meta["origin"] + np.arange(meta["samples"]) * meta["sampling"]
+        first, last = _range(times, np.iinfo(np.int64).min if begin is None else begin,
+                             np.iinfo(np.int64).max if end is None else end)
+        low, high = _range(self.burndown[:, 0], pos, pos + 1)
+        rows = self.burndown[low:high]
+        never = np.iinfo(np.int64).max
+        low, high = _range(rows[:, 1], times[first] if first < len(times) else never,
+                           times[last] if last < len(times) else never)
+        rows = rows[low:high]
+        matrix = np.zeros((last - first, meta["bands"]), dtype=np.int64)
+        matrix[(rows[:, 1] - meta["origin"]) // meta["sampling"] - first,
+               (rows[:, 2] - meta["origin"]) // meta["granularity"]] = rows[:, 3]
+        bands = meta["origin"] + np.arange(meta["bands"]) * meta["granularity"]
+        return times[first:last], bands, matrix
@@ -0,0 +1,241 @@
+"""Shared object stores for repositories with common history (forks, mirrors) via git alternates.
+
+Every store is a bare repository under `<output>/.objects`. It keeps refs of every repository
+linked to it (`refs/members/<name>/*`), so objects borrowed by members are always reachable in
+the store and are never removed by repacking. Objects are fetched into the store before a member
+drops its own copies, so a member is never left without an object.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging as log
+import os
+import subprocess
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from org_analysis.defaults import GITHUB_API_URL, LISTING_THREADS, LISTING_TIMEOUT, \
+    SHARED_OBJECTS_DIR
+from org_analysis.listing import get, Repo
+from org_analysis.triage import git_output
+from org_analysis.utils import clone_repo
+
+
+def store_location(root_dir: str, key: str) -> str:
+    """
+    Location of shared object store.
+
+    :param root_dir: root directory with repositories.
+    :param key: name of family of repositories (source repository or root commit).
+    :return: location of bare repository.
+    """
+    return os.path.join(root_dir, SHARED_OBJECTS_DIR, key.replace("/", "__") + ".git")
+
+
+def member_name(repo_loc: str) -> str:
+    """Name of namespace for refs of repository in shared object store."""
+    return hashlib.sha1(os.path.abspath(repo_loc).encode("utf-8")).hexdigest()
+
+
+def init_store(store: str) -> None:
+    """Create shared object store if it doesn't exist."""
+    if not os.path.isdir(store):
+        subprocess.run(["git", "init", "--quiet", "--bare", store], check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def fetch_into_store(store: str, url: str, name: str) -> None:
+    """
+    Fetch all refs of repository into its namespace in shared object store.
+
+    :param store: location of shared object store.
+    :param url: URL or location of repository.
+    :param name: namespace for refs.
+    """
+    subprocess.run(["git", "--git-dir", store, "fetch", "--quiet", "--prune", "--force", url,
+                    f"+refs/heads/*:refs/members/{name}/heads/*",
+                    f"+refs/tags/*:refs/members/{name}/tags/*"],
+                   check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def alternates_location(repo_loc: str) -> str:
+    """Location of file with list of alternate object directories of repository."""
+    return os.path.join(repo_loc, "objects", "info", "alternates")
+
+
+def link_to_store(repo_loc: str, store: str) -> None:
+    """
+    Make existing clone borrow objects from shared object store and drop its own copies.
+
+    :param repo_loc: location of bare repository.
+    :param store: location of shared object store.
+    """
+    # objects are in the store before repository drops them
+    fetch_into_store(store, repo_loc, member_name(repo_loc))
+    alternates = alternates_location(repo_loc)
+    store_objects = os.path.join(os.path.abspath(store), "objects")
+    existing = []
+    if os.path.isfile(alternates):
+        with open(alternates) as f:
+            existing = f.read().split()
+    if store_objects not in existing:
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, "a") as f:
+            f.write(store_objects + "\n")
+    # `-l` omits objects which are available through alternates
+    subprocess.run(["git", "--git-dir", repo_loc, "repack", "-a", "-d", "-l", "-q"], check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def repack_store(store: str) -> None:
+    """Pack all objects of shared object store together. Refs of members keep them reachable."""
+    subprocess.run(["git", "--git-dir", store, "repack", "-a", "-d", "-q"], check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def fork_sources(repositories: Iterable[Repo], session: "requests.Session",
+                 api_url: str = GITHUB_API_URL,
+                 n_threads: int = LISTING_THREADS,
+                 timeout: float = LISTING_TIMEOUT) -> Dict[str, Repo]:
+    """
+    Find source (root of fork network) for every fork.
+
+    :param repositories: repositories.
+    :param session: HTTP session.
+    :param api_url: root of GitHub API.
+    :param n_threads: number of concurrent requests.
+    :param timeout: max time to wait for connection and for each read of response in seconds.
+    :return: mapping from full name of fork to its source repository.
+    """
+    def source(repo: Repo) -> Tuple[str, Repo]:
+        response = get(session, f"{api_url}/repos/{repo.full_name}", timeout=timeout)
+        response.raise_for_status()
+        meta = response.json().get("source")
+        if not meta:
+            return repo.full_name, None
+        return repo.full_name, Repo(**{field: meta[field] for field in Repo._fields})
+
+    forks = [repo for repo in repositories if repo.fork]
+    with ThreadPoolExecutor(n_threads) as executor:
+        return {name: src for name, src in executor.map(source, forks) if src}
+
+
+def fork_families(repositories: Sequence[Repo],
+                  sources: Dict[str, Repo]) -> Tuple[Dict[Repo, List[Repo]], List[Repo]]:
+    """
+    Group forks together with their source.
+
+    :param repositories: repositories.
+    :param sources: mapping from full name of fork to its source (see `fork_sources`).
+    :return: (mapping from source to members of family, repositories without family).
+    """
+    families = {}
+    for repo in repositories:
+        if repo.full_name in sources:
+            families.setdefault(sources[repo.full_name], []).append(repo)
+    by_name = {src.full_name: src for src in families}
+    singles = []
+    for repo in repositories:
+        if repo.full_name in by_name:
+            # source is cloned as a member of its own family
+            families[by_name[repo.full_name]].append(repo)
+        elif repo.full_name not in sources:
+            singles.append(repo)
+    return families, singles
+
+
+def clone_family(source_url: str, store: str, members: Sequence[Tuple[str, str]],
+                 force: bool = False, update: bool = False,
+                 clone: Callable[..., str] = clone_repo) -> List[Tuple[str, str]]:
+    """
+    Clone members of family against shared object store populated from their source.
+
+    :param source_url: URL of source repository of family.
+    :param store: location of shared object store.
+    :param members: (repository URL, destination) of each member.
+    :param force: force to clone repository even if it's exist already.
+    :param update: fetch new objects and refs into existing clones.
+    :param clone: function to clone member with the signature of `clone_repo`.
+    :return: list of (destination location or None in case of errors, repository URL).
+    """
+    try:
+        init_store(store)
+        fetch_into_store(store, source_url, "source")
+    except subprocess.CalledProcessError as e:
+        log.error(f"Shared object store {store} failed with exception {e}: {e.stderr}")
+        store = None
+    results = []
+    for repo_url, dest in members:
+        dest_dir = clone(repo_url, dest=dest, force=force, update=update, reference=store)
+        if dest_dir and store:
+            try:
+                # keep everything member borrows reachable in the store
+                fetch_into_store(store, dest_dir, member_name(dest_dir))
+            except subprocess.CalledProcessError as e:
+                log.error(f"Repository {dest_dir} failed with exception {e} at linking step")
+        results.append((dest_dir, repo_url))
+    if store:
+        try:
+            repack_store(store)
+        except subprocess.CalledProcessError as e:
+            log.error(f"Shared object store {store} failed with exception {e} at repacking step")
+    return results
+
+
+def clone_family_multiprocessing(kwargs) -> List[Tuple[str, str]]:
+    return clone_family(**kwargs)
+
+
+def root_commit(repo_loc: str) -> str:
+    """
+    Get the oldest root commit of repository (by committer date, ties are broken by hash) -
+    repositories with the same one share history.
+
+    :param repo_loc: location of repository.
+    :return: hash of commit or empty string for empty/broken repository.
+    """
+    try:
+        roots = git_output(repo_loc, "log", "--max-parents=0", "--all", "--format=%ct %H")
+    except subprocess.CalledProcessError:
+        return ""
+    roots = [(int(timestamp), commit) for timestamp, commit in
+             (line.split() for line in roots.splitlines() if line.strip())]
+    return min(roots, default=(0, ""))[1]
+
+
+def dedup_by_root_commit(repo_locs: Iterable[str], root_dir: str) -> int:
+    """
+    Move objects of repositories with common root commit to shared object stores.
+
+    :param repo_locs: locations of cloned repositories. Repositories which borrow objects already
+                      (members of fork families) are skipped.
+    :param root_dir: root directory with repositories.
+    :return: number of repositories linked to shared object stores.
+    """
+    groups = {}
+    for repo_loc in repo_locs:
+        if os.path.isfile(alternates_location(repo_loc)):
+            continue
+        root = root_commit(repo_loc)
+        if root:
+            groups.setdefault(root, []).append(repo_loc)
+    n_linked = 0
+    for root, members in groups.items():
+        if len(members) < 2:
+            continue
+        store = store_location(root_dir, root)
+        try:
+            init_store(store)
+        except subprocess.CalledProcessError as e:
+            log.error(f"Shared object store {store} failed with exception {e}: {e.stderr}")
+            continue
+        for repo_loc in members:
+            try:
+                link_to_store(repo_loc, store)
+                n_linked += 1
+            except subprocess.CalledProcessError as e:
+                log.error(f"Repository {repo_loc} failed with exception {e} at linking step: "
+                          f"{e.stderr}")
+        try:
+            repack_store(store)
+        except subprocess.CalledProcessError as e:
+            log.error(f"Shared object store {store} failed with exception {e} at repacking step")
+    return n_linked
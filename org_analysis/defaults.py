@@ -8,3 +8,51 @@ HERCULES_EXEC = "hercules"
 N_REPOS = -1  # all repos will be used
 SIZE_LIMIT = int(1024 * 1024 * 1024 / 4)  # 0.25 GB
 AGGREGATED_STATISTICS_NAME = "aggregated_statistics.pb"
+TRIAGE_CHUNKSIZE = 16  # number of repositories sent to triage worker at once
+MERGE_BATCH_SIZE = 32  # number of statistics to combine together while analysis is running
+MERGE_CORES = 1  # number of merges running concurrently with analysis
+HISTORY_NAME = "run_history.json"  # observations about repositories from previous runs
+SECONDS_PER_BYTE = 1e-6  # processing speed of hercules if there are no observations
+MEMORY_BUDGET = -1  # total memory for concurrent hercules processes in bytes, <= 0 - no limit
+MEMORY_PER_BYTE = 8.0  # peak memory of hercules per byte of repository if there are no observations
+BASE_JOB_MEMORY = 256 * 1024 * 1024  # memory of hercules process without repository data
+TIMEOUT = -1  # max duration of one hercules run in seconds, <= 0 - no limit
+GITHUB_API_URL = "https://api.github.com"
+PER_PAGE = 100  # max number of repositories on one page of GitHub listing
+LISTING_THREADS = 8  # number of concurrent requests to list repositories
+LISTING_CACHE_NAME = ".listing_cache.json"  # ETags of listing pages
+LISTING_TIMEOUT = 30.0  # seconds to wait for connection and for each read of GitHub API response
+LISTING_RETRIES = 3  # retries of GitHub API request after timeout
+SHARED_OBJECTS_DIR = ".objects"  # directory with shared object stores of related repositories
+LEASE_SECONDS = 60  # claim of job expires if node doesn't renew it for so long
+MAX_ATTEMPTS = 3  # job is marked as failed after so many expired claims
+POLL_INTERVAL = 5  # seconds between checks of work queue while other nodes are busy
+PARTIALS_DIR = "partials"  # directory with partial aggregates of nodes
+MERGE_ENGINE = "hercules"  # "hercules" - `hercules combine` subprocesses, "python" - in-process
+CLONE_THREADS = 8  # number of concurrent clones in pipeline
+MAX_IN_FLIGHT = -1  # repositories cloned but not analysed yet, <= 0 - 2 * (threads + cores)
+CLONES_DIR = "repositories"  # directory with clones in pipeline output
+STATISTICS_DIR = "statistics"  # directory with statistics of repositories in pipeline output
+START_METHOD = None  # how pool workers are started ("fork", "spawn", "forkserver"), None - default
+WORKER_MODULES = ("org_analysis.hercules_statistics",)  # modules preloaded by forkserver
+MANIFEST_WINDOW = 1024  # repositories read from input CSV, triaged and ordered together
+ADMISSION_LOOKAHEAD = 64  # jobs waiting for admission, smaller ones may overtake the first one
+ADMISSION_MAX_OVERTAKES = 16  # then memory is reserved for the first job until it fits
+ADMISSION_MAX_WAIT = 600.0  # seconds the first job may wait before memory is reserved for it
+ADMISSION_POLL_INTERVAL = 0.5  # seconds between pulls of jobs while none of them is ready
+RESULTS_LOG_NAME = "results.jsonl"  # results of repositories spilled to disk during the run
+CLONE_RETRIES = 3  # retries of clone after transient failure
+CLONE_BACKOFF = 2.0  # base delay before retry of clone in seconds, doubled with each attempt
+CLONE_MAX_BACKOFF = 60.0  # max delay before retry of clone in seconds
+CLONE_OUTCOMES_NAME = "clone_outcomes.json"  # outcome of the last clone of each repository
+COLUMNAR_DIR = "columnar"  # columnar store exported from statistics in output directory
+PROFILE = "full"  # analysis profile - set of hercules analyses
+SHARDS = 0  # segments of history of repository over size limit analysed in parallel, <= 0 - skip
+CLONE_STORE_NAME = "clone_store.json"  # size and the last use of each clone in download output
+DISK_BUDGET = -1  # total size of clones in download output in bytes, <= 0 - no limit
+LOOSE_OBJECTS_LIMIT = 1000  # clone with more loose objects is repacked during maintenance
+PACKS_LIMIT = 8  # clone with more packs is repacked during maintenance
+MAX_REPACKS = 16  # repacks in one maintenance run, <= 0 - no limit
+IDLE_LOAD = 0.5  # repacks run while 1-minute load average per core is below it
+REPACK_TIMEOUT = 3600  # max duration of one repack in seconds, <= 0 - no limit
+MERGE_WORK_SUFFIX = ".merge"  # work directory of hierarchical merge next to merged statistics
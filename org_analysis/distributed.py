@@ -0,0 +1,276 @@
+"""Calculate statistics on several nodes which claim repositories from shared work queue.
+
+Every node runs the same command against the same input CSV, output directory and queue. Input
+CSV, repositories and output directory have to be on a filesystem shared by all nodes. Each node
+merges statistics of its own repositories into partial aggregate, the last node to finish merges
+partial aggregates (and statistics of nodes that died) into final statistics.
+
+Queue database holds one run: after the final merge every job is done and the final merge is
+taken, so the next run has to use a new database or pass `--reset-queue`.
+"""
+import argparse
+import multiprocessing
+from multiprocessing import Pool
+from operator import itemgetter
+import os
+import logging as log
+import subprocess
+from time import sleep
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from org_analysis import metrics
+from org_analysis.admission import admit_jobs, expected_memory, memory_per_byte
+from org_analysis.clone_store import touch_clones
+from org_analysis.defaults import HISTORY_NAME, LEASE_SECONDS, MEMORY_BUDGET, MERGE_BATCH_SIZE, \
+    MERGE_CORES, MERGE_ENGINE, PARTIALS_DIR, POLL_INTERVAL, PROFILE, SHARDS, TIMEOUT
+from org_analysis.hercules_statistics import add_hercules_args, job_processes, known_failures, \
+    merge_statistics, ReportStat, StreamingMerger, triaged_statistics_multiprocessing
+from org_analysis.history import RunHistory
+from org_analysis.manifest import read_manifest
+from org_analysis.triage import packed_size
+from org_analysis.utils import filter_kwargs, kill_process_groups_on_sigterm
+from org_analysis.work_queue import default_node_id, Heartbeat, WorkQueue
+
+FINAL_MERGE = "final_merge"
+
+
+def _init_worker(*metrics_args) -> None:
+    metrics.configure(*metrics_args)
+    # hercules of terminated worker would keep running on jobs claimed by other nodes
+    kill_process_groups_on_sigterm()
+
+
+def node_statistics_multiprocessing(kwargs) -> Tuple[str, Optional[ReportStat], str, str]:
+    """
+    Calculate statistics of claimed repository - failure of one job doesn't stop the node.
+
+    :param kwargs: arguments of `triaged_statistics_multiprocessing` with number of hercules
+                   `processes` of job.
+    :return: (key of job, ReportStat, path, "") or (key of job, None, None, exception).
+    """
+    kwargs = {key: value for key, value in kwargs.items() if key != "processes"}
+    try:
+        stat, stat_loc = triaged_statistics_multiprocessing(kwargs)
+    except Exception as e:
+        return kwargs["repo_loc"], None, None, str(e)
+    return kwargs["repo_loc"], stat, stat_loc, ""
+
+
+def final_merge(queue: WorkQueue, output: str, result_filepath: str, hercules_exec: str,
+                batch_size: int, merge_cores: int, timeout: float,
+                merge_engine: str = MERGE_ENGINE) -> str:
+    """
+    Merge partial aggregates of nodes and statistics of jobs completed by nodes which died before
+    publishing their partial aggregates. History of runs is updated from results of all jobs.
+
+    :param queue: work queue.
+    :param output: output directory.
+    :param result_filepath: path to store final statistics.
+    :param hercules_exec: location of hercules executable.
+    :param batch_size: number of statistics to combine together.
+    :param merge_cores: number of concurrent merges.
+    :param timeout: max duration of each hercules combine in seconds (and of hercules runs -
+                    stored in history).
+    :param merge_engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+    :return: location of aggregated statistics or None in case of error.
+    """
+    finished = queue.finished_nodes()
+    locations = [partial for partial in finished.values() if partial]
+    history = RunHistory(os.path.join(output, HISTORY_NAME))
+    used = []
+    for key, owner, result in queue.results():
+        if owner not in finished and result.get("stat_loc"):
+            log.warning(f"Node {owner} didn't finish - merging {key} individually")
+            locations.append(result["stat_loc"])
+        if result.get("stat_loc"):
+            used.append(key)
+        if result.get("analysed"):
+            history.update(key, duration=result["duration"], repo_size=result["repo_size"],
+                           peak_rss=result["peak_rss"], first_parent=result["first_parent"],
+                           timed_out_key=result["key"] if result["timed_out"] else "",
+                           timed_out_after=timeout if result["timed_out"] else 0)
+    history.save()
+    touch_clones(used)
+    if not locations:
+        log.error("Nothing to merge")
+        return None
+    # statistics were validated by nodes already
+    return merge_statistics([(None, loc) for loc in locations], result_filepath,
+                            hercules_exec=hercules_exec, n_samples=batch_size,
+                            n_cores=merge_cores, validate=False, engine=merge_engine,
+                            timeout=timeout)
+
+
+def node_handler(queue_path: str, input_csv: str, output: str, size_limit: int, force: bool,
+                 n_cores: int, hercules_exec: str, directory_field_name: str, url_field_name: str,
+                 aggregated_statistics_name: str, n_samples: int, merge_cores: int = MERGE_CORES,
+                 timeout: float = TIMEOUT, node_id: str = None,
+                 lease_seconds: float = LEASE_SECONDS, poll_interval: float = POLL_INTERVAL,
+                 metrics_path: str = None, merge_engine: str = MERGE_ENGINE,
+                 shards: int = SHARDS, profile: str = PROFILE,
+                 split_analyses: bool = False, reset_queue: bool = False,
+                 memory_budget: int = MEMORY_BUDGET, prometheus_textfile: str = None) -> None:
+    """
+    Run one node of distributed pipeline: claim repositories from work queue until all of them
+    are processed, merge their statistics into partial aggregate and take part in final merge.
+
+    :param queue_path: location of SQLite database of work queue on shared filesystem.
+    :param input_csv: path to CSV with information about repositories location.
+    :param output: output directory to store statistics.
+    :param size_limit: max size of repo to process in bytes. If <= 0 no filtering will be applied.
+    :param force: force overwriting of existing statistics.
+    :param n_cores: how many hercules processes to run concurrently on this node.
+    :param hercules_exec: hercules executable location.
+    :param directory_field_name: name of directory field in CSV (it contains path to repository).
+    :param url_field_name: name of URL field in CSV (it contains repository's URL).
+    :param aggregated_statistics_name: name of file to store aggregated statistics.
+    :param n_samples: number of statistics to combine together. If <= 0 - `MERGE_BATCH_SIZE`.
+    :param merge_cores: how many merges to run concurrently with analysis.
+    :param timeout: max duration of each hercules run (analysis or combine) in seconds. If <= 0 -
+                    no limit.
+    :param node_id: identifier of this node. Host name and process id are used by default.
+    :param lease_seconds: claims of node expire if it doesn't renew them for so long.
+    :param poll_interval: seconds between checks of queue while other nodes finish their jobs.
+    :param metrics_path: JSONL file to append metrics of each stage to. If None - no metrics.
+    :param merge_engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+    :param shards: repositories over `size_limit` are analysed by this number of parallel hercules
+                   runs over segments of history. If <= 0 - they are skipped.
+    :param profile: name of analysis profile - set of hercules analyses.
+    :param split_analyses: run independent analyses of the profile as concurrent hercules
+                           processes per repository and splice their statistics.
+    :param reset_queue: empty the queue first if it holds a finished run.
+    :param memory_budget: total memory of concurrent hercules processes of node in bytes. Claimed
+                          jobs are started only while their expected memory fits. If <= 0 - only
+                          `n_cores` limits concurrency.
+    :param prometheus_textfile: Prometheus textfile to write metrics of the node aggregated by stage
+                                to when it finishes (requires `metrics_path`).
+    :raises RuntimeError: if leases of node couldn't be renewed - its jobs may be claimed by other
+                          nodes, so its hercules runs are killed and nothing is completed.
+    """
+    metrics.configure(metrics_path)
+    os.makedirs(os.path.join(output, PARTIALS_DIR), exist_ok=True)
+    node_id = node_id or default_node_id()
+    queue = WorkQueue(queue_path, node_id=node_id, lease_seconds=lease_seconds)
+    if reset_queue and queue.reset_finished(FINAL_MERGE):
+        log.info(f"Queue {queue_path} held a finished run - it's emptied")
+    # every node adds the same jobs, only the first one actually inserts them
+    added = queue.add((repo, {"repo_loc": repo, "repo_url": url})
+                      for repo, url in read_manifest(input_csv, directory_field_name,
+                                                     url_field_name))
+    log.info(f"Node {node_id}: {added} new jobs, {queue.remaining()} jobs to process")
+    if not added and not queue.remaining():
+        log.warning(f"Queue {queue_path} has no jobs to process - if it holds a finished run, "
+                    f"pass --reset-queue to start a new one")
+    # history is only read by nodes, it's updated at final merge
+    history = RunHistory(os.path.join(output, HISTORY_NAME))
+    ratio = memory_per_byte(history)
+    n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
+    batch_size = n_samples if n_samples > 0 else MERGE_BATCH_SIZE
+    partial = None
+    with Heartbeat(queue_path, node_id, lease_seconds) as heartbeat, \
+            Pool(n_cores, initializer=_init_worker, initargs=metrics.initargs()) as p, \
+            StreamingMerger(hercules_exec=hercules_exec, batch_size=batch_size,
+                            n_cores=merge_cores, engine=merge_engine, timeout=timeout) as merger:
+        merged = {}  # statistics added to partial aggregate -> key of job
+
+        def jobs() -> Iterator[Optional[Tuple[Dict[str, Any], int]]]:
+            while True:
+                if heartbeat.lost.is_set():
+                    # leaving the pool terminates workers, they kill their hercules runs
+                    raise RuntimeError(f"Node {node_id} lost its leases - stopping")
+                job = queue.claim()
+                if job is None:
+                    if not queue.remaining():
+                        return
+                    # other nodes hold the rest, their claims are taken over if they expire
+                    yield None
+                    continue
+                key, payload = job
+                kwargs = {"output_dir": output, "force": force, "hercules_exec": hercules_exec,
+                          "size_limit": size_limit, "timeout": timeout, "shards": shards,
+                          "profile": profile, "split_analyses": split_analyses,
+                          **payload, **known_failures(history.get(key), timeout)}
+                try:
+                    repo_size = packed_size(kwargs["repo_loc"])
+                except subprocess.CalledProcessError:
+                    repo_size = 0  # triage of worker reports it
+                kwargs["processes"] = job_processes({**kwargs, "repo_size": repo_size})
+                yield kwargs, expected_memory(key, repo_size, history, ratio,
+                                              kwargs["processes"])
+
+        # claimed jobs are admitted within memory budget, one more waits for admission
+        for key, stat, stat_loc, err in admit_jobs(p, node_statistics_multiprocessing, jobs(),
+                                                   budget=memory_budget, max_in_flight=n_cores,
+                                                   lookahead=1, poll_interval=poll_interval,
+                                                   processes=itemgetter("processes")):
+            if stat is None:
+                log.error(f"Repository {key} failed with exception {err}")
+                queue.complete(key, {"err": err}, failed=True)
+                continue
+            metrics.emit("repository", repository=stat.repository, wall_time=stat.duration,
+                         exit_status=int(bool(stat.err)), repo_size=stat.repo_size,
+                         err=stat.err, analysed=stat.analysed, node=node_id)
+            # result is dropped if job was taken over by other node meanwhile
+            if queue.complete(key, {**stat._asdict(), "stat_loc": stat_loc},
+                              failed=bool(stat.err)) and stat_loc:
+                merger.add(stat_loc)
+                merged[os.path.abspath(stat_loc)] = key
+        if merged:
+            log.info(f"Node {node_id}: merging statistics of {len(merged)} repositories...")
+            partial = merger.finish(os.path.join(output, PARTIALS_DIR, f"{node_id}.pb"))
+            # they aren't in partial aggregate and final merge takes only partial aggregates of
+            # finished nodes
+            dropped = [merged[os.path.abspath(loc)] for loc in merger.dropped
+                       if os.path.abspath(loc) in merged]
+            if dropped:
+                n_failed = queue.fail_done(dropped, "statistics were lost in failed merge")
+                log.error(f"Node {node_id}: {n_failed} repositories are marked as failed because "
+                          f"their merge failed: {', '.join(dropped)}")
+        queue.finish_node(partial)
+        # the last node to finish does final merge, wait for nodes which are still merging
+        while queue.working_nodes():
+            sleep(poll_interval)
+    final_stat = None
+    if queue.acquire(FINAL_MERGE):
+        log.info(f"Node {node_id}: final merge...")
+        final_stat = final_merge(queue, output, os.path.join(output, aggregated_statistics_name),
+                                 hercules_exec=hercules_exec, batch_size=batch_size,
+                                 merge_cores=merge_cores, timeout=timeout,
+                                 merge_engine=merge_engine)
+    else:
+        log.info(f"Node {node_id}: done, final merge is done by other node")
+    queue.close()
+    if metrics_path and prometheus_textfile:
+        metrics.write_prometheus(metrics_path, prometheus_textfile)
+    if final_stat:
+        log.info("Success!")
+        log.info(f"Aggregated statistics is stored at {final_stat}")
+
+
+def add_node_args(parser: argparse.ArgumentParser):
+    add_hercules_args(parser)
+    parser.add_argument("--queue", dest="queue_path", required=True,
+                        help="SQLite database of work queue on filesystem shared by all nodes. "
+                             "It's created by the first node and holds one run - use a new "
+                             "database or --reset-queue for the next run.")
+    parser.add_argument("--reset-queue", action="store_true",
+                        help="Empty the queue first if it holds a finished run (nothing pending "
+                             "and the final merge done).")
+    parser.add_argument("--node-id", default=None,
+                        help="Identifier of this node. Host name and process id by default.")
+    parser.add_argument("--lease-seconds", default=LEASE_SECONDS, type=float,
+                        help="Claims of node expire if it doesn't renew them for so long - then "
+                             "other nodes take over its repositories.")
+    parser.add_argument("--poll-interval", default=POLL_INTERVAL, type=float,
+                        help="Seconds between checks of queue while other nodes are busy.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", default="INFO", choices=log._nameToLevel,
+                        help="Logging verbosity.")
+    add_node_args(parser)
+    args = parser.parse_args()
+    log.getLogger().setLevel(args.log_level)
+    node_kwargs = filter_kwargs(vars(args), node_handler)
+    node_handler(**node_kwargs)
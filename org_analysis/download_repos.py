@@ -1,25 +1,31 @@
 """Functionality related to retrieving list of repositories and cloning them."""
 import argparse
+from functools import partial
 import os
-import multiprocessing
-from multiprocessing import Pool
 import logging as log
+from typing import Any, Callable, Dict, Iterable, Tuple
 
-
-from github import UnknownObjectException, Repository
 from tqdm import tqdm
 
-from org_analysis.defaults import CSV_NAME, DIRECTORY_FIELD_NAME, GITHUB_TOKEN_ENV_VAR, N_CORES, \
-    URL_FIELD_NAME
-from org_analysis.utils import ArgumentDefaultsHelpFormatterNoNone, clone_repo, init_github, \
-    filter_kwargs
+from org_analysis.clone_store import CloneStore, prune_manifest
+from org_analysis.cloning import AdaptiveLimit, clone_with_retries, CloneOutcomes, RetryPolicy, \
+    run_threaded
+from org_analysis.defaults import CLONE_BACKOFF, CLONE_OUTCOMES_NAME, CLONE_RETRIES, \
+    CLONE_THREADS, CSV_NAME, DIRECTORY_FIELD_NAME, DISK_BUDGET, GITHUB_API_URL, \
+    GITHUB_TOKEN_ENV_VAR, LISTING_CACHE_NAME, LISTING_THREADS, LISTING_TIMEOUT, URL_FIELD_NAME
+from org_analysis import metrics
+from org_analysis.dedup import clone_family_multiprocessing, dedup_by_root_commit, \
+    fork_families, fork_sources, store_location
+from org_analysis.listing import list_repositories, make_session, Repo
+from org_analysis.manifest import ManifestWriter, read_manifest
+from org_analysis.utils import add_metrics_args, ArgumentDefaultsHelpFormatterNoNone, filter_kwargs
 
 
 def clone_repo_multiprocessing(kwargs):
-    return clone_repo(**kwargs), kwargs["repo_url"]
+    return [(clone_with_retries(**kwargs), kwargs["repo_url"])]
 
 
-def make_repo_dest_dir(repository: Repository.Repository, root_dir: str) -> str:
+def make_repo_dest_dir(repository: Repo, root_dir: str) -> str:
     """
     Prepare name of destination directory for given repository.
 
@@ -30,8 +36,55 @@ def make_repo_dest_dir(repository: Repository.Repository, root_dir: str) -> str:
     return os.path.join(root_dir, repository.full_name)
 
 
-def handler(login, password, token_env, organization, cores, output, force, csv_name,
-            url_field_name, directory_field_name):
+def clone_tasks(repositories: Iterable[Repo], output: str, clone_kwargs: Dict[str, Any],
+                session: "requests.Session" = None, api_url: str = GITHUB_API_URL,
+                listing_threads: int = LISTING_THREADS, listing_timeout: float = LISTING_TIMEOUT
+                ) -> Iterable[Tuple[Callable[[Dict[str, Any]], Any], Dict[str, Any]]]:
+    """
+    Prepare tasks to clone repositories.
+
+    :param repositories: repositories to clone.
+    :param output: output directory.
+    :param clone_kwargs: arguments of `clone_with_retries` besides URL and destination.
+    :param session: HTTP session to find fork families. If None - repositories are cloned
+                    independently.
+    :param api_url: root of GitHub API.
+    :param listing_threads: number of concurrent requests to find fork families.
+    :param listing_timeout: max time to wait for connection and for each read of GitHub API
+                            response in seconds.
+    :return: (function, kwargs) of each task - function returns list of (destination, URL).
+    """
+    if session is None:
+        return ((clone_repo_multiprocessing, {"repo_url": r.git_url,
+                                              "dest": make_repo_dest_dir(r, output),
+                                              **clone_kwargs})
+                for r in repositories)
+    # families have to be known before cloning, so the whole listing is collected first
+    repositories = list(repositories)
+    families, singles = fork_families(repositories,
+                                      fork_sources(repositories, session, api_url=api_url,
+                                                   n_threads=listing_threads,
+                                                   timeout=listing_timeout))
+    log.info(f"{len(families)} fork families found")
+    clone = partial(clone_with_retries, **{key: value for key, value in clone_kwargs.items()
+                                           if key not in ("force", "update")})
+    tasks = [(clone_family_multiprocessing,
+              {"source_url": src.git_url, "store": store_location(output, src.full_name),
+               "members": [(r.git_url, make_repo_dest_dir(r, output)) for r in members],
+               "force": clone_kwargs["force"], "update": clone_kwargs["update"], "clone": clone})
+             for src, members in families.items()]
+    tasks.extend((clone_repo_multiprocessing, {"repo_url": r.git_url,
+                                               "dest": make_repo_dest_dir(r, output),
+                                               **clone_kwargs})
+                 for r in singles)
+    return tasks
+
+
+def handler(login, password, token_env, organization, clone_threads, output, force, update,
+            csv_name, url_field_name, directory_field_name, api_url=GITHUB_API_URL,
+            listing_threads=LISTING_THREADS, listing_timeout=LISTING_TIMEOUT, dedup=False,
+            metrics_path=None, prometheus_textfile=None, retries=CLONE_RETRIES,
+            backoff=CLONE_BACKOFF, retry_failed=False, disk_budget=DISK_BUDGET):
     """
     Retrieve list of repositories in organization/user and download them to output directory and
     save CSV with fields `URL,directory`.
@@ -40,48 +93,91 @@ def handler(login, password, token_env, organization, cores, output, force, csv_
     :param password: GitHub password.
     :param token_env: environment variable to store GitHub token.
     :param organization: organization name.
-    :param cores: number of cores to use for downloading repositories.
+    :param clone_threads: max number of concurrent clones. Actual concurrency adapts to throughput
+                          and transient failures between 1 and this number.
     :param output: output directory.
     :param force: if not force and repository was cloned already - nothing will be done. If force
                   and repository was cloned - repository will be deleted and cloned again.
+    :param update: if repository was cloned already (and not force) - incrementally fetch new
+                   objects and refs into it.
     :param csv_name: name of csv to store statistics.
     :param url_field_name: name of URL field in CSV (GitHub URL).
     :param directory_field_name: name of directory field in CSV (path to repository)..
+    :param api_url: root of GitHub API.
+    :param listing_threads: number of concurrent requests to list repositories.
+    :param listing_timeout: max time to wait for connection and for each read of GitHub API
+                            response in seconds.
+    :param dedup: clone forks against shared object store of their source and move objects of
+                  repositories with common root commit to shared object stores (git alternates).
+    :param metrics_path: JSONL file to append metrics of each stage to. If None - no metrics.
+    :param prometheus_textfile: Prometheus textfile to write metrics of the run aggregated by
+                                stage to (requires `metrics_path`).
+    :param retries: how many times to retry clone after transient failure.
+    :param backoff: base delay before retry in seconds, it's doubled with each attempt.
+    :param retry_failed: clone only repositories which failed in previous runs (according to
+                         `CLONE_OUTCOMES_NAME` in output directory) without listing organization.
+    :param disk_budget: total size of clones and shared object stores in output directory in
+                        bytes - the least recently used (cloned or analysed) clones are evicted
+                        over it and dropped from CSV. If <= 0 - no limit.
     """
-    entrypoint = init_github(login_or_token=login, password=password,
-                             token_env=token_env)
-    try:
-        org_or_user = entrypoint.get_organization(organization)
-    except UnknownObjectException:
-        # switch to user
-        org_or_user = entrypoint.get_user(organization)
-    # this step may take a while to complete for big organizations with many repositories
-    log.info("Retrieving a list of repositories...")
-    repositories = list(org_or_user.get_repos())
-
-    log.info(f"Number of repositories to process is {len(repositories)}")
+    metrics.configure(metrics_path)
     os.makedirs(output, exist_ok=True)
-
-    arguments = [{"repo_url": r.git_url, "dest": d, "force": f}
-                 for r, d, f in zip(repositories, map(lambda r: make_repo_dest_dir(r, output),
-                                                      repositories),
-                                    [force] * len(repositories))]
-    n_cores = cores if cores > 0 else multiprocessing.cpu_count()
-    with Pool(n_cores) as p:
-        results = []
-        for dest_dir, repo_url in tqdm(p.imap_unordered(clone_repo_multiprocessing, arguments),
-                                       total=len(repositories), unit="repo", desc="repositories"):
-            results.append((dest_dir, repo_url))
-    good_res = [(dest_dir, repo_url) for dest_dir, repo_url in results if dest_dir]
-    log.info(f"{len(good_res)} repositories out of {len(results)} cloned "
-             f"successfully")
+    outcomes = CloneOutcomes(os.path.join(output, CLONE_OUTCOMES_NAME))
+    clone_threads = clone_threads if clone_threads > 0 else CLONE_THREADS
+    clone_kwargs = {"force": force, "update": update, "outcomes": outcomes,
+                    "policy": RetryPolicy(retries=retries, backoff=backoff),
+                    "limit": AdaptiveLimit(clone_threads)}
+    if retry_failed:
+        failed = outcomes.select(ok=False)
+        log.info(f"Retrying {len(failed)} repositories which failed before...")
+        tasks = ((clone_repo_multiprocessing, {"repo_url": repo_url, "dest": dest, **clone_kwargs})
+                 for repo_url, dest in failed)
+    else:
+        session = make_session(login=login, password=password, token_env=token_env,
+                               pool_size=listing_threads)
+        # pages of listing are fetched concurrently and repositories are cloned as pages arrive
+        log.info("Retrieving a list of repositories...")
+        repositories = list_repositories(organization, session, api_url=api_url,
+                                         cache_path=os.path.join(output, LISTING_CACHE_NAME),
+                                         n_threads=listing_threads, timeout=listing_timeout)
+        tasks = clone_tasks(repositories, output, clone_kwargs, session=session if dedup else None,
+                            api_url=api_url, listing_threads=listing_threads,
+                            listing_timeout=listing_timeout)
+    # rows are written as clones finish, so nothing is accumulated in memory
     csv_loc = os.path.join(output, csv_name)
-    with open(csv_loc, "w") as f:
-        f.write(f"{url_field_name},{directory_field_name}\n")
-        for dest_dir, repo_url in good_res:
-            f.write(f"{repo_url},{dest_dir}\n")
-
+    n_total = n_good = 0
+    # clones are network-bound, so they run on threads under adaptive limit instead of processes
+    with ManifestWriter(csv_loc, url_field_name, directory_field_name) as manifest:
+        if retry_failed:
+            # repositories cloned in previous runs stay in CSV
+            for repo_url, dest_dir in outcomes.select(ok=True):
+                manifest.write(repo_url, dest_dir)
+        try:
+            for res in tqdm(run_threaded(tasks, clone_threads), unit="task",
+                            desc="repositories"):
+                for dest_dir, repo_url in res:
+                    n_total += 1
+                    if dest_dir:
+                        manifest.write(repo_url, dest_dir)
+                        n_good += 1
+        finally:
+            outcomes.save()
+    log.info(f"{n_good} repositories out of {n_total} cloned successfully")
+    if dedup:
+        n_linked = dedup_by_root_commit(
+            (dest_dir for dest_dir, _ in read_manifest(csv_loc, directory_field_name,
+                                                       url_field_name)), output)
+        log.info(f"{n_linked} repositories with common root commit moved objects to shared "
+                 f"stores")
+    # sizes are measured after dedup - objects moved to shared stores aren't counted twice
+    with CloneStore(output) as store:
+        for dest_dir, repo_url in read_manifest(csv_loc, directory_field_name, url_field_name):
+            store.add(dest_dir, repo_url, measure=disk_budget > 0)
+        evicted = store.evict(disk_budget)
+        prune_manifest(csv_loc, url_field_name, directory_field_name, evicted)
     log.info(f"{csv_loc} is written.")
+    if metrics_path and prometheus_textfile:
+        metrics.write_prometheus(metrics_path, prometheus_textfile)
 
 
 def add_download_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
@@ -93,10 +189,37 @@ def add_download_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParse
     parser.add_argument("-p", "--password", default=None,  help="Password.")
     parser.add_argument("--token-env", default=GITHUB_TOKEN_ENV_VAR,
                         help="Environment variable for GitHub token.")
-    parser.add_argument("-c", "--cores", default=N_CORES, type=int,
-                        help="Number of cores to use. If <= 0 - all cores will be used.")
+    parser.add_argument("-c", "--clone-threads", "--cores", default=CLONE_THREADS, type=int,
+                        help="Max number of concurrent clones - concurrency adapts to throughput "
+                             "and transient failures below it. If <= 0 - "
+                             f"{CLONE_THREADS} is used.")
+    parser.add_argument("--retries", default=CLONE_RETRIES, type=int,
+                        help="How many times to retry clone after transient failure.")
+    parser.add_argument("--backoff", default=CLONE_BACKOFF, type=float,
+                        help="Base delay before retry of clone in seconds - it's doubled with "
+                             "each attempt and randomized.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help=f"Clone only repositories which failed in previous runs (according "
+                             f"to {CLONE_OUTCOMES_NAME} in output directory).")
+    parser.add_argument("--disk-budget", default=DISK_BUDGET, type=int,
+                        help="Total size of clones and shared object stores in bytes - the least "
+                             "recently cloned or analysed clones are evicted over it and cloned "
+                             "again by the next download. If <= 0 - no limit.")
     parser.add_argument("-f", "--force", action="store_true",
                         help="Force to clone repository.")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Fetch new commits into already cloned repositories instead of "
+                             "skipping them. Corrupted clones are cloned again.")
+    parser.add_argument("--api-url", default=GITHUB_API_URL, help="Root of GitHub API.")
+    parser.add_argument("--listing-threads", default=LISTING_THREADS, type=int,
+                        help="Number of concurrent requests to list repositories.")
+    parser.add_argument("--listing-timeout", default=LISTING_TIMEOUT, type=float,
+                        help="Seconds to wait for connection and for each read of GitHub API "
+                             "response. Timed out requests are retried.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Share objects of forks and repositories with common root commit "
+                             "through git alternates.")
+    add_metrics_args(parser)
     parser.add_argument("--csv-name", default=CSV_NAME, help="Name of csv to store statistics.")
     parser.add_argument("--url-field-name", default=URL_FIELD_NAME,
                         help="Name of URL field in CSV (GitHub URL).")
@@ -0,0 +1,56 @@
+"""Export of statistics to columnar store (see `org_analysis.columnar`)."""
+import argparse
+import logging as log
+import os
+from typing import List
+
+from org_analysis.defaults import COLUMNAR_DIR, RESULTS_LOG_NAME
+from org_analysis.manifest import ResultsLog
+from org_analysis.utils import filter_kwargs
+
+
+def export_handler(output: str, statistics: List[str] = None, store: str = None,
+                   force: bool = False) -> str:
+    """
+    Export statistics of repositories analysed by `hercules` command to columnar store.
+
+    :param output: output directory of `hercules` command.
+    :param statistics: locations of statistics to export. If None - statistics of repositories
+                       from `RESULTS_LOG_NAME` in output directory.
+    :param store: directory of the store. If None - `COLUMNAR_DIR` in output directory.
+    :param force: export even if statistics didn't change since the previous export.
+    :return: directory of the store.
+    """
+    from org_analysis.columnar import export_statistics
+
+    if not statistics:
+        results_log = os.path.join(output, RESULTS_LOG_NAME)
+        if not os.path.isfile(results_log):
+            raise ValueError(f"{results_log} doesn't exist - pass statistics explicitly")
+        statistics = [record["stat_loc"] for record in ResultsLog(results_log)
+                      if record.get("stat_loc")]
+    return export_statistics(statistics, store or os.path.join(output, COLUMNAR_DIR), force=force)
+
+
+def add_export_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output directory of hercules command.")
+    parser.add_argument("--statistics", nargs="+", default=None,
+                        help="Statistics to export (merged statistics may be exported too). "
+                             f"Statistics of repositories from {RESULTS_LOG_NAME} in output "
+                             f"directory by default.")
+    parser.add_argument("--store", default=None,
+                        help=f"Directory of columnar store. {COLUMNAR_DIR} in output directory "
+                             f"by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Export even if statistics didn't change since the previous export.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", default="INFO", choices=log._nameToLevel,
+                        help="Logging verbosity.")
+    add_export_args(parser)
+    args = parser.parse_args()
+    log.getLogger().setLevel(args.log_level)
+    export_handler(**filter_kwargs(vars(args), export_handler))
@@ -6,49 +6,70 @@ from multiprocessing import Pool
 import os
 import logging as log
 import subprocess
-import sys
 import tempfile
 from time import time
-from typing import NamedTuple, Sequence, Tuple
+from typing import Any, Dict, Iterator, List, NamedTuple, Sequence, Tuple
 
-import pandas as pd
 import tqdm
 
+from org_analysis import metrics
+from org_analysis.admission import admit_jobs, expected_memory, memory_per_byte
+from org_analysis.analyses import PROFILES, split_call_with_rusage, split_commands
+from org_analysis.cache import hercules_version, invalidate, is_cached, statistics_key, \
+    store_key
+from org_analysis.clone_store import lease_clone, touch_clones
 from org_analysis.defaults import AGGREGATED_STATISTICS_NAME, DIRECTORY_FIELD_NAME, HERCULES_EXEC,\
-    N_CORES, SIZE_LIMIT, URL_FIELD_NAME
-from org_analysis.utils import filter_kwargs
-from hercules import labours
-
-sys.path.append("hercules")
-
-ReportStat = NamedTuple("ReportStat",
-                        (("repo_size", int),
-                         ("duration", int),
-                         ("err", str),
-                         ("repository", str)))
-
-
-def dir_size(loc: str) -> int:
+    HISTORY_NAME, MANIFEST_WINDOW, MEMORY_BUDGET, MERGE_BATCH_SIZE, MERGE_CORES, MERGE_ENGINE, \
+    MERGE_WORK_SUFFIX, N_CORES, PROFILE, RESULTS_LOG_NAME, SHARDS, SIZE_LIMIT, TIMEOUT, \
+    URL_FIELD_NAME
+from org_analysis.history import RunHistory
+from org_analysis.manifest import read_manifest, ResultsLog, windows
+from org_analysis.merge_journal import chunks, MergeJournal, node_id
+from org_analysis.pb_header import read_header
+from org_analysis.scheduling import longest_first, seconds_per_byte
+from org_analysis.sharding import sharded_processes, sharded_statistics
+from org_analysis.triage import iter_triage, packed_size, RepoInfo, skip_reason, \
+    triage_repository
+from org_analysis.utils import add_metrics_args, check_call_with_rusage, filter_kwargs
+
+MERGE_ENGINES = ("hercules", "python")
+
+
+class ReportStat(NamedTuple):
+    repo_size: int
+    duration: int
+    err: str
+    repository: str
+    analysed: bool = False  # hercules was run (statistics weren't taken from cache)
+    peak_rss: int = 0  # max resident set size of hercules process in bytes
+    first_parent: bool = False  # statistics were calculated with `--first-parent`
+    timed_out: bool = False  # hercules was killed because of timeout
+    key: str = ""  # cache key of statistics
+
+
+def validated_report(stat_loc: str, stat: ReportStat) -> (ReportStat, str):
     """
-    Measure size of directory.
+    Validate calculated statistics and prepare result of `repository_statistics`.
 
-    :param loc: location of directory.
-    :return: size in bytes.
+    :param stat_loc: location of statistics.
+    :param stat: report about repository.
+    :return: (ReportStat, path). Path is None if statistics can't be merged.
     """
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(loc):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            try:
-                total_size += os.path.getsize(fp)
-            except:
-                pass
-    return total_size
+    with metrics.measure("validation", repository=stat.repository, children=False) as fields:
+        err = statistics_error(stat_loc)
+        fields["exit_status"] = int(bool(err))
+    if err:
+        log.warning(err)
+        return stat._replace(err=err), None
+    return stat, stat_loc
 
 
 def repository_statistics(repo_url: str, repo_loc: str, output_dir: str,
                           hercules_exec: str = HERCULES_EXEC, size_limit: int = SIZE_LIMIT,
-                          force: bool = True) -> (ReportStat, str):
+                          force: bool = True, repo_size: int = None, timeout: float = TIMEOUT,
+                          first_parent: bool = False, timed_out_key: str = "",
+                          shards: int = SHARDS, profile: str = PROFILE,
+                          split_analyses: bool = False) -> (ReportStat, str):
     """
     Calculate statistics for given repository and save results.
 
@@ -56,14 +77,32 @@ def repository_statistics(repo_url: str, repo_loc: str, output_dir: str,
     :param repo_loc: directory with repository.
     :param output_dir: where to create directories for repo and save "statistics.pb".
     :param hercules_exec: location of hercules executable.
-    :param size_limit: size limit - skip repository if it's bigger than size_limit.
-    :param force: Force overwriting of existing statistic.
+    :param size_limit: size limit - skip repository if it's bigger than size_limit. If <= 0 - no
+                       filtering will be applied.
+    :param force: Force overwriting of existing statistic. If not force - statistic is recalculated
+                  only if refs of repository, hercules flags or hercules version changed.
+    :param repo_size: size of repository in bytes if it's known already (from triage step).
+    :param timeout: max duration of each hercules run in seconds. If <= 0 - no limit.
+    :param first_parent: start with `--first-parent` because full history is known to fail.
+    :param timed_out_key: cache key of repository state for which hercules timed out before. If
+                          it's the same as current key (and not force) - repository is skipped.
+    :param shards: repository over `size_limit` is analysed by this number of parallel hercules
+                   runs over segments of its first-parent history (see `org_analysis.sharding`).
+                   If <= 0 - it's skipped.
+    :param profile: name of analysis profile - set of hercules analyses (see `PROFILES`).
+    :param split_analyses: run independent analyses of the profile as concurrent hercules
+                           processes and splice their statistics.
     :return: (ReportStat, path).
              ReportStat contains statistics about repository:
                 size - size of git in bytes (0 in case if caching step failed)
                 duration of processing - in seconds
                 repository name
                 error logs in case of error or None
+                if hercules was run
+                peak memory of hercules in bytes
+                if `--first-parent` was used
+                if hercules timed out
+                cache key of statistics
             path to file with statistics.
     """
     start = time()
@@ -74,135 +113,272 @@ def repository_statistics(repo_url: str, repo_loc: str, output_dir: str,
 
     result_dir = os.path.join(output_dir, *repo_url.split("/")[-2:])
     stat_loc = os.path.join(result_dir, f"statistics.pb")
-    repo_size = dir_size(repo_loc)
-    if os.path.isfile(stat_loc) and not force:
-        log.info(f"{repo_loc}: statistics were calculated already and not required to "
-                 f"recalculate - skipping next steps.")
-        return (ReportStat(repo_size=repo_size, duration=time() - start, repository=repo_loc,
-                           err=""),
-                stat_loc)
-
-    if repo_size > size_limit > 0:
-        err = f"Repository {repo_loc} is too big: {repo_size} bytes > {size_limit} - skipping"
-        log.error(err)
-        return (ReportStat(repo_size=repo_size, duration=time() - start, repository=repo_loc,
-                           err=err),
-                None)
-
-    os.makedirs(result_dir, exist_ok=True)  # create subdirectories for org/name if needed
+    if repo_size is None:
+        repo_size = packed_size(repo_loc)
 
-    # calculate statistics
     cmd = [hercules_exec]
     # use protobuf to merge results for several repositories
     cmd.append(f"--pb")
-    # burndown. TODO: check if it's needed
-    cmd.extend("--burndown --burndown-people".split())
-    # devs analysis
-    cmd.append("--devs")
-    # couples analysis - for developer-file matching
-    cmd.append("--couples")
+    # analyses of the selected profile (couples are used for developer-file matching)
+    cmd.extend(PROFILES[profile])
     # for stability
     cmd.append("--hibernation-distance=1000")
     # exclude vendors
     cmd.append("--skip-blacklist")
+    # history of repository over size limit is split between parallel runs
+    sharded = repo_size > size_limit > 0 and shards > 0
+    # statistics are reused while refs, flags and hercules version stay the same
+    key = statistics_key(repo_loc, cmd[1:] + (["--first-parent"] if sharded else []),
+                         hercules_version(hercules_exec))
     # cache to analyse
     cmd.append(repo_loc)
-    try:
-        with open(stat_loc, "wb") as f:
-            # write results to file
-            subprocess.run(cmd, check=True, stdout=f)
-    except subprocess.CalledProcessError as e:
-        err = f"Repository {repo_loc} failed with exception {e} at step of calculating statistics"
+    report = ReportStat(repo_size=repo_size, duration=0, repository=repo_loc, err="", key=key)
+    if not force and is_cached(stat_loc, key):
+        log.info(f"{repo_loc}: statistics were calculated already for the same state of "
+                 f"repository - skipping next steps.")
+        return validated_report(stat_loc, report._replace(duration=time() - start))
+
+    if repo_size > size_limit > 0 and not sharded:
+        err = f"Repository {repo_loc} is too big: {repo_size} bytes > {size_limit} - skipping"
+        log.error(err)
+        return report._replace(duration=time() - start, err=err), None
+
+    if not force and key and key == timed_out_key:
+        err = f"Repository {repo_loc} timed out before and wasn't changed since then - skipping"
         log.error(err)
-        log.error("Fall back to more stable option")
-        # for stability
-        cmd.append("--first-parent")
+        return report._replace(duration=time() - start, err=err, timed_out=True), None
+
+    os.makedirs(result_dir, exist_ok=True)  # create subdirectories for org/name if needed
+
+    invalidate(stat_loc)
+    if sharded:
+        return sharded_repository_statistics(cmd[:-1], repo_loc, stat_loc, shards, timeout,
+                                             report, start)
+
+    # calculate statistics, `--first-parent` is more stable option to fall back to
+    attempts = [cmd + ["--first-parent"]]
+    if not first_parent:
+        attempts.insert(0, cmd)
+    peak_rss = 0
+    for i, attempt in enumerate(attempts):
+        stage = "hercules_fallback" if i else "hercules"
+        attempt_start = time()
         try:
-            with open(stat_loc, "wb") as f:
-                # write results to file
-                subprocess.run(cmd, check=True, stdout=f)
-        except subprocess.CalledProcessError as e:
+            if split_analyses:
+                rusage = split_call_with_rusage(split_commands(attempt), stat_loc,
+                                                timeout=timeout)
+            else:
+                with open(stat_loc, "wb") as f:
+                    # write results to file
+                    rusage = check_call_with_rusage(attempt, stdout=f, timeout=timeout)
+            peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+            metrics.emit(stage, repository=repo_loc, wall_time=time() - attempt_start,
+                         rusage=rusage, first_parent=attempt is attempts[-1])
+            break
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            metrics.emit(stage, repository=repo_loc, wall_time=time() - attempt_start,
+                         rusage=e.rusage, exit_status=getattr(e, "returncode", -9),
+                         first_parent=attempt is attempts[-1],
+                         timed_out=isinstance(e, subprocess.TimeoutExpired))
             err = f"Repository {repo_loc} failed with exception {e} at step of calculating " \
                   f"statistics"
             log.error(err)
-            return (ReportStat(repo_size=repo_size, duration=time() - start,
-                               repository=repo_loc, err=err),
-                    None)
-    return (ReportStat(repo_size=repo_size, duration=time() - start,
-                       repository=repo_loc, err=""),
-            stat_loc)
-
-
-def slice_max_n(size: int, n_elem: int):
+            if i + 1 < len(attempts):
+                log.error("Fall back to more stable option")
+                continue
+            return report._replace(duration=time() - start, err=err, analysed=True,
+                                   peak_rss=peak_rss, first_parent=True,
+                                   timed_out=isinstance(e, subprocess.TimeoutExpired)), None
+    store_key(stat_loc, key)
+    return validated_report(stat_loc, report._replace(duration=time() - start, analysed=True,
+                                                      peak_rss=peak_rss,
+                                                      first_parent=attempt is attempts[-1]))
+
+
+def sharded_repository_statistics(cmd: List[str], repo_loc: str, stat_loc: str, shards: int,
+                                  timeout: float, report: ReportStat, start: float
+                                  ) -> (ReportStat, str):
     """
-    Yield start and end indices to preserve max size equal to `n_elem`.
+    Calculate statistics of repository over size limit with parallel hercules runs.
 
-    :param size: number of element in sequence.
-    :param n_elem: Number of elements to yield.
-    :return: generator.
+    :param cmd: hercules command without repository location.
+    :param repo_loc: directory with repository.
+    :param stat_loc: where to store statistics.
+    :param shards: max number of segments of history.
+    :param timeout: max duration of each hercules run in seconds. If <= 0 - no limit.
+    :param report: report about repository to complete.
+    :param start: start time of processing of repository.
+    :return: (ReportStat, path) like `repository_statistics`.
     """
-    for start, end in zip(range(0, size, n_elem), range(n_elem, size + n_elem, n_elem)):
-        yield start, end
+    from org_analysis.pb_merge import UnsupportedStatistics
+
+    attempt_start = time()
+    try:
+        peak_rss = sharded_statistics(cmd, repo_loc, stat_loc, shards, timeout=timeout)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+            UnsupportedStatistics) as e:
+        timed_out = isinstance(e, subprocess.TimeoutExpired)
+        metrics.emit("hercules_sharded", repository=repo_loc, wall_time=time() - attempt_start,
+                     exit_status=getattr(e, "returncode", -9 if timed_out else 1),
+                     segments=shards, timed_out=timed_out)
+        err = f"Repository {repo_loc} failed with exception {e} at step of calculating sharded " \
+              f"statistics"
+        log.error(err)
+        return report._replace(duration=time() - start, err=err, analysed=True,
+                               first_parent=True, timed_out=timed_out), None
+    metrics.emit("hercules_sharded", repository=repo_loc, wall_time=time() - attempt_start,
+                 segments=shards)
+    store_key(stat_loc, report.key)
+    return validated_report(stat_loc, report._replace(duration=time() - start, analysed=True,
+                                                      peak_rss=peak_rss, first_parent=True))
 
 
 def starts_with_zero_timestamp(stat_loc):
-    """Check if statistics starts at 1970-01-01"""
-    reader = labours.ProtobufReader()
-    reader.read(stat_loc)
-    start, _ = reader.get_header()
+    """Check if statistics starts at 1970-01-01 (only header of statistics is read)."""
+    start = read_header(stat_loc).begin_unix_time
     return datetime.utcfromtimestamp(start).strftime("%Y-%m-%d") == "1970-01-01"
 
 
+def statistics_error(stat_loc: str) -> str:
+    """
+    Check if statistics can be merged with others.
+
+    :param stat_loc: location of statistics.
+    :return: error or empty string if statistics are valid.
+    """
+    try:
+        if starts_with_zero_timestamp(stat_loc):
+            return f"Bad date at repository {stat_loc}."
+    except (OSError, ValueError) as e:
+        return f"Broken statistics {stat_loc}: {e}"
+    return ""
+
+
+def filter_valid_statistics(locations: Sequence[str]) -> List[str]:
+    """
+    Filter out statistics which start at 1970-01-01.
+
+    :param locations: locations of statistics.
+    :return: locations of valid statistics.
+    """
+    filtered_locations = []
+    for loc in locations:
+        err = statistics_error(loc)
+        if not err:
+            filtered_locations.append(loc)
+        else:
+            log.warning(err)
+    return filtered_locations
+
+
 def merge_statistics(filenames: Sequence[Tuple[ReportStat, str]], output_filepath: str,
-                     hercules_exec: str = HERCULES_EXEC, n_samples: int = 0) -> str:
+                     hercules_exec: str = HERCULES_EXEC, n_samples: int = 0,
+                     n_cores: int = N_CORES, validate: bool = True,
+                     engine: str = MERGE_ENGINE, work_dir: str = None,
+                     timeout: float = None) -> str:
     """
     Merge statistics for multiple repositories together.
 
     :param filenames: list of results from repository_statistics for each repository.
     :param output_filepath: path to store results.
     :param hercules_exec: location of hercules executable.
-    :param n_samples: number of samples in one.
+    :param n_samples: number of samples in one merge (fan-in of reduction tree).
+    :param n_cores: how many merges of one level of reduction tree to run concurrently. If <= 0 -
+                    all cores will be used.
+    :param validate: skip statistics which start at 1970-01-01.
+    :param engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+    :param work_dir: durable directory with intermediates of hierarchical merge and their journal
+                     (see `org_analysis.merge_journal`). If None - `output_filepath` with
+                     `MERGE_WORK_SUFFIX`.
+    :param timeout: max duration of each `hercules combine` in seconds. If None or <= 0 - no
+                    limit.
     :return: location aggregated statistics or None in case of error.
     """
     # filter out failed repositories
     locations = [loc for _, loc in filenames if loc]
-
-    filtered_locations = []
-    for loc in locations:
-        if not starts_with_zero_timestamp(loc):
-            filtered_locations.append(loc)
-        else:
-            log.warning(f"Bad date at repository {loc}.")
     # merge statistics
-    file_stack = filtered_locations
-    if n_samples > 0:
-        # hierarchical processing
-        file_cnter = 0  # used to write temporal files
-        new_stack = []
-        with tempfile.TemporaryDirectory(prefix="hercules_merge_") as tmp_dir:
-            while len(file_stack) > n_samples:
-                for start, end in slice_max_n(len(file_stack), n_samples):
-                    new_tmp_loc = os.path.join(tmp_dir, f"{file_cnter}.pb")
-                    new_stack.append(merge_statistics_(filenames=file_stack[start:end],
-                                                       output_filename=new_tmp_loc,
-                                                       hercules_exec=hercules_exec,
-                                                       output_dir=tmp_dir))
-                    file_cnter += 1
-                    log.info(f"Number of merges: {file_cnter}")
-                file_stack = [loc for loc in new_stack if loc and os.path.getsize(loc) > 0]
-                new_stack = []
-
-            return merge_statistics_(filenames=file_stack,
-                                     output_filename=output_filepath,
-                                     hercules_exec=hercules_exec)
+    file_stack = filter_valid_statistics(locations) if validate else locations
+    if engine == "python":
+        # NumPy and SciPy are imported only when in-process merge is used
+        from org_analysis import pb_merge
+        try:
+            return pb_merge.combine(file_stack, output_filepath,
+                                    batch_size=n_samples if n_samples > 0 else MERGE_BATCH_SIZE,
+                                    n_cores=n_cores if n_cores > 0 else
+                                    multiprocessing.cpu_count())
+        except pb_merge.UnsupportedStatistics as e:
+            log.error(f"{e} - falling back to hercules combine")
+    if n_samples > 0 and len(file_stack) > n_samples:
+        return checkpointed_merge(file_stack, output_filepath,
+                                  work_dir or output_filepath + MERGE_WORK_SUFFIX,
+                                  hercules_exec=hercules_exec, n_samples=n_samples,
+                                  n_cores=n_cores, timeout=timeout)
     return merge_statistics_(filenames=file_stack,
                              output_filename=output_filepath,
-                             hercules_exec=hercules_exec)
+                             hercules_exec=hercules_exec, timeout=timeout)
+
+
+def checkpointed_merge(locations: Sequence[str], output_filepath: str, work_dir: str,
+                       hercules_exec: str = HERCULES_EXEC, n_samples: int = MERGE_BATCH_SIZE,
+                       n_cores: int = N_CORES, timeout: float = None) -> str:
+    """
+    Hierarchical merge with intermediates journaled in durable work directory - merges done by
+    previous (crashed or complete) runs with the same inputs are reused.
+
+    :param locations: locations of valid statistics.
+    :param output_filepath: path to store results.
+    :param work_dir: directory with intermediates and journal.
+    :param hercules_exec: location of hercules executable.
+    :param n_samples: max number of samples in one merge. Batches are cut by content, so fan-in of
+                      reduction tree is about half of it on average.
+    :param n_cores: how many merges of one level of reduction tree to run concurrently. If <= 0 -
+                    all cores will be used.
+    :param timeout: max duration of each `hercules combine` in seconds. If None or <= 0 - no
+                    limit.
+    :return: location aggregated statistics or None in case of error.
+    """
+    n_samples = max(n_samples, 2)  # otherwise number of files never decreases
+    n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
+    version = hercules_version(hercules_exec)
+    # key of input is location of the first repository under it - it keeps boundaries of batches
+    items = sorted((os.path.abspath(loc), os.path.abspath(loc)) for loc in locations)
+    level = 0
+    with MergeJournal(work_dir) as journal, \
+            Pool(n_cores, initializer=metrics.configure, initargs=metrics.initargs()) as p:
+        while len(items) > n_samples:
+            # batches of one level are independent and merged concurrently
+            next_items, todo, n_reused = [], [], 0
+            for batch in chunks(items, n_samples, level):
+                if len(batch) == 1:
+                    next_items.append(batch[0])
+                    continue
+                inputs = [loc for _, loc in batch]
+                node = node_id([journal.digest(loc) for loc in inputs], version)
+                next_items.append((batch[0][0], journal.lookup(node)))
+                if next_items[-1][1] is None:
+                    todo.append((len(next_items) - 1, node, inputs))
+                else:
+                    n_reused += 1
+            arguments = [{"filenames": inputs, "output_filename": journal.location(node),
+                          "hercules_exec": hercules_exec, "level": level, "timeout": timeout}
+                         for _, node, inputs in todo]
+            for (i, node, inputs), loc in zip(todo, p.imap(merge_statistics_multiprocessing,
+                                                           arguments)):
+                if loc and os.path.getsize(loc) > 0:
+                    journal.record(node, inputs)
+                    next_items[i] = (next_items[i][0], loc)
+            items = [(key, loc) for key, loc in next_items if loc]
+            level += 1
+            log.info(f"Level {level} of merging: {len(todo)} merges, {n_reused} reused")
+        return merge_statistics_(filenames=[loc for _, loc in items],
+                                 output_filename=output_filepath,
+                                 hercules_exec=hercules_exec, level=level, timeout=timeout)
 
 
 def merge_statistics_(filenames: Sequence[Tuple[ReportStat, str]],
                       output_filename: str = AGGREGATED_STATISTICS_NAME,
-                      hercules_exec: str = HERCULES_EXEC, output_dir: str = None) -> str:
+                      hercules_exec: str = HERCULES_EXEC, output_dir: str = None,
+                      level: int = 0, timeout: float = None) -> str:
     """
     Merge statistics for multiple repositories together.
 
@@ -210,6 +386,9 @@ def merge_statistics_(filenames: Sequence[Tuple[ReportStat, str]],
     :param output_dir: directory to store results. File will be `output_dir/filename`.
     :param output_filename: name (not path) of the file with extension to store results.
     :param hercules_exec: location of hercules executable.
+    :param level: level of hierarchical merge (for metrics).
+    :param timeout: max duration of `hercules combine` in seconds - it's killed after it. If None
+                    or <= 0 - no limit.
     :return: location aggregated statistics or None in case of error.
     """
     if output_dir:
@@ -220,16 +399,272 @@ def merge_statistics_(filenames: Sequence[Tuple[ReportStat, str]],
 
     cmd = [hercules_exec, "combine"]
     cmd.extend(locations)
+    start = time()
     try:
         with open(stat_loc, "wb") as f:
-            subprocess.run(cmd, check=True, stdout=f)
-    except subprocess.CalledProcessError as e:
+            rusage = check_call_with_rusage(cmd, stdout=f, timeout=timeout)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        metrics.emit("merge", repository=stat_loc, wall_time=time() - start, rusage=e.rusage,
+                     exit_status=getattr(e, "returncode", -9), level=level,
+                     inputs=len(locations), timed_out=isinstance(e, subprocess.TimeoutExpired))
         err = f"Aggregating of statistics failed with exception {e}"
         log.error(err)
         return None
+    metrics.emit("merge", repository=stat_loc, wall_time=time() - start, rusage=rusage,
+                 level=level, inputs=len(locations))
     return stat_loc
 
 
+def merge_statistics_multiprocessing(kwargs) -> str:
+    """
+    Wrapper to call `merge_statistics_` from `multiprocessing.Pool`.
+
+    :param kwargs: dictionary of arguments for `merge_statistics_`.
+    :return: result from `merge_statistics_`.
+    """
+    if len(kwargs["filenames"]) == 1:
+        # nothing to combine
+        return kwargs["filenames"][0]
+    return merge_statistics_(**kwargs)
+
+
+def merge_statistics_in_process(filenames: Sequence[str]):
+    """
+    Wrapper to call `pb_merge.read_serialized` from `multiprocessing.Pool`.
+
+    :param filenames: locations of statistics.
+    :return: serialized partial aggregate or the same filenames if they can't be merged
+             in-process.
+    """
+    from org_analysis import pb_merge
+    try:
+        return pb_merge.read_serialized(filenames)
+    except pb_merge.UnsupportedStatistics as e:
+        log.error(f"{e} - falling back to hercules combine")
+        return list(filenames)
+
+
+class StreamingMerger:
+    """
+    Merge statistics into partial aggregates in batches as soon as they arrive.
+
+    Merges run on their own pool, so they overlap with analysis of the remaining repositories.
+    Partial aggregates are merged again once there are `batch_size` of them, so only a small
+    final combine is left after the last repository is processed.
+
+    With "python" engine batches are merged by workers into partial aggregates which are sent back
+    serialized and merged into in-memory aggregate of the main process - it's serialized once. It
+    falls back to "hercules" engine if statistics contain analysis that can't be merged
+    in-process.
+
+    With work directory merges of "hercules" engine are journaled like in `checkpointed_merge`:
+    once all inputs of a merge journaled by the previous run arrive again unchanged, its
+    intermediate is reused instead of merging them. Inputs of journaled merges are held until the
+    rest of them arrive (or the end), since batches depend on the order of arrival.
+
+    Statistics of repositories under a merge which failed are dropped - they are listed in
+    `dropped`.
+    """
+
+    def __init__(self, hercules_exec: str = HERCULES_EXEC, batch_size: int = MERGE_BATCH_SIZE,
+                 n_cores: int = MERGE_CORES, engine: str = MERGE_ENGINE, work_dir: str = None,
+                 timeout: float = None):
+        """
+        :param hercules_exec: location of hercules executable.
+        :param batch_size: number of statistics to combine together.
+        :param n_cores: number of concurrent merges.
+        :param engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+        :param work_dir: durable directory with journaled intermediates. If None - intermediates
+                         are temporary.
+        :param timeout: max duration of each `hercules combine` in seconds. If None or <= 0 - no
+                        limit.
+        """
+        self.hercules_exec = hercules_exec
+        self.engine = engine
+        self.batch_size = max(batch_size, 2)
+        self.n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
+        self.work_dir = work_dir
+        self.timeout = timeout
+        # level 0 contains statistics of repositories, level N - merges of level N - 1
+        self._levels = {}
+        self._in_flight = []
+        self._counter = 0
+        self._aggregate = None
+        self._pool = None
+        self._tmp_dir = None
+        self._journal = None
+        self._version = None
+        self._journaled = {}  # input -> journaled merge of previous runs
+        self._waiting = {}  # journaled merge -> {arrived input: level}
+        self._sources = {}  # intermediate -> statistics of repositories under it
+        self.dropped = []  # statistics of repositories which are lost because their merge failed
+
+    def __enter__(self) -> "StreamingMerger":
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="hercules_merge_")
+        if self.work_dir is not None:
+            self._version = hercules_version(self.hercules_exec)
+            self._journal = MergeJournal(self.work_dir).__enter__()
+            for node, entry in self._journal.merges.items():
+                for loc in entry["inputs"]:
+                    self._journaled[loc] = node
+        self._pool = Pool(self.n_cores, initializer=metrics.configure,
+                          initargs=metrics.initargs())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._pool.terminate()
+        self._pool.join()
+        if self._journal is not None:
+            # unused intermediates are deleted only after success
+            self._journal.__exit__(exc_type, exc_val, exc_tb)
+        self._tmp_dir.cleanup()
+
+    def add(self, stat_loc: str) -> None:
+        """
+        Add statistics of repository. It's merged in background once the batch is full.
+
+        :param stat_loc: location of validated statistics.
+        """
+        self._add(stat_loc, level=0)
+        self._collect()
+
+    def _add(self, stat_loc: str, level: int) -> None:
+        if self._journal is not None and self.engine == "hercules":
+            stat_loc = os.path.abspath(stat_loc)
+            node = self._journaled.get(stat_loc)
+            if node is not None:
+                waiting = self._waiting.setdefault(node, {})
+                waiting[stat_loc] = level
+                if len(waiting) == len(self._journal.merges[node]["inputs"]):
+                    self._reuse(node)
+                return
+        self._batch(stat_loc, level)
+
+    def _batch(self, stat_loc: str, level: int) -> None:
+        batch = self._levels.setdefault(level, [])
+        batch.append(stat_loc)
+        if len(batch) >= self.batch_size:
+            self._submit(self._levels.pop(level), level)
+
+    def _reuse(self, node: str) -> None:
+        waiting = self._waiting.pop(node)
+        inputs = self._journal.merges[node]["inputs"]
+        level = max(waiting.values())
+        loc = None
+        if node_id([self._journal.digest(i) for i in inputs], self._version) == node:
+            loc = self._journal.lookup(node)
+        if loc is None:
+            for stat_loc, stat_level in waiting.items():
+                self._batch(stat_loc, stat_level)
+        else:
+            self._sources[loc] = self._sources_of(inputs)
+            self._add(loc, level + 1)
+
+    def _sources_of(self, batch: List[str]) -> List[str]:
+        return [source for loc in batch for source in self._sources.pop(loc, [loc])]
+
+    def _drop(self, batch: List[str]) -> None:
+        sources = self._sources_of(batch)
+        log.error(f"Statistics of {len(sources)} repositories are dropped because their merge "
+                  f"failed: {', '.join(sources)}")
+        self.dropped.extend(sources)
+
+    def _submit(self, batch: List[str], level: int) -> None:
+        if self.engine == "python":
+            self._in_flight.append((level + 1, self._pool.apply_async(merge_statistics_in_process,
+                                                                      (batch,)), None, batch))
+            return
+        kwargs = {"filenames": batch, "output_filename": f"{level}_{self._counter}.pb",
+                  "hercules_exec": self.hercules_exec, "output_dir": self._tmp_dir.name,
+                  "level": level, "timeout": self.timeout}
+        self._counter += 1
+        node = None
+        if self._journal is not None:
+            node = node_id([self._journal.digest(loc) for loc in batch], self._version)
+            loc = self._journal.lookup(node)
+            if loc is not None:
+                self._sources[loc] = self._sources_of(batch)
+                self._add(loc, level + 1)
+                return
+            kwargs["output_filename"], kwargs["output_dir"] = self._journal.location(node), None
+        self._in_flight.append((level + 1, self._pool.apply_async(merge_statistics_multiprocessing,
+                                                                  (kwargs,)), node, batch))
+
+    def _collect(self, wait: bool = False) -> None:
+        in_flight = []
+        for level, res, node, batch in self._in_flight:
+            if not wait and not res.ready():
+                in_flight.append((level, res, node, batch))
+                continue
+            loc = res.get()
+            if isinstance(loc, list):
+                self._fall_back(loc)
+            elif isinstance(loc, str) and os.path.getsize(loc) > 0:
+                if node is not None:
+                    self._journal.record(node, batch)
+                if loc not in batch:
+                    self._sources[loc] = self._sources_of(batch)
+                self._add(loc, level)
+            elif isinstance(loc, bytes):
+                # serialized partial aggregate
+                from org_analysis import pb_merge
+                if self._aggregate is None:
+                    self._aggregate = pb_merge.Aggregate()
+                self._aggregate.add_serialized(loc)
+            else:
+                self._drop(batch)
+        self._in_flight = in_flight
+
+    def _fall_back(self, batch: List[str]) -> None:
+        self.engine = "hercules"
+        for loc in batch:
+            self._add(loc, level=0)
+
+    def finish(self, output_filepath: str) -> str:
+        """
+        Wait for background merges and combine what is left into final statistics.
+
+        :param output_filepath: path to store results.
+        :return: location aggregated statistics or None in case of error.
+        """
+        while self._in_flight:
+            self._collect(wait=True)
+        if self.engine == "python" or self._aggregate is not None:
+            from org_analysis import pb_merge
+        if self.engine == "python":
+            batch = self._levels.pop(0, [])
+            try:
+                aggregate = pb_merge.read_statistics(batch)
+            except pb_merge.UnsupportedStatistics as e:
+                log.error(f"{e} - falling back to hercules combine")
+                self._fall_back(batch)
+            else:
+                if self._aggregate is not None:
+                    aggregate.update(self._aggregate)
+                return pb_merge.write_statistics(aggregate, output_filepath)
+        if self._aggregate is not None:
+            # statistics merged in-process before the fallback
+            self._add(pb_merge.write_statistics(
+                self._aggregate, os.path.join(self._tmp_dir.name, "in_process.pb")), level=1)
+            self._aggregate = None
+        while self._in_flight or self._waiting:
+            # the rest of inputs of journaled merges didn't arrive - merge them anew
+            for waiting in self._waiting.values():
+                for stat_loc, level in waiting.items():
+                    self._batch(stat_loc, level)
+            self._waiting = {}
+            self._collect(wait=True)
+        locations = [loc for level in sorted(self._levels) for loc in self._levels[level]]
+        final_level = max(self._levels, default=0) + 1
+        self._levels = {}
+        stat_loc = merge_statistics_(filenames=locations, output_filename=output_filepath,
+                                     hercules_exec=self.hercules_exec, level=final_level,
+                                     timeout=self.timeout)
+        if stat_loc is None:
+            self._drop(locations)
+        return stat_loc
+
+
 def repository_statistics_multiprocessing(kwargs) -> (ReportStat, str):
     """
     Wrapper to call `repository_statistics` from `multiprocessing.Pool`.
@@ -237,61 +672,288 @@ def repository_statistics_multiprocessing(kwargs) -> (ReportStat, str):
     :param kwargs: dictionary of arguments for `repository_statistics`.
     :return: result from `repository_statistics`.
     """
-    return repository_statistics(**kwargs)
+    with lease_clone(kwargs["repo_loc"]):
+        return repository_statistics(**kwargs)
+
+
+def triaged_statistics_multiprocessing(kwargs) -> (ReportStat, str):
+    """
+    Triage repository and calculate its statistics (called from `multiprocessing.Pool` when
+    repositories arrive one by one and there is no separate triage step).
+
+    :param kwargs: dictionary of arguments for `repository_statistics` (without `repo_size`).
+    :return: result from `repository_statistics`.
+    """
+    with lease_clone(kwargs["repo_loc"]):
+        info = triage_repository(kwargs["repo_loc"])
+        reason = skip_reason(info)
+        if reason:
+            log.warning(reason)
+            return ReportStat(repo_size=info.size, duration=0, repository=info.repository,
+                              err=reason), None
+        return repository_statistics(repo_size=info.size, **kwargs)
+
+
+def known_failures(record: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """
+    Prepare arguments of `repository_statistics` to avoid attempts that failed in previous runs.
+
+    :param record: observations about repository from previous runs.
+    :param timeout: current timeout of hercules runs.
+    :return: `first_parent` and `timed_out_key` arguments.
+    """
+    timed_out_key = record.get("timed_out_key", "")
+    if timeout <= 0 or timeout > record.get("timed_out_after", 0):
+        # it may succeed with more time
+        timed_out_key = ""
+    return {"first_parent": record.get("first_parent", False), "timed_out_key": timed_out_key}
+
+
+def skipped_result(info: RepoInfo, reason: str) -> Dict[str, Any]:
+    """Record of results log about repository which was skipped by triage."""
+    log.warning(reason)
+    return {**ReportStat(repo_size=info.size, duration=0, err=reason,
+                         repository=info.repository)._asdict(), "stat_loc": None}
+
+
+def job_arguments(info: RepoInfo, repo_url: str, history: RunHistory, timeout: float,
+                  **options: Any) -> Dict[str, Any]:
+    """
+    Prepare arguments of `repository_statistics` for triaged repository.
+
+    :param info: triage of repository.
+    :param repo_url: repository URL.
+    :param history: observations from previous runs.
+    :param timeout: max duration of each hercules run in seconds.
+    :param options: the rest of arguments (the same for all repositories).
+    :return: arguments.
+    """
+    return {"repo_loc": info.repository, "repo_url": repo_url, "repo_size": info.size,
+            "timeout": timeout, **options, **known_failures(history.get(info.repository), timeout)}
+
+
+def job_processes(kwargs: Dict[str, Any]) -> int:
+    """
+    Number of concurrent hercules processes of `repository_statistics` - for `admit_jobs`.
+
+    :param kwargs: arguments of `repository_statistics`.
+    :return: max number of processes.
+    """
+    flags = PROFILES[kwargs.get("profile", PROFILE)]
+    shards, size_limit = kwargs.get("shards", SHARDS), kwargs.get("size_limit", SIZE_LIMIT)
+    if kwargs.get("repo_size", 0) > size_limit > 0 and shards > 0:
+        return sharded_processes(flags, shards)
+    if kwargs.get("split_analyses"):
+        return len(split_commands(flags))
+    return 1
+
+
+def ordered_jobs(arguments: Sequence[Dict[str, Any]], history: RunHistory, rate: float,
+                 ratio: float) -> Iterator[Tuple[Dict[str, Any], int]]:
+    """
+    Order jobs for `admit_jobs`: the longest first, so they don't become stragglers, with
+    expected memory of each.
+
+    :param arguments: arguments of `repository_statistics`.
+    :param history: observations from previous runs.
+    :param rate: seconds per byte for repositories without observations.
+    :param ratio: bytes of memory per byte of repository for repositories without observations.
+    :return: iterator over (arguments, expected peak memory).
+    """
+    for kwargs in longest_first(arguments, history, rate):
+        yield kwargs, expected_memory(kwargs["repo_loc"], kwargs["repo_size"], history, ratio,
+                                      job_processes(kwargs))
 
 
 def hercules_handler(input_csv: str, output: str, size_limit: int, force: bool, n_cores: int,
                      hercules_exec: str, directory_field_name: str, url_field_name: str,
-                     aggregated_statistics_name: str, n_samples: int) -> None:
+                     aggregated_statistics_name: str, n_samples: int,
+                     merge_cores: int = MERGE_CORES, memory_budget: int = MEMORY_BUDGET,
+                     timeout: float = TIMEOUT, metrics_path: str = None,
+                     prometheus_textfile: str = None, merge_engine: str = MERGE_ENGINE,
+                     shards: int = SHARDS, profile: str = PROFILE,
+                     split_analyses: bool = False) -> None:
     """
     Pipeline to calculate statistics for multiple repositories & merge statistics together.
 
-    :param input_csv: path to CSV with information about repositories location.
-    :param output: output directory to store statistics.
+    :param input_csv: path to CSV with information about repositories location. It's read in
+                      windows of `MANIFEST_WINDOW` repositories.
+    :param output: output directory to store statistics. Results of repositories are written to
+                   `RESULTS_LOG_NAME` in it as they arrive.
     :param size_limit: max size of repo to process in bytes. If <= 0 no filtering will be applied.
     :param force: force overwriting of existing statistics (aggregated statistics will always be
-                  overwritten).
+                  overwritten). If not force - statistics of unchanged repositories are reused.
     :param n_cores: how many cores to use.
     :param hercules_exec: hercules executable location.
     :param directory_field_name: name of directory field in CSV (it contains path to repository).
     :param directory_field_name: name of URL field in CSV (it contains repository's URL).
     :param aggregated_statistics_name: name of file to store aggregated statistics.
-    :param n_samples: Max number of repos to combine together - it will be done in a hierarchical
-                      manner. If <= 0 - no hierarchical processing will be used.
-    """
-    # load list of repositories to process
-    repos = pd.read_csv(input_csv)
-    if directory_field_name not in repos.columns:
-        raise ValueError(f"Input CSV should have column \"{directory_field_name}\" but got "
-                         f"{repos.columns}")
-    if url_field_name not in repos.columns:
-        raise ValueError(f"Input CSV should have column \"{url_field_name}\" but got "
-                         f"{repos.columns}")
-    # prepare arguments for parallel processing
-    arguments = []
-    repositories = repos[directory_field_name].tolist()
-    urls = repos[url_field_name].tolist()
-    for repo, url in zip(repositories, urls):
-        arguments.append({"repo_loc": repo, "repo_url": url, "output_dir": output, "force": force,
-                          "hercules_exec": hercules_exec, "size_limit": size_limit})
-    # calculate statistics
+    :param n_samples: Max number of repos to combine together - statistics are merged in batches
+                      of this size while other repositories are being analysed. If <= 0 -
+                      `MERGE_BATCH_SIZE` is used.
+    :param merge_cores: how many merges to run concurrently with analysis.
+    :param memory_budget: total memory of concurrent hercules processes in bytes. Expected memory
+                          of each job is based on repository size and peak memory observed in
+                          previous runs. If <= 0 - only `n_cores` limits concurrency.
+    :param timeout: max duration of each hercules run (analysis or combine) in seconds. If <= 0 -
+                    no limit. Repositories that needed `--first-parent` before start with it,
+                    repositories that timed out with the same or bigger timeout are skipped until
+                    they change.
+    :param metrics_path: JSONL file to append metrics of each stage to. If None - no metrics.
+    :param prometheus_textfile: Prometheus textfile to write metrics of the run aggregated by
+                                stage to (requires `metrics_path`).
+    :param merge_engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+    :param shards: repositories over `size_limit` are analysed by this number of parallel hercules
+                   runs over segments of history. If <= 0 - they are skipped.
+    :param profile: name of analysis profile - set of hercules analyses (see `PROFILES`).
+    :param split_analyses: run independent analyses of the profile as concurrent hercules
+                           processes per repository and splice their statistics.
+    """
+    metrics.configure(metrics_path)
     n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
-    with Pool(n_cores) as p:
-        results = []
-        for res in tqdm.tqdm(p.imap_unordered(repository_statistics_multiprocessing,
-                                              arguments),
-                             total=len(repositories)):
-            results.append(res)
-    # merge statistics
-    log.info("Start merging of statistics...")
+    os.makedirs(output, exist_ok=True)
+    history = RunHistory(os.path.join(output, HISTORY_NAME))
+    rate, ratio = seconds_per_byte(history), memory_per_byte(history)
     result_filepath = os.path.join(output, aggregated_statistics_name)
-    final_stat = merge_statistics(filenames=results, output_filepath=result_filepath,
-                                  hercules_exec=hercules_exec, n_samples=n_samples)
+    batch_size = n_samples if n_samples > 0 else MERGE_BATCH_SIZE
+    options = {"output_dir": output, "force": force, "hercules_exec": hercules_exec,
+               "size_limit": size_limit, "shards": shards, "profile": profile,
+               "split_analyses": split_analyses}
+    # repositories are read, triaged and ordered window by window, results are spilled to disk -
+    # memory doesn't grow with the number of repositories
+    with Pool(n_cores, initializer=metrics.configure, initargs=metrics.initargs()) as triage_pool, \
+            Pool(n_cores, initializer=metrics.configure, initargs=metrics.initargs()) as p, \
+            StreamingMerger(hercules_exec=hercules_exec, batch_size=batch_size,
+                            n_cores=merge_cores, engine=merge_engine,
+                            work_dir=result_filepath + MERGE_WORK_SUFFIX,
+                            timeout=timeout) as merger, \
+            ResultsLog(os.path.join(output, RESULTS_LOG_NAME)) as results:
+
+        def jobs() -> Iterator[Tuple[Dict[str, Any], int]]:
+            manifest = read_manifest(input_csv, directory_field_name, url_field_name)
+            for window in windows(manifest, MANIFEST_WINDOW):
+                # collect cheap metadata to skip repositories that hercules can't process
+                arguments = []
+                for info, url in iter_triage(window, triage_pool):
+                    reason = skip_reason(info)
+                    if reason:
+                        results.append(skipped_result(info, reason))
+                        continue
+                    arguments.append(job_arguments(info, url, history, timeout, **options))
+                # dispatch the longest jobs of window first so they don't become stragglers,
+                # jobs are admitted only while their expected memory fits into budget
+                yield from ordered_jobs(arguments, history, rate, ratio)
+
+        # calculate statistics and merge them in batches while the rest is being analysed
+        for stat, stat_loc in tqdm.tqdm(admit_jobs(p, repository_statistics_multiprocessing,
+                                                   jobs(), budget=memory_budget,
+                                                   max_in_flight=n_cores,
+                                                   processes=job_processes)):
+            results.append({**stat._asdict(), "stat_loc": stat_loc})
+            if stat_loc:
+                merger.add(stat_loc)
+        log.info("Finish merging of statistics...")
+        final_stat = merger.finish(result_filepath)
+    used = []
+    for record in results:
+        stat = ReportStat(**{field: record[field] for field in ReportStat._fields})
+        if record.get("stat_loc"):
+            used.append(stat.repository)
+        metrics.emit("repository", repository=stat.repository, wall_time=stat.duration,
+                     exit_status=int(bool(stat.err)), repo_size=stat.repo_size, err=stat.err,
+                     analysed=stat.analysed)
+        if stat.analysed:
+            history.update(stat.repository, duration=stat.duration, repo_size=stat.repo_size,
+                           peak_rss=stat.peak_rss, first_parent=stat.first_parent,
+                           timed_out_key=stat.key if stat.timed_out else "",
+                           timed_out_after=timeout if stat.timed_out else 0)
+    history.save()
+    # clones of download output stay on disk by recency of analysis
+    touch_clones(used)
+    if metrics_path and prometheus_textfile:
+        metrics.write_prometheus(metrics_path, prometheus_textfile)
     if final_stat:
         log.info("Success!")
         log.info(f"Aggregated statistics is stored at {final_stat}")
 
 
+def merge_handler(output: str, statistics: List[str] = None,
+                  aggregated_statistics_name: str = AGGREGATED_STATISTICS_NAME,
+                  hercules_exec: str = HERCULES_EXEC, n_samples: int = -1,
+                  merge_cores: int = MERGE_CORES, timeout: float = TIMEOUT) -> str:
+    """
+    Merge statistics of repositories again with checkpointed hierarchical merge: interrupted
+    merge is resumed, after adding repositories only affected branches of the tree are merged.
+
+    :param output: output directory of `hercules` command.
+    :param statistics: locations of statistics to merge. If None - statistics of repositories
+                       from `RESULTS_LOG_NAME` in output directory.
+    :param aggregated_statistics_name: name of file to store aggregated statistics.
+    :param hercules_exec: hercules executable location.
+    :param n_samples: max number of repos to combine together. If <= 0 - `MERGE_BATCH_SIZE`.
+    :param merge_cores: how many merges to run concurrently.
+    :param timeout: max duration of each `hercules combine` in seconds. If <= 0 - no limit.
+    :return: location of aggregated statistics or None in case of error.
+    """
+    if not statistics:
+        results_log = os.path.join(output, RESULTS_LOG_NAME)
+        if not os.path.isfile(results_log):
+            raise ValueError(f"{results_log} doesn't exist - pass statistics explicitly")
+        statistics = [record["stat_loc"] for record in ResultsLog(results_log)
+                      if record.get("stat_loc")]
+    final_stat = merge_statistics([(None, loc) for loc in statistics],
+                                  os.path.join(output, aggregated_statistics_name),
+                                  hercules_exec=hercules_exec,
+                                  n_samples=n_samples if n_samples > 0 else MERGE_BATCH_SIZE,
+                                  n_cores=merge_cores, timeout=timeout)
+    if final_stat:
+        log.info(f"Aggregated statistics is stored at {final_stat}")
+    return final_stat
+
+
+def add_merge_args(parser: argparse.ArgumentParser):
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output directory of hercules command.")
+    parser.add_argument("--statistics", nargs="+", default=None,
+                        help=f"Statistics to merge. Statistics of repositories from "
+                             f"{RESULTS_LOG_NAME} in output directory by default.")
+    parser.add_argument("--hercules-exec", default=HERCULES_EXEC,
+                        help="Hercules executable.")
+    parser.add_argument("--n-samples", "--merge-fan-in", default=-1, type=int,
+                        help="Max number of repos to combine together. Batches are cut by "
+                             "content, so they have about half of it on average. If <= 0 - "
+                             f"{MERGE_BATCH_SIZE} is used.")
+    parser.add_argument("--merge-cores", default=MERGE_CORES, type=int,
+                        help="How many merges to run concurrently.")
+    parser.add_argument("--timeout", default=TIMEOUT, type=float,
+                        help="Max duration of each hercules combine in seconds - it's killed "
+                             "after it. If <= 0 - no limit.")
+    parser.add_argument("--aggregated-statistics-name", default=AGGREGATED_STATISTICS_NAME,
+                        help="Name of file to store aggregated statistics.")
+
+
+def add_analysis_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--memory-budget", default=MEMORY_BUDGET, type=int,
+                        help="Total memory of concurrent hercules processes in bytes. Jobs are "
+                             "started only while their expected memory fits, so --size-limit may "
+                             "be raised or disabled. If <= 0 - no limit.")
+    parser.add_argument("--shards", default=SHARDS, type=int,
+                        help="Analyse repositories over --size-limit instead of skipping them: "
+                             "developers statistics of up to this number of segments of "
+                             "first-parent history are calculated in parallel, burndown and "
+                             "couples - by one more run over the whole history. Every run counts "
+                             "against --n-cores and --memory-budget. If <= 0 - they are skipped.")
+    parser.add_argument("--profile", default=PROFILE, choices=sorted(PROFILES),
+                        help="Analysis profile - set of hercules analyses: "
+                             + ", ".join(f"{name} ({' '.join(flags)})"
+                                         for name, flags in sorted(PROFILES.items())) + ".")
+    parser.add_argument("--split-analyses", action="store_true",
+                        help="Run independent analyses of the profile (burndown, devs, couples) "
+                             "as concurrent hercules processes per repository and splice their "
+                             "statistics. Shortens the longest jobs at the cost of more memory "
+                             "and repeated reading of history.")
+
+
 def add_hercules_args(parser: argparse.ArgumentParser):
     parser.add_argument("-i", "--input-csv", help="Path to csv with repositories.", required=True)
     parser.add_argument("-o", "--output", help="Path to the directory where to store reports.",
@@ -305,11 +967,23 @@ def add_hercules_args(parser: argparse.ArgumentParser):
                              "applied.")
     parser.add_argument("-f", "--force", action="store_true",
                         help="Force overwriting of existing statistics (summary will always be "
-                             "overwritten).")
-    parser.add_argument("--n-samples", default=-1, type=int,
-                        help="Max number of repos to combine together - it will be done in a "
-                             "hierarchical manner. If <= 0 - no hierarchical processing will be "
-                             "used.")
+                             "overwritten). Otherwise statistics are recalculated only for "
+                             "repositories with changed refs.")
+    parser.add_argument("--n-samples", "--merge-fan-in", default=-1, type=int,
+                        help="Max number of repos to combine together - statistics are merged in "
+                             "batches of this size while other repositories are being analysed. "
+                             f"If <= 0 - {MERGE_BATCH_SIZE} is used.")
+    add_analysis_args(parser)
+    parser.add_argument("--timeout", default=TIMEOUT, type=float,
+                        help="Max duration of each hercules run (analysis or combine) in seconds - "
+                             "hercules is killed after it. If <= 0 - no limit.")
+    add_metrics_args(parser)
+    parser.add_argument("--merge-cores", default=MERGE_CORES, type=int,
+                        help="How many merges to run concurrently with analysis.")
+    parser.add_argument("--merge-engine", default=MERGE_ENGINE, choices=MERGE_ENGINES,
+                        help="\"hercules\" - merge with `hercules combine` subprocesses, "
+                             "\"python\" - merge in-process with NumPy/SciPy (partial aggregates "
+                             "stay in memory and are serialized once).")
     parser.add_argument("--directory-field-name", default=DIRECTORY_FIELD_NAME,
                         help="Name of directory field in CSV (it contains path to repository).")
     parser.add_argument("--url-field-name", default=URL_FIELD_NAME,
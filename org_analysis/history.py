@@ -0,0 +1,47 @@
+"""Per-repository observations persisted between runs."""
+import json
+import os
+from typing import Any, Dict
+
+
+class RunHistory:
+    """
+    JSON file with observations about each repository from previous runs (duration, size, etc).
+
+    It's only read and written by the main process - workers return observations in results.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: location of JSON file. It's created on `save()` if it doesn't exist.
+        """
+        self.path = path
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.records = json.load(f)
+
+    def get(self, repository: str) -> Dict[str, Any]:
+        """
+        Get observations about repository.
+
+        :param repository: repository location.
+        :return: dictionary with observations (empty if repository wasn't processed before).
+        """
+        return self.records.get(repository, {})
+
+    def update(self, repository: str, **values: Any) -> None:
+        """
+        Update observations about repository.
+
+        :param repository: repository location.
+        :param values: observations to update.
+        """
+        self.records.setdefault(repository, {}).update(values)
+
+    def save(self) -> None:
+        """Atomically write observations to disk."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.records, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
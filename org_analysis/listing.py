@@ -0,0 +1,190 @@
+"""Concurrent paginated listing of repositories through GitHub REST API."""
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import json
+import logging as log
+import os
+import threading
+from time import sleep
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from org_analysis.cloning import RetryPolicy
+from org_analysis.defaults import GITHUB_API_URL, GITHUB_TOKEN_ENV_VAR, LISTING_RETRIES, \
+    LISTING_THREADS, LISTING_TIMEOUT, PER_PAGE
+
+Repo = NamedTuple("Repo",
+                  (("full_name", str),
+                   ("git_url", str),
+                   ("clone_url", str),
+                   ("fork", bool)))
+
+
+class ListingCache:
+    """
+    Pages of listing with their ETags. Unchanged pages are answered with "304 Not Modified" which
+    is nearly free and doesn't count against GitHub rate limit.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: location of JSON file with cache. If None - nothing is cached.
+        """
+        self.path = path
+        self.pages = {}
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.pages = json.load(f)
+
+    def get(self, url: str) -> Dict[str, Any]:
+        with self._lock:
+            return self.pages.get(url, {})
+
+    def put(self, url: str, etag: str, repos: List[Dict[str, Any]], last_page: int) -> None:
+        with self._lock:
+            self.pages[url] = {"etag": etag, "repos": repos, "last_page": last_page}
+
+    def save(self) -> None:
+        """Atomically write cache to disk."""
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with self._lock, open(tmp_path, "w") as f:
+            json.dump(self.pages, f)
+        os.replace(tmp_path, self.path)
+
+
+def make_session(login: str = None, password: str = None, token_env: str = GITHUB_TOKEN_ENV_VAR,
+                 pool_size: int = LISTING_THREADS) -> "requests.Session":
+    """
+    Create HTTP session with connection pool shared by all threads of listing.
+
+    :param login: login or token.
+    :param password: password.
+    :param token_env: environment variable for GitHub token.
+    :param pool_size: max number of kept-alive connections.
+    :return: session.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept"] = "application/vnd.github.v3+json"
+    if login is None:
+        login = os.getenv(token_env)
+    if login is not None and password is not None:
+        session.auth = (login, password)
+    elif login is not None:
+        session.headers["Authorization"] = f"token {login}"
+    return session
+
+
+def get(session: "requests.Session", url: str, timeout: float = LISTING_TIMEOUT,
+        policy: RetryPolicy = RetryPolicy(retries=LISTING_RETRIES), **kwargs
+        ) -> "requests.Response":
+    """
+    GET request which is retried with exponential backoff and jitter if it timed out - a stalled
+    connection is transient and doesn't hang the whole listing.
+
+    :param session: HTTP session.
+    :param url: URL.
+    :param timeout: max time to wait for connection and for each read of response in seconds.
+    :param policy: retries after timeout.
+    :param kwargs: other arguments of `requests.Session.get`.
+    :return: response.
+    :raises requests.Timeout: if the last retry timed out too.
+    """
+    import requests
+
+    for attempt in range(policy.retries + 1):
+        try:
+            return session.get(url, timeout=timeout, **kwargs)
+        except requests.Timeout as e:
+            if attempt == policy.retries:
+                raise
+            delay = policy.delay(attempt)
+            log.warning(f"Request {url} timed out ({e}) - retry in {delay:.1f}s")
+            sleep(delay)
+
+
+def repos_url(session: "requests.Session", owner: str, api_url: str = GITHUB_API_URL,
+              timeout: float = LISTING_TIMEOUT) -> str:
+    """
+    Get URL of repositories listing for organization or user.
+
+    :param session: HTTP session.
+    :param owner: organization or user name.
+    :param api_url: root of GitHub API.
+    :param timeout: max time to wait for connection and for each read of response in seconds.
+    :return: URL of listing.
+    """
+    response = get(session, f"{api_url}/orgs/{owner}", timeout=timeout)
+    if response.status_code == 404:
+        # switch to user
+        return f"{api_url}/users/{owner}/repos"
+    response.raise_for_status()
+    return f"{api_url}/orgs/{owner}/repos"
+
+
+def page_number(link: str) -> int:
+    """Get number of page from URL of pagination link."""
+    return int(parse_qs(urlparse(link).query)["page"][0])
+
+
+def fetch_page(session: "requests.Session", url: str, page: int, cache: ListingCache,
+               timeout: float = LISTING_TIMEOUT) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Fetch one page of listing (conditionally if it was seen before).
+
+    :param session: HTTP session.
+    :param url: URL of listing.
+    :param page: page number starting from 1.
+    :param cache: pages with ETags.
+    :param timeout: max time to wait for connection and for each read of response in seconds.
+    :return: (repositories from page, number of the last page).
+    """
+    page_url = f"{url}?per_page={PER_PAGE}&page={page}"
+    cached = cache.get(page_url)
+    headers = {"If-None-Match": cached["etag"]} if cached.get("etag") else {}
+    response = get(session, page_url, timeout=timeout, headers=headers)
+    if response.status_code == 304:
+        return cached["repos"], cached["last_page"]
+    response.raise_for_status()
+    repos = [{field: repo[field] for field in Repo._fields} for repo in response.json()]
+    last_page = page_number(response.links["last"]["url"]) if "last" in response.links else page
+    cache.put(page_url, response.headers.get("ETag"), repos, last_page)
+    return repos, last_page
+
+
+def list_repositories(owner: str, session: "requests.Session", api_url: str = GITHUB_API_URL,
+                      cache_path: str = None, n_threads: int = LISTING_THREADS,
+                      timeout: float = LISTING_TIMEOUT) -> Iterator[Repo]:
+    """
+    List repositories of organization or user. The first page tells how many pages there are,
+    the rest of pages are fetched concurrently and repositories are yielded as pages arrive.
+
+    :param owner: organization or user name.
+    :param session: HTTP session.
+    :param api_url: root of GitHub API.
+    :param cache_path: location of JSON file with ETags of pages. If None - nothing is cached.
+    :param n_threads: number of concurrent requests.
+    :param timeout: max time to wait for connection and for each read of response in seconds.
+    :return: iterator over repositories.
+    """
+    cache = ListingCache(cache_path)
+    url = repos_url(session, owner, api_url, timeout=timeout)
+    repos, last_page = fetch_page(session, url, 1, cache, timeout=timeout)
+    log.info(f"Listing of {owner} has {last_page} pages")
+    for repo in repos:
+        yield Repo(**repo)
+    with ThreadPoolExecutor(n_threads) as executor:
+        futures = [executor.submit(fetch_page, session, url, page, cache, timeout)
+                   for page in range(2, last_page + 1)]
+        for future in as_completed(futures):
+            repos, _ = future.result()
+            for repo in repos:
+                yield Repo(**repo)
+    cache.save()
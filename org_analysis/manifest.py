@@ -0,0 +1,133 @@
+"""Streaming access to lists of repositories and to results of their processing."""
+import csv
+from itertools import islice
+import json
+import logging as log
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+FINISHED_RECORD = {"finished": True}  # the last record of log of a run which finished
+
+
+def read_manifest(input_csv: str, directory_field_name: str,
+                  url_field_name: str) -> Iterator[Tuple[str, str]]:
+    """
+    Read CSV with repositories row by row.
+
+    :param input_csv: path to CSV with information about repositories location.
+    :param directory_field_name: name of directory field in CSV (it contains path to repository).
+    :param url_field_name: name of URL field in CSV (it contains repository's URL).
+    :return: iterator over (directory, URL).
+    """
+    with open(input_csv, newline="") as f:
+        reader = csv.DictReader(f)
+        for field in (directory_field_name, url_field_name):
+            if field not in (reader.fieldnames or []):
+                raise ValueError(f"Input CSV should have column \"{field}\" but got "
+                                 f"{reader.fieldnames}")
+        for row in reader:
+            yield row[directory_field_name], row[url_field_name]
+
+
+def windows(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    Split iterable into lists of `size` elements (the last one may be shorter).
+
+    :param iterable: iterable.
+    :param size: size of window.
+    :return: iterator over windows.
+    """
+    iterator = iter(iterable)
+    while True:
+        window = list(islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+class ManifestWriter:
+    """CSV with repositories written row by row as they are processed."""
+
+    def __init__(self, path: str, url_field_name: str, directory_field_name: str):
+        self.path = path
+        self._fields = (url_field_name, directory_field_name)
+        self._file = None
+        self._writer = None
+
+    def __enter__(self) -> "ManifestWriter":
+        self._file = open(self.path, "w", newline="")
+        self._writer = csv.writer(self._file, lineterminator="\n")
+        self._writer.writerow(self._fields)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file.close()
+
+    def write(self, repo_url: str, directory: str) -> None:
+        self._writer.writerow((repo_url, directory))
+        self._file.flush()
+
+
+class ResultsLog:
+    """
+    JSONL file with results of processing of repositories - results are spilled to disk as they
+    arrive instead of being kept in memory until the end of the run.
+
+    The log of a run which was interrupted is continued by the next run, so results of finished
+    repositories aren't lost - the last result of each repository counts.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: location of JSONL file. It's overwritten if the previous run finished.
+        """
+        self.path = path
+        self._file = None
+
+    def interrupted(self) -> bool:
+        """Check if the log was left by a run that didn't finish."""
+        try:
+            with open(self.path, "rb") as f:
+                last = f.read().rstrip(b"\n").rsplit(b"\n", 1)[-1]
+        except FileNotFoundError:
+            return False
+        return bool(last) and last != json.dumps(FINISHED_RECORD).encode()
+
+    def __enter__(self) -> "ResultsLog":
+        if self.interrupted():
+            log.info(f"Continuing results of interrupted run in {self.path}")
+            self._file = open(self.path, "a")
+            # torn write of the last record
+            self._file.write("\n")
+        else:
+            self._file = open(self.path, "w")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._file.write(json.dumps(FINISHED_RECORD) + "\n")
+        self._file.close()
+
+    def append(self, record: Dict[str, Any]) -> None:
+        """Write result of one repository."""
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def _records(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # empty line or torn write of interrupted run
+                if record != FINISHED_RECORD:
+                    yield record
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Read results back (after the log is closed) - the last one of each repository."""
+        last = {}
+        for i, record in enumerate(self._records()):
+            last[record.get("repository")] = i
+        indices = set(last.values())
+        for i, record in enumerate(self._records()):
+            if i in indices:
+                yield record
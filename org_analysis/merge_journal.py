@@ -0,0 +1,198 @@
+"""Journal of checkpointed hierarchical merge of statistics.
+
+Intermediate statistics of the reduction tree are content-addressed: the name of intermediate is
+a hash of digests of its inputs and hercules version, so the same merge is never repeated. The
+journal in work directory maps intermediates to their inputs and digest of output, and caches
+SHA-256 of inputs by size and modification time. It's appended and synced after every merge, so
+a re-run after crash reuses every intermediate which matches the journal and continues with the
+rest.
+
+Batches are cut by content-defined chunking over inputs sorted by location: a batch ends after an
+input whose key (location of the first repository under it) hashes onto boundary. So a few added
+or changed repositories change only the batches which contain them and their ancestors - the rest
+of the tree is reused. Batches have half of max inputs on average (at least 2, at most max), so
+the tree is deeper than with batches of exactly max inputs - max ~ 2x desired fan-in.
+"""
+import hashlib
+import json
+import logging as log
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+JOURNAL_NAME = "journal.jsonl"
+CHUNK_SIZE = 1 << 20  # bytes read at once to compute digest
+# names of files written by journal: intermediates and temporary file of compaction
+OWN_FILE = re.compile(r"[0-9a-f]{64}\.pb|" + re.escape(JOURNAL_NAME) + r"\.tmp")
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def node_id(digests: Sequence[str], version: str) -> str:
+    """
+    Name of intermediate statistics.
+
+    :param digests: digests of inputs in order of merging.
+    :param version: hercules version.
+    :return: hex digest.
+    """
+    return hashlib.sha256("\n".join([version, *digests]).encode()).hexdigest()
+
+
+def is_boundary(key: str, level: int, target: int) -> bool:
+    """Check if batch of `level` ends after input with `key` (1 of `target` inputs on average)."""
+    value = int(hashlib.sha256(f"{level}:{key}".encode()).hexdigest()[:8], 16)
+    return value % target == 0
+
+
+def chunks(items: Sequence[Tuple[str, str]], max_size: int,
+           level: int) -> List[List[Tuple[str, str]]]:
+    """
+    Split inputs of level into batches with content-defined boundaries.
+
+    :param items: (key, location) of inputs sorted by key.
+    :param max_size: max number of inputs in batch. Batches are half of it on average and have at
+                     least 2 inputs (except the last one), so each level shrinks.
+    :param level: level of reduction tree - boundaries of different levels are independent.
+    :return: batches.
+    """
+    max_size = max(max_size, 2)
+    target = max(max_size // 2, 1)
+    batches, batch = [], []
+    for key, location in items:
+        batch.append((key, location))
+        if len(batch) >= max_size or len(batch) >= 2 and is_boundary(key, level, target):
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _sync(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MergeJournal:
+    """
+    Journal of merges in durable work directory. Used as context manager: on successful exit the
+    journal is compacted to entries used by this merge and unused intermediates are deleted, after
+    failure everything is kept for the next run. Other files of work directory are never
+    deleted.
+    """
+
+    def __init__(self, work_dir: str):
+        """
+        :param work_dir: directory with intermediates and journal.
+        """
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, JOURNAL_NAME)
+        self.digests = {}  # location -> {size, mtime, sha256}
+        self.merges = {}  # node -> {inputs, sha256}
+        self._used_digests = set()
+        self._used_merges = set()
+        self._file = None
+
+    def __enter__(self) -> "MergeJournal":
+        os.makedirs(self.work_dir, exist_ok=True)
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # torn write of the last entry
+                    if entry["type"] == "digest":
+                        self.digests[entry["path"]] = entry
+                    else:
+                        self.merges[entry["node"]] = entry
+        self._file = open(self.path, "a")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file.close()
+        if exc_type is not None:
+            return
+        self._compact([self.digests[path] for path in self._used_digests] +
+                      [self.merges[node] for node in self._used_merges])
+        used = {self.location(node) for node in self._used_merges}
+        for name in os.listdir(self.work_dir):
+            path = os.path.join(self.work_dir, name)
+            if OWN_FILE.fullmatch(name) and path not in used and os.path.isfile(path):
+                os.remove(path)
+
+    def _compact(self, entries: Iterable[Dict[str, Any]]) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def location(self, node: str) -> str:
+        """Location of intermediate statistics."""
+        return os.path.join(self.work_dir, node + ".pb")
+
+    def digest(self, path: str) -> str:
+        """
+        SHA-256 of file - computed again only if size or modification time changed.
+
+        :param path: absolute location of file.
+        :return: hex digest.
+        """
+        stat = os.stat(path)
+        entry = self.digests.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"type": "digest", "path": path, "size": stat.st_size,
+                     "mtime": stat.st_mtime_ns, "sha256": file_digest(path)}
+            self.digests[path] = entry
+            self._append(entry)
+        self._used_digests.add(path)
+        return entry["sha256"]
+
+    def lookup(self, node: str) -> Optional[str]:
+        """
+        Find valid intermediate statistics.
+
+        :param node: name of intermediate.
+        :return: location or None if it wasn't merged or its content doesn't match the journal.
+        """
+        entry = self.merges.get(node)
+        location = self.location(node)
+        if entry is None or not os.path.isfile(location):
+            return None
+        if self.digest(location) != entry["sha256"]:
+            log.warning(f"Intermediate statistics {location} are corrupted - merging again")
+            return None
+        self._used_merges.add(node)
+        return location
+
+    def record(self, node: str, inputs: Sequence[str]) -> None:
+        """
+        Journal finished merge. Its output is synced to disk first.
+
+        :param node: name of intermediate.
+        :param inputs: locations of inputs.
+        """
+        location = self.location(node)
+        _sync(location)
+        entry = {"type": "merge", "node": node, "inputs": list(inputs),
+                 "sha256": self.digest(location)}
+        self.merges[node] = entry
+        self._used_merges.add(node)
+        self._append(entry)
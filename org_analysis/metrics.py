@@ -0,0 +1,160 @@
+"""Structured per-stage metrics written to JSONL file and optionally to Prometheus textfile.
+
+Metrics are disabled until `configure()` is called. Pools should call it in workers too (pass it
+as `initializer`), every process appends complete lines to the same file with a single write.
+"""
+from contextlib import contextmanager
+import json
+import os
+import resource
+import socket
+from time import time
+from typing import Any, Dict, Iterator, Optional
+import uuid
+
+_path = None
+_run_id = None
+
+
+def configure(path: Optional[str], run_id: str = None) -> str:
+    """
+    Enable metrics for current process.
+
+    :param path: location of JSONL file. If None - metrics are disabled.
+    :param run_id: identifier of the run. New one is generated if not given.
+    :return: identifier of the run (pass it to workers).
+    """
+    global _path, _run_id
+    _path = path
+    _run_id = run_id or uuid.uuid4().hex
+    return _run_id
+
+
+def initargs() -> tuple:
+    """Arguments for `configure` to initialize pool workers with the same settings."""
+    return _path, _run_id
+
+
+def rusage_metrics(rusage: resource.struct_rusage) -> Dict[str, Any]:
+    """
+    Convert resource usage to metrics.
+
+    :param rusage: resource usage (of child process or delta).
+    :return: CPU time in seconds, peak RSS and bytes read/written.
+    """
+    return {"cpu_time": rusage.ru_utime + rusage.ru_stime,
+            "peak_rss": rusage.ru_maxrss * 1024,
+            # block operations are counted in 512-byte units
+            "bytes_read": rusage.ru_inblock * 512,
+            "bytes_written": rusage.ru_oublock * 512}
+
+
+def emit(stage: str, repository: str = "", wall_time: float = 0,
+         rusage: resource.struct_rusage = None, exit_status: int = 0, **extra: Any) -> None:
+    """
+    Append metrics record.
+
+    :param stage: name of stage (clone, sizing, hercules, hercules_fallback, validation, merge...).
+    :param repository: repository URL or location.
+    :param wall_time: duration in seconds.
+    :param rusage: resource usage of the stage.
+    :param exit_status: exit status of process (non-zero means failure).
+    :param extra: additional fields.
+    """
+    if _path is None:
+        return
+    record = {"run_id": _run_id, "timestamp": time(), "host": socket.gethostname(),
+              "pid": os.getpid(), "stage": stage, "repository": repository,
+              "wall_time": wall_time, "exit_status": exit_status}
+    record.update(rusage_metrics(rusage) if rusage is not None else
+                  {"cpu_time": 0, "peak_rss": 0, "bytes_read": 0, "bytes_written": 0})
+    record.update(extra)
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def _delta(after: resource.struct_rusage,
+           before: resource.struct_rusage) -> resource.struct_rusage:
+    values = [a - b for a, b in zip(after, before)]
+    # peak memory can't be subtracted
+    values[2] = after.ru_maxrss
+    return resource.struct_rusage(values)
+
+
+@contextmanager
+def measure(stage: str, repository: str = "", children: bool = True,
+            **extra: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Measure stage which runs in current process or in its children and emit metrics.
+
+    Resource usage is a difference between the end and the start of the stage, so it's exact
+    only if nothing else runs in the process at the same time. Peak RSS is the max of process
+    (or of all its children) so far.
+
+    :param stage: name of stage.
+    :param repository: repository URL or location.
+    :param children: measure children of current process instead of current process itself.
+    :param extra: additional fields.
+    :return: dictionary to update extra fields (`exit_status` too) inside of the stage.
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    before = resource.getrusage(who)
+    start = time()
+    fields = dict(extra)
+    try:
+        yield fields
+    except Exception:
+        fields.setdefault("exit_status", 1)
+        raise
+    finally:
+        emit(stage, repository=repository, wall_time=time() - start,
+             rusage=_delta(resource.getrusage(who), before), **fields)
+
+
+def write_prometheus(jsonl_path: str, textfile_path: str, run_id: str = None) -> None:
+    """
+    Aggregate metrics of the run by stage and write them in Prometheus textfile format.
+
+    :param jsonl_path: location of JSONL file with metrics.
+    :param textfile_path: location of textfile (for node_exporter's textfile collector).
+    :param run_id: identifier of the run to aggregate. Current one by default.
+    """
+    run_id = run_id or _run_id
+    stages = {}
+    with open(jsonl_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["run_id"] != run_id:
+                continue
+            agg = stages.setdefault(record["stage"], {"count": 0, "failures": 0, "wall_time": 0,
+                                                      "cpu_time": 0, "bytes_read": 0,
+                                                      "bytes_written": 0, "peak_rss": 0})
+            agg["count"] += 1
+            agg["failures"] += record["exit_status"] != 0
+            for key in ("wall_time", "cpu_time", "bytes_read", "bytes_written"):
+                agg[key] += record[key]
+            agg["peak_rss"] = max(agg["peak_rss"], record["peak_rss"])
+    # totals of one run start from zero every run - they are gauges, counters would be read by
+    # `rate()` and `increase()` as resets
+    metrics = [("count", "gauge", "Number of executions of stage in the last run."),
+               ("failures", "gauge", "Number of failed executions of stage in the last run."),
+               ("wall_time", "gauge", "Total wall time of stage in the last run in seconds."),
+               ("cpu_time", "gauge", "Total CPU time of stage in the last run in seconds."),
+               ("bytes_read", "gauge", "Total bytes read by stage in the last run."),
+               ("bytes_written", "gauge", "Total bytes written by stage in the last run."),
+               ("peak_rss", "gauge", "Max resident set size of stage in the last run in bytes.")]
+    lines = []
+    for key, kind, help in metrics:
+        name = f"org_analysis_stage_{key}"
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, agg in sorted(stages.items()):
+            lines.append(f'{name}{{stage="{stage}"}} {agg[key]}')
+    tmp_path = textfile_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, textfile_path)
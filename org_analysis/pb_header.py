@@ -0,0 +1,125 @@
+"""Read header of hercules statistics without parsing the whole protobuf message."""
+from typing import BinaryIO, NamedTuple, Tuple
+
+# field numbers from hercules' `AnalysisResults` and `Metadata` messages (internal/pb/pb.proto)
+HEADER_FIELD = 1
+REPOSITORY_FIELD = 3
+BEGIN_UNIX_TIME_FIELD = 4
+END_UNIX_TIME_FIELD = 5
+COMMITS_FIELD = 6
+
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+Header = NamedTuple("Header",
+                    (("repository", str),
+                     ("begin_unix_time", int),
+                     ("end_unix_time", int),
+                     ("commits", int)))
+
+
+def read_varint(f: BinaryIO) -> int:
+    """
+    Read base 128 varint from file.
+
+    :param f: file opened in binary mode.
+    :return: decoded value or -1 if file ended before varint started.
+    """
+    result = shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            if shift:
+                raise ValueError("Truncated varint")
+            return -1
+        result |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
+
+def decode_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    """
+    Decode base 128 varint from buffer.
+
+    :param buf: buffer.
+    :param pos: start position.
+    :return: (value, position after varint).
+    """
+    result = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("Truncated varint")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def to_int64(value: int) -> int:
+    """Interpret decoded varint as signed 64-bit integer."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def parse_header(buf: bytes) -> Header:
+    """
+    Decode `Metadata` message.
+
+    :param buf: serialized message.
+    :return: Header.
+    """
+    fields = {}
+    pos = 0
+    while pos < len(buf):
+        tag, pos = decode_varint(buf, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == VARINT:
+            fields[field], pos = decode_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            size, pos = decode_varint(buf, pos)
+            fields[field] = buf[pos:pos + size]
+            pos += size
+        elif wire_type == FIXED64:
+            pos += 8
+        elif wire_type == FIXED32:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+    return Header(repository=bytes(fields.get(REPOSITORY_FIELD, b"")).decode("utf-8", "replace"),
+                  begin_unix_time=to_int64(fields.get(BEGIN_UNIX_TIME_FIELD, 0)),
+                  end_unix_time=to_int64(fields.get(END_UNIX_TIME_FIELD, 0)),
+                  commits=to_int64(fields.get(COMMITS_FIELD, 0)))
+
+
+def read_header(stat_loc: str) -> Header:
+    """
+    Read header of statistics produced by hercules with `--pb`. Only header message is decoded -
+    analysis results are skipped without reading them.
+
+    :param stat_loc: location of statistics.
+    :return: Header.
+    :raises ValueError: if file has no header or it is truncated.
+    """
+    with open(stat_loc, "rb") as f:
+        while True:
+            tag = read_varint(f)
+            if tag < 0:
+                raise ValueError(f"No header in {stat_loc}")
+            field, wire_type = tag >> 3, tag & 7
+            if wire_type == VARINT:
+                read_varint(f)
+            elif wire_type == FIXED64:
+                f.seek(8, 1)
+            elif wire_type == FIXED32:
+                f.seek(4, 1)
+            elif wire_type == LENGTH_DELIMITED:
+                size = read_varint(f)
+                if field == HEADER_FIELD:
+                    buf = f.read(size)
+                    if len(buf) != size:
+                        raise ValueError(f"Truncated header in {stat_loc}")
+                    return parse_header(buf)
+                f.seek(size, 1)
+            else:
+                raise ValueError(f"Unsupported wire type {wire_type} in {stat_loc}")
@@ -0,0 +1,698 @@
+"""In-process merge of hercules statistics - alternative to `hercules combine` subprocesses.
+
+Statistics are decoded with message types registered in `labours.PB_MESSAGES` and accumulated in
+`Aggregate` which stays in memory between levels of merging, so it's serialized only once - in
+the same format as output of `hercules combine`.
+
+Burndown matrices of different repositories have different time grids: they are resampled to a
+common grid with the smallest granularity and sampling (like `hercules combine` does) right
+before serialization. Until then matrices on the same grid are summed as soon as they are added,
+so memory doesn't grow with the number of repositories and developers. Partial aggregates of
+pool workers are sent back serialized, so their burndowns are resampled to the grid of the batch
+like intermediate outputs of hierarchical `hercules combine`. Developers, files and languages are
+matched by name.
+"""
+from functools import lru_cache
+from importlib import import_module
+from math import lcm
+from multiprocessing import Pool
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from org_analysis import metrics
+from org_analysis.defaults import MERGE_BATCH_SIZE, MERGE_CORES
+
+DAY = 24 * 3600
+AUTHOR_MISSING = (1 << 18) - 1  # hercules' key of developer without identity
+MISSING = -1  # position of developer without identity
+INTERACTION_SPECIAL_COLUMNS = 2  # first columns of people interaction aren't developers
+DEVS_COLUMNS = 3  # tick, developer, language (MISSING - totals of developer)
+COMPACT_EVERY = 64  # number of appended chunks before they are summed up
+
+
+class UnsupportedStatistics(ValueError):
+    """Statistics contain analysis which can't be merged in-process."""
+
+
+@lru_cache(maxsize=None)
+def message_types() -> Tuple[type, Dict[str, type]]:
+    """
+    Find protobuf message types of hercules through labours.
+
+    :return: (AnalysisResults, mapping from name of analysis to message type of its results).
+    """
+    try:
+        from hercules import labours
+    except ImportError as e:
+        raise UnsupportedStatistics(f"Message types of hercules are not available: {e}")
+    types = {}
+    for name, path in labours.PB_MESSAGES.items():
+        module, cls = path.rsplit(".", 1)
+        types[name] = getattr(import_module(module), cls)
+    module = import_module(labours.PB_MESSAGES["Burndown"].rsplit(".", 1)[0])
+    return module.AnalysisResults, types
+
+
+def tick_seconds(msg) -> int:
+    """Duration of tick of analysis results in seconds (older hercules always uses days)."""
+    tick_size = getattr(msg, "tick_size", 0)  # nanoseconds
+    return tick_size // 10 ** 9 if tick_size else DAY
+
+
+class Index:
+    """Positions of names (developers, files, languages) in merged statistics."""
+
+    def __init__(self):
+        self.names = []
+        self._positions = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def position(self, name: str) -> int:
+        pos = self._positions.get(name)
+        if pos is None:
+            pos = self._positions[name] = len(self.names)
+            self.names.append(name)
+        return pos
+
+    def map(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Find positions of names, unknown names are appended.
+
+        :param names: names.
+        :return: array of positions.
+        """
+        return np.fromiter((self.position(name) for name in names), dtype=np.int64,
+                           count=len(names))
+
+
+def to_csr(msg) -> sparse.csr_matrix:
+    """Convert `CompressedSparseRowMatrix` message to scipy matrix."""
+    return sparse.csr_matrix((np.array(msg.data, dtype=np.int64),
+                              np.array(msg.indices, dtype=np.int64),
+                              np.array(msg.indptr, dtype=np.int64)),
+                             shape=(msg.number_of_rows, msg.number_of_columns))
+
+
+def fill_csr(msg, matrix: sparse.csr_matrix) -> None:
+    """Fill `CompressedSparseRowMatrix` message from scipy matrix."""
+    matrix.sum_duplicates()
+    msg.number_of_rows, msg.number_of_columns = matrix.shape
+    msg.data.extend(matrix.data.tolist())
+    msg.indices.extend(matrix.indices.tolist())
+    msg.indptr.extend(matrix.indptr.tolist())
+
+
+class SparseUnion:
+    """Sum of sparse matrices whose rows and columns are matched by names."""
+
+    def __init__(self, index: Index, special_columns: int = 0):
+        """
+        :param index: positions of names of rows (and columns).
+        :param special_columns: number of first columns which don't correspond to names.
+        """
+        self.index = index
+        self.special_columns = special_columns
+        self._chunks = []
+
+    def add(self, positions: np.ndarray, matrix: sparse.spmatrix) -> None:
+        """
+        Add matrix.
+
+        :param positions: positions of its rows in `index`.
+        :param matrix: matrix - its columns correspond to the same names as rows.
+        """
+        coo = matrix.tocoo()
+        if not coo.nnz:
+            return
+        shifted = coo.col - self.special_columns
+        cols = np.where(shifted >= 0, positions[np.maximum(shifted, 0)] + self.special_columns,
+                        coo.col)
+        self._chunks.append((positions[coo.row], cols, coo.data.astype(np.int64)))
+        if len(self._chunks) >= COMPACT_EVERY:
+            self._chunks = [self._triplets(self.matrix().tocoo())]
+
+    def update(self, other: "SparseUnion") -> None:
+        """Add the sum of other union."""
+        self.add(self.index.map(other.index.names), other.matrix())
+
+    @staticmethod
+    def _triplets(coo: sparse.coo_matrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+
+    def matrix(self) -> sparse.csr_matrix:
+        """Sum of added matrices."""
+        n = len(self.index)
+        shape = (n, n + self.special_columns)
+        if not self._chunks:
+            return sparse.csr_matrix(shape, dtype=np.int64)
+        rows, cols, data = (np.concatenate(parts) for parts in zip(*self._chunks))
+        return sparse.coo_matrix((data, (rows, cols)), shape=shape).tocsr()
+
+
+class Term(NamedTuple):
+    offset: int  # absolute tick of the first commit
+    granularity: int  # ticks in each band
+    sampling: int  # ticks between samples
+    matrix: np.ndarray  # samples x bands
+
+
+class TermSum:
+    """
+    Sum of burndown matrices on the same time grid: equal granularity and sampling, offsets
+    differ by multiples of both. It's kept as sparse differences between consecutive samples, so
+    matrix which ended keeps its last sample in the sum - like `resample` extends it.
+    """
+
+    def __init__(self, granularity: int, sampling: int, offset: int):
+        """
+        :param granularity: ticks in each band.
+        :param sampling: ticks between samples.
+        :param offset: absolute tick of the first sample and band.
+        """
+        self.granularity, self.sampling, self.offset = granularity, sampling, offset
+        self.shape = (0, 0)
+        self._chunks = []
+
+    def add(self, term: Term) -> None:
+        """Add matrix on the same grid."""
+        coo = sparse.coo_matrix(np.diff(term.matrix, axis=0, prepend=0))
+        self._add(term.offset, (coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data),
+                  term.matrix.shape)
+
+    def update(self, other: "TermSum") -> None:
+        """Add other sum on the same grid."""
+        self._add(other.offset, other._triplets(), other.shape)
+
+    def _add(self, offset: int, triplets: Tuple[np.ndarray, np.ndarray, np.ndarray],
+             shape: Tuple[int, int]) -> None:
+        if offset < self.offset:
+            rows, cols, data = self._triplets()
+            self._chunks = [(rows + (self.offset - offset) // self.sampling,
+                             cols + (self.offset - offset) // self.granularity, data)]
+            self.shape = (self.shape[0] + (self.offset - offset) // self.sampling,
+                          self.shape[1] + (self.offset - offset) // self.granularity)
+            self.offset = offset
+        row_shift = (offset - self.offset) // self.sampling
+        col_shift = (offset - self.offset) // self.granularity
+        rows, cols, data = triplets
+        self._chunks.append((rows + row_shift, cols + col_shift, data))
+        self.shape = (max(self.shape[0], shape[0] + row_shift),
+                      max(self.shape[1], shape[1] + col_shift))
+        if len(self._chunks) >= COMPACT_EVERY:
+            self._chunks = [self._triplets()]
+
+    def _triplets(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if not self._chunks:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        rows, cols, data = (np.concatenate(parts) for parts in zip(*self._chunks))
+        coo = sparse.coo_matrix((data, (rows, cols)), shape=self.shape)
+        coo.sum_duplicates()
+        return coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+
+    def term(self) -> Term:
+        """Summed matrix."""
+        matrix = np.zeros(self.shape)
+        rows, cols, data = self._triplets()
+        np.add.at(matrix, (rows, cols), data)
+        return Term(self.offset, self.granularity, self.sampling, np.cumsum(matrix, axis=0))
+
+
+def add_term(sums: Dict[Tuple[int, int, int], TermSum], term: Term) -> None:
+    """
+    Add burndown matrix to the sum on its grid.
+
+    :param sums: sums by grid.
+    :param term: matrix with its time grid.
+    """
+    residue = term.offset % lcm(term.granularity, term.sampling)
+    key = term.granularity, term.sampling, residue
+    if key not in sums:
+        sums[key] = TermSum(term.granularity, term.sampling, term.offset)
+    sums[key].add(term)
+
+
+def update_terms(sums: Dict[Tuple[int, int, int], TermSum],
+                 other: Dict[Tuple[int, int, int], TermSum]) -> None:
+    """Add other sums by grid."""
+    for key, term_sum in other.items():
+        if key in sums:
+            sums[key].update(term_sum)
+        else:
+            sums[key] = term_sum
+
+
+def dense_matrix(msg) -> np.ndarray:
+    """Convert `BurndownSparseMatrix` message to dense matrix."""
+    matrix = np.zeros((msg.number_of_rows, msg.number_of_columns))
+    for i, row in enumerate(msg.rows):
+        matrix[i, :len(row.columns)] = row.columns
+    return matrix
+
+
+def fill_matrix(msg, name: str, matrix: np.ndarray) -> None:
+    """Fill `BurndownSparseMatrix` message, trailing zeros of rows are not stored."""
+    matrix = np.clip(np.rint(matrix), 0, np.iinfo(np.uint32).max).astype(np.uint32)
+    msg.name = name
+    msg.number_of_rows, msg.number_of_columns = matrix.shape
+    for row in matrix:
+        nonzero = np.flatnonzero(row)
+        msg.rows.add().columns.extend(row[:nonzero[-1] + 1].tolist() if nonzero.size else [])
+
+
+def resample(terms: Sequence[Term], origin: int, length: int, granularity: int,
+             sampling: int) -> np.ndarray:
+    """
+    Align burndown matrices to common time grid and sum them.
+
+    Sample of output at tick T takes the latest sample of each matrix made before T (the last one
+    after its repository ends), lines of each band are spread uniformly over ticks of the band.
+
+    :param terms: matrices with their time grids.
+    :param origin: absolute tick of the first output sample and band.
+    :param length: number of ticks.
+    :param granularity: ticks in each output band.
+    :param sampling: ticks between output samples.
+    :return: samples x bands matrix.
+    """
+    n_samples, n_bands = -(-length // sampling), -(-length // granularity)
+    result = np.zeros((n_samples, n_bands))
+    for term in terms:
+        n_rows, n_cols = term.matrix.shape
+        if not n_rows or not n_cols:
+            continue
+        ticks = np.arange(n_samples) * sampling + origin - term.offset
+        valid = np.flatnonzero(ticks >= 0)
+        sources = np.minimum(ticks[valid] // term.sampling, n_rows - 1)
+        rows = sparse.csr_matrix((np.ones(len(valid)), (valid, sources)),
+                                 shape=(n_samples, n_rows))
+        band_ticks = np.arange(n_cols * term.granularity)
+        bands = np.clip((band_ticks + term.offset - origin) // granularity, 0, n_bands - 1)
+        cols = sparse.csr_matrix((np.full(len(band_ticks), 1 / term.granularity),
+                                  (band_ticks // term.granularity, bands)),
+                                 shape=(n_cols, n_bands))
+        result += (rows @ sparse.csr_matrix(term.matrix) @ cols).toarray()
+    return result
+
+
+class Burndown:
+    """Burndown of project and developers, people interaction."""
+
+    def __init__(self):
+        self.granularity = self.sampling = 0
+        # sums of matrices by time grid (see `add_term`)
+        self.project = {}
+        self.people_index = Index()
+        self.people = []
+        self.interaction = SparseUnion(self.people_index, INTERACTION_SPECIAL_COLUMNS)
+
+    def _people_terms(self, positions: np.ndarray) -> List[Dict[Tuple[int, int, int], TermSum]]:
+        while len(self.people) < len(self.people_index):
+            self.people.append({})
+        return [self.people[pos] for pos in positions]
+
+    def project_terms(self) -> List[Term]:
+        """Burndown of project - one matrix per time grid."""
+        return [term_sum.term() for term_sum in self.project.values()]
+
+    def _grid(self, granularity: int, sampling: int) -> None:
+        self.granularity = min(self.granularity or granularity, granularity)
+        self.sampling = min(self.sampling or sampling, sampling)
+
+    def add(self, msg, offset: int) -> None:
+        """
+        Add `BurndownAnalysisResults`.
+
+        :param msg: message.
+        :param offset: absolute tick of the first commit.
+        """
+        if len(msg.files) or len(msg.files_ownership):
+            raise UnsupportedStatistics("Burndown of files can't be merged in-process")
+        self._grid(msg.granularity, msg.sampling)
+        add_term(self.project, Term(offset, msg.granularity, msg.sampling,
+                                    dense_matrix(msg.project)))
+        positions = self.people_index.map([person.name for person in msg.people])
+        for terms, person in zip(self._people_terms(positions), msg.people):
+            add_term(terms, Term(offset, msg.granularity, msg.sampling, dense_matrix(person)))
+        if msg.people_interaction.number_of_rows:
+            self.interaction.add(positions, to_csr(msg.people_interaction))
+
+    def update(self, other: "Burndown") -> None:
+        """Add other burndown."""
+        self._grid(other.granularity, other.sampling)
+        update_terms(self.project, other.project)
+        positions = self.people_index.map(other.people_index.names)
+        for terms, other_terms in zip(self._people_terms(positions), other.people):
+            update_terms(terms, other_terms)
+        self.interaction.update(other.interaction)
+
+    def fill(self, msg, origin: int, length: int) -> None:
+        """
+        Fill `BurndownAnalysisResults` message.
+
+        :param msg: message.
+        :param origin: absolute tick of the first commit of merged statistics.
+        :param length: number of ticks of merged statistics.
+        """
+        grid = origin, length, self.granularity, self.sampling
+        msg.granularity, msg.sampling = self.granularity, self.sampling
+        fill_matrix(msg.project, "project", resample(self.project_terms(), *grid))
+        for name, terms in zip(self.people_index.names, self.people):
+            fill_matrix(msg.people.add(), name,
+                        resample([term_sum.term() for term_sum in terms.values()], *grid))
+        if self.people_index.names:
+            fill_csr(msg.people_interaction, self.interaction.matrix())
+
+
+class Devs:
+    """Commits and changed lines of each developer (and language) per tick."""
+
+    def __init__(self):
+        self.index = Index()
+        self.languages = Index()
+        # rows: tick, developer, language, commits, added, removed, changed
+        self._chunks = []
+
+    def add(self, msg, offset: int) -> None:
+        """
+        Add `DevsAnalysisResults`.
+
+        :param msg: message.
+        :param offset: absolute tick of the first commit.
+        """
+        positions = self.index.map(list(msg.dev_index))
+        # the field is called `days` in older versions of hercules
+        ticks = getattr(msg, msg.DESCRIPTOR.fields_by_number[1].name)
+        rows = []
+        for tick, tick_devs in ticks.items():
+            for dev, dev_tick in tick_devs.devs.items():
+                dev = positions[dev] if dev < len(positions) else MISSING
+                stats = dev_tick.stats
+                rows.append((tick + offset, dev, MISSING, dev_tick.commits, stats.added,
+                             stats.removed, stats.changed))
+                for lang, stats in dev_tick.languages.items():
+                    rows.append((tick + offset, dev, self.languages.position(lang), 0,
+                                 stats.added, stats.removed, stats.changed))
+        self._append(np.array(rows, dtype=np.int64).reshape(-1, DEVS_COLUMNS + 4))
+
+    def update(self, other: "Devs") -> None:
+        """Add other developers statistics."""
+        table = other.table()
+        for column, index, other_index in ((1, self.index, other.index),
+                                           (2, self.languages, other.languages)):
+            positions = index.map(other_index.names)
+            known = table[:, column] != MISSING
+            table[known, column] = positions[table[known, column]]
+        self._append(table)
+
+    def _append(self, table: np.ndarray) -> None:
+        self._chunks.append(table)
+        if len(self._chunks) >= COMPACT_EVERY:
+            self._chunks = [self.table()]
+
+    def drop_tick(self, tick: int) -> None:
+        """Remove statistics of absolute `tick`."""
+        table = self.table()
+        self._chunks = [table[table[:, 0] != tick]]
+
+    def rename(self, names: Dict[str, str]) -> None:
+        """Rename developers, names missing in `names` are kept."""
+        index = Index()
+        index.map([names.get(name, name) for name in self.index.names])
+        self.index = index
+
+    def table(self) -> np.ndarray:
+        """Rows with unique (tick, developer, language) - values of duplicates are summed."""
+        table = np.concatenate(self._chunks) if self._chunks else \
+            np.zeros((0, DEVS_COLUMNS + 4), dtype=np.int64)
+        keys, inverse = np.unique(table[:, :DEVS_COLUMNS], axis=0, return_inverse=True)
+        values = np.zeros((len(keys), table.shape[1] - DEVS_COLUMNS), dtype=np.int64)
+        np.add.at(values, inverse.ravel(), table[:, DEVS_COLUMNS:])
+        return np.hstack([keys, values])
+
+    def fill(self, msg, origin: int) -> None:
+        """
+        Fill `DevsAnalysisResults` message.
+
+        :param msg: message.
+        :param origin: absolute tick of the first commit of merged statistics.
+        """
+        msg.dev_index.extend(self.index.names)
+        ticks = getattr(msg, msg.DESCRIPTOR.fields_by_number[1].name)
+        for tick, dev, lang, commits, added, removed, changed in self.table().tolist():
+            dev_tick = ticks[tick - origin].devs[AUTHOR_MISSING if dev == MISSING else dev]
+            dev_tick.commits += commits
+            if lang != MISSING:
+                stats = dev_tick.languages[self.languages.names[lang]]
+            elif added or removed or changed:
+                stats = dev_tick.stats
+            else:
+                continue
+            stats.added, stats.removed, stats.changed = added, removed, changed
+
+
+class Couples:
+    """Files and developers changed together."""
+
+    def __init__(self):
+        self.files_index = Index()
+        self.people_index = Index()
+        self.files = SparseUnion(self.files_index)
+        self.people = SparseUnion(self.people_index)
+        self._people_files = []
+        self._files_lines = []
+
+    def add(self, msg) -> None:
+        """Add `CouplesAnalysisResults`."""
+        files = self.files_index.map(list(msg.file_couples.index))
+        people = self.people_index.map(list(msg.people_couples.index))
+        if msg.file_couples.matrix.number_of_rows:
+            self.files.add(files, to_csr(msg.file_couples.matrix))
+        if msg.people_couples.matrix.number_of_rows:
+            self.people.add(people, to_csr(msg.people_couples.matrix))
+        for person, touched in zip(people, msg.people_files):
+            touched = files[np.array(touched.files, dtype=np.int64)]
+            self._people_files.append(np.stack([np.full(len(touched), person), touched], axis=1))
+        self._files_lines.append((files[:len(msg.files_lines)],
+                                  np.array(msg.files_lines, dtype=np.int64)))
+
+    def update(self, other: "Couples") -> None:
+        """Add other couples."""
+        files = self.files_index.map(other.files_index.names)
+        people = self.people_index.map(other.people_index.names)
+        self.files.add(files, other.files.matrix())
+        self.people.add(people, other.people.matrix())
+        pairs = other.people_files()
+        self._people_files.append(np.stack([people[pairs[:, 0]], files[pairs[:, 1]]], axis=1))
+        self._files_lines.append((files, other.files_lines()))
+
+    def people_files(self) -> np.ndarray:
+        """Unique (developer, file) pairs."""
+        if not self._people_files:
+            return np.zeros((0, 2), dtype=np.int64)
+        return np.unique(np.concatenate(self._people_files), axis=0)
+
+    def files_lines(self) -> np.ndarray:
+        """Number of lines of each file."""
+        lines = np.zeros(len(self.files_index), dtype=np.int64)
+        for files, values in self._files_lines:
+            np.add.at(lines, files, values)
+        return lines
+
+    def fill(self, msg) -> None:
+        """Fill `CouplesAnalysisResults` message."""
+        msg.file_couples.index.extend(self.files_index.names)
+        fill_csr(msg.file_couples.matrix, self.files.matrix())
+        msg.people_couples.index.extend(self.people_index.names)
+        fill_csr(msg.people_couples.matrix, self.people.matrix())
+        pairs = self.people_files()
+        bounds = np.searchsorted(pairs[:, 0], np.arange(len(self.people_index) + 1))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            msg.people_files.add().files.extend(pairs[start:end, 1].tolist())
+        msg.files_lines.extend(self.files_lines().tolist())
+
+
+class Aggregate:
+    """Merged statistics of several repositories."""
+
+    ANALYSES = {"Burndown": Burndown, "Devs": Devs, "Couples": Couples}
+
+    def __init__(self):
+        self.repositories = []
+        self.version = 0
+        self.hash = ""
+        self.begin = self.end = None
+        self.commits = self.run_time = 0
+        self.run_time_per_item = {}
+        self.tick = None
+        self.analyses = {}
+
+    def _header(self, version: int, hash: str, repositories: List[str], begin: int, end: int,
+                commits: int, run_time: int, run_time_per_item: Dict[str, float],
+                tick: int) -> None:
+        if self.tick is not None and tick != self.tick:
+            raise UnsupportedStatistics(f"Tick size {tick}s differs from {self.tick}s")
+        self.tick = tick
+        self.version = self.version or version
+        self.hash = self.hash or hash
+        self.repositories.extend(repositories)
+        self.begin = begin if self.begin is None else min(self.begin, begin)
+        self.end = end if self.end is None else max(self.end, end)
+        self.commits += commits
+        self.run_time += run_time
+        for item, value in run_time_per_item.items():
+            self.run_time_per_item[item] = self.run_time_per_item.get(item, 0) + value
+
+    def add(self, results) -> None:
+        """
+        Add statistics of repository (or output of `hercules combine`).
+
+        :param results: `AnalysisResults` message.
+        """
+        _, types = message_types()
+        unsupported = set(results.contents) - set(self.ANALYSES)
+        if unsupported:
+            raise UnsupportedStatistics(f"Can't merge {', '.join(sorted(unsupported))} in-process")
+        messages = {}
+        for name, value in results.contents.items():
+            messages[name] = types[name]()
+            messages[name].ParseFromString(value)
+        ticks = {tick_seconds(msg) for name, msg in messages.items() if name != "Couples"}
+        if len(ticks) > 1:
+            raise UnsupportedStatistics(f"Different tick sizes {ticks}")
+        header = results.header
+        self._header(header.version, header.hash, [header.repository], header.begin_unix_time,
+                     header.end_unix_time, header.commits, header.run_time,
+                     dict(header.run_time_per_item), ticks.pop() if ticks else self.tick or DAY)
+        offset = header.begin_unix_time // self.tick
+        for name, msg in messages.items():
+            analysis = self.analyses.setdefault(name, self.ANALYSES[name]())
+            if name == "Couples":
+                analysis.add(msg)
+            else:
+                analysis.add(msg, offset)
+
+    def add_serialized(self, data: bytes) -> None:
+        """Add statistics serialized by `serialize` (e.g. returned by pool worker)."""
+        results_type, _ = message_types()
+        results = results_type()
+        results.ParseFromString(data)
+        self.add(results)
+
+    def update(self, other: "Aggregate") -> "Aggregate":
+        """
+        Add other aggregate.
+
+        :param other: aggregate.
+        :return: self.
+        """
+        if other.begin is None:
+            return self
+        self._header(other.version, other.hash, other.repositories, other.begin, other.end,
+                     other.commits, other.run_time, other.run_time_per_item, other.tick)
+        for name, analysis in other.analyses.items():
+            if name in self.analyses:
+                self.analyses[name].update(analysis)
+            else:
+                self.analyses[name] = analysis
+        return self
+
+    def serialize(self) -> bytes:
+        """Serialize to `AnalysisResults` message."""
+        results_type, types = message_types()
+        results = results_type()
+        header = results.header
+        header.version, header.hash = self.version, self.hash
+        header.repository = " & ".join(self.repositories)
+        header.begin_unix_time, header.end_unix_time = self.begin or 0, self.end or 0
+        header.commits, header.run_time = self.commits, self.run_time
+        header.run_time_per_item.update(self.run_time_per_item)
+        origin = (self.begin or 0) // (self.tick or DAY)
+        length = (self.end or 0) // (self.tick or DAY) - origin + 1
+        for name, analysis in self.analyses.items():
+            msg = types[name]()
+            if hasattr(msg, "tick_size"):
+                msg.tick_size = self.tick * 10 ** 9
+            if name == "Burndown":
+                analysis.fill(msg, origin, length)
+            elif name == "Devs":
+                analysis.fill(msg, origin)
+            else:
+                analysis.fill(msg)
+            results.contents[name] = msg.SerializeToString()
+        return results.SerializeToString()
+
+
+def read_statistics(stat_locs: Sequence[str]) -> Aggregate:
+    """
+    Read statistics and merge them in memory.
+
+    :param stat_locs: locations of statistics.
+    :return: Aggregate.
+    """
+    results_type, _ = message_types()
+    aggregate = Aggregate()
+    with metrics.measure("merge", repository=stat_locs[0] if stat_locs else "", children=False,
+                         level=0, inputs=len(stat_locs), engine="python"):
+        for stat_loc in stat_locs:
+            results = results_type()
+            with open(stat_loc, "rb") as f:
+                results.ParseFromString(f.read())
+            aggregate.add(results)
+    return aggregate
+
+
+def read_serialized(stat_locs: Sequence[str]) -> bytes:
+    """
+    Read statistics, merge them in memory and serialize - workers return bytes instead of
+    pickled `Aggregate`.
+
+    :param stat_locs: locations of statistics.
+    :return: serialized `AnalysisResults`.
+    """
+    return read_statistics(stat_locs).serialize()
+
+
+def write_statistics(aggregate: Aggregate, output_filepath: str) -> str:
+    """
+    Serialize aggregate in the format of `hercules combine`.
+
+    :param aggregate: merged statistics.
+    :param output_filepath: path to store results.
+    :return: output_filepath.
+    """
+    with metrics.measure("merge", repository=output_filepath, children=False, engine="python",
+                         inputs=len(aggregate.repositories)):
+        data = aggregate.serialize()
+        with open(output_filepath, "wb") as f:
+            f.write(data)
+    return output_filepath
+
+
+def combine(stat_locs: Sequence[str], output_filepath: str, batch_size: int = MERGE_BATCH_SIZE,
+            n_cores: int = MERGE_CORES) -> str:
+    """
+    Merge statistics in-process: batches are decoded and merged in parallel, their serialized
+    partial aggregates are merged in memory and serialized once.
+
+    :param stat_locs: locations of statistics.
+    :param output_filepath: path to store results.
+    :param batch_size: number of statistics decoded by one worker at once.
+    :param n_cores: number of workers.
+    :return: output_filepath.
+    """
+    batches = [stat_locs[start:start + batch_size]
+               for start in range(0, len(stat_locs), batch_size)]
+    aggregate = Aggregate()
+    if n_cores <= 1 or len(batches) <= 1:
+        for batch in batches:
+            aggregate.update(read_statistics(batch))
+    else:
+        with Pool(min(n_cores, len(batches)), initializer=metrics.configure,
+                  initargs=metrics.initargs()) as p:
+            for partial in p.imap_unordered(read_serialized, batches):
+                aggregate.add_serialized(partial)
+    return write_statistics(aggregate, output_filepath)
@@ -0,0 +1,305 @@
+"""Clone, analyse and (optionally) delete each repository as soon as it's listed."""
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging as log
+import multiprocessing
+from multiprocessing import Pool
+import os
+import shutil
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+from org_analysis import metrics
+from org_analysis.admission import admit_jobs, memory_per_byte
+from org_analysis.cloning import AdaptiveLimit, clone_with_retries, CloneOutcomes, RetryPolicy
+from org_analysis.defaults import AGGREGATED_STATISTICS_NAME, CLONE_BACKOFF, \
+    CLONE_OUTCOMES_NAME, CLONE_RETRIES, CLONE_THREADS, CLONES_DIR, CSV_NAME, \
+    DIRECTORY_FIELD_NAME, GITHUB_API_URL, GITHUB_TOKEN_ENV_VAR, HERCULES_EXEC, HISTORY_NAME, \
+    LISTING_CACHE_NAME, LISTING_THREADS, LISTING_TIMEOUT, MAX_IN_FLIGHT, MEMORY_BUDGET, \
+    MERGE_BATCH_SIZE, MERGE_CORES, MERGE_ENGINE, MERGE_WORK_SUFFIX, N_CORES, PROFILE, \
+    RESULTS_LOG_NAME, SHARDS, SIZE_LIMIT, STATISTICS_DIR, TIMEOUT, URL_FIELD_NAME
+from org_analysis.download_repos import make_repo_dest_dir
+from org_analysis.hercules_statistics import add_analysis_args, job_arguments, job_processes, \
+    MERGE_ENGINES, ordered_jobs, ReportStat, repository_statistics_multiprocessing, \
+    skipped_result, StreamingMerger
+from org_analysis.history import RunHistory
+from org_analysis.listing import list_repositories, make_session
+from org_analysis.manifest import ManifestWriter, ResultsLog
+from org_analysis.scheduling import seconds_per_byte
+from org_analysis.triage import RepoInfo, skip_reason, triage_repository
+from org_analysis.utils import add_metrics_args, ArgumentDefaultsHelpFormatterNoNone, \
+    filter_kwargs
+
+
+def pipeline_handler(login: str, password: str, token_env: str, organization: str, output: str,
+                     clone_threads: int = CLONE_THREADS, n_cores: int = N_CORES,
+                     max_in_flight: int = MAX_IN_FLIGHT, evict: bool = False,
+                     force: bool = False, update: bool = False,
+                     hercules_exec: str = HERCULES_EXEC, size_limit: int = SIZE_LIMIT,
+                     timeout: float = TIMEOUT, n_samples: int = -1,
+                     merge_cores: int = MERGE_CORES, merge_engine: str = MERGE_ENGINE,
+                     memory_budget: int = MEMORY_BUDGET, shards: int = SHARDS,
+                     profile: str = PROFILE, split_analyses: bool = False,
+                     retries: int = CLONE_RETRIES, backoff: float = CLONE_BACKOFF,
+                     api_url: str = GITHUB_API_URL, listing_threads: int = LISTING_THREADS,
+                     listing_timeout: float = LISTING_TIMEOUT,
+                     aggregated_statistics_name: str = AGGREGATED_STATISTICS_NAME,
+                     csv_name: str = CSV_NAME, url_field_name: str = URL_FIELD_NAME,
+                     directory_field_name: str = DIRECTORY_FIELD_NAME, metrics_path: str = None,
+                     prometheus_textfile: str = None) -> None:
+    """
+    Pipeline where each repository flows through clone -> analysis -> (optional) deletion of clone.
+
+    Cloning (with retries and adaptive concurrency) and triage run on thread pool - they wait for
+    network and git. Cloned repositories are analysed on process pool with the same job
+    arguments, longest-first order and memory-aware admission as in `hercules_handler`, statistics
+    are merged in batches while the rest is being cloned and analysed.
+
+    :param login: login or GitHub token.
+    :param password: GitHub password.
+    :param token_env: environment variable to store GitHub token.
+    :param organization: organization or user name.
+    :param output: output directory: clones, statistics of repositories, aggregated statistics.
+    :param clone_threads: max number of concurrent clones. Actual concurrency adapts to
+                          throughput and transient failures between 1 and this number.
+    :param n_cores: number of concurrent hercules processes. If <= 0 - all cores will be used.
+    :param max_in_flight: max number of repositories which are cloned or waiting for analysis -
+                          it bounds disk usage with `evict`. If <= 0 -
+                          2 * (clone_threads + n_cores).
+    :param evict: delete clone after its statistics are calculated.
+    :param force: clone repositories and calculate statistics again even if they exist.
+    :param update: fetch new objects and refs into existing clones.
+    :param hercules_exec: hercules executable location.
+    :param size_limit: max size of repo to process in bytes. If <= 0 no filtering will be applied.
+    :param timeout: max duration of each hercules run (analysis or combine) in seconds. If <= 0 -
+                    no limit.
+    :param n_samples: number of statistics to combine together. If <= 0 - `MERGE_BATCH_SIZE`.
+    :param merge_cores: how many merges to run concurrently with analysis.
+    :param merge_engine: "hercules" - merge with `hercules combine`, "python" - merge in-process.
+    :param memory_budget: total memory of concurrent hercules processes in bytes. If <= 0 - only
+                          `n_cores` limits concurrency.
+    :param shards: repositories over `size_limit` are analysed by this number of parallel hercules
+                   runs over segments of history. If <= 0 - they are skipped.
+    :param profile: name of analysis profile - set of hercules analyses.
+    :param split_analyses: run independent analyses of the profile as concurrent hercules
+                           processes per repository and splice their statistics.
+    :param retries: how many times to retry clone after transient failure.
+    :param backoff: base delay before retry of clone in seconds.
+    :param api_url: root of GitHub API.
+    :param listing_threads: number of concurrent requests to list repositories.
+    :param listing_timeout: max time to wait for connection and for each read of GitHub API
+                            response in seconds.
+    :param aggregated_statistics_name: name of file to store aggregated statistics.
+    :param csv_name: name of CSV with repositories left on disk (not written with `evict`).
+    :param url_field_name: name of URL field in CSV.
+    :param directory_field_name: name of directory field in CSV.
+    :param metrics_path: JSONL file to append metrics of each stage to. If None - no metrics.
+    :param prometheus_textfile: Prometheus textfile to write metrics of the run aggregated by
+                                stage to (requires `metrics_path`).
+    """
+    metrics.configure(metrics_path)
+    output = os.path.abspath(output)
+    clones_dir = os.path.join(output, CLONES_DIR)
+    statistics_dir = os.path.join(output, STATISTICS_DIR)
+    os.makedirs(clones_dir, exist_ok=True)
+    os.makedirs(statistics_dir, exist_ok=True)
+    history = RunHistory(os.path.join(output, HISTORY_NAME))
+    rate, ratio = seconds_per_byte(history), memory_per_byte(history)
+    session = make_session(login=login, password=password, token_env=token_env,
+                           pool_size=listing_threads)
+    repositories = list_repositories(organization, session, api_url=api_url,
+                                     cache_path=os.path.join(output, LISTING_CACHE_NAME),
+                                     n_threads=listing_threads, timeout=listing_timeout)
+    n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
+    clone_threads = clone_threads if clone_threads > 0 else CLONE_THREADS
+    max_in_flight = max_in_flight if max_in_flight > 0 else 2 * (clone_threads + n_cores)
+    batch_size = n_samples if n_samples > 0 else MERGE_BATCH_SIZE
+    result_filepath = os.path.join(output, aggregated_statistics_name)
+    outcomes = CloneOutcomes(os.path.join(output, CLONE_OUTCOMES_NAME))
+    policy, limit = RetryPolicy(retries=retries, backoff=backoff), AdaptiveLimit(clone_threads)
+    options = {"output_dir": statistics_dir, "force": force, "hercules_exec": hercules_exec,
+               "size_limit": size_limit, "shards": shards, "profile": profile,
+               "split_analyses": split_analyses}
+
+    def clone_and_triage(repo_url: str, dest: str) -> Tuple[str, Optional[RepoInfo]]:
+        # runs in clone thread - triage is a few git commands, cheap compared to hercules
+        try:
+            dest = clone_with_retries(repo_url, dest=dest, force=force, update=update,
+                                      policy=policy, limit=limit, outcomes=outcomes)
+        except Exception as e:
+            log.error(f"Repository {repo_url} failed with exception {e} at cloning step")
+            dest = None
+        return repo_url, triage_repository(dest) if dest else None
+
+    # results are spilled to disk, so memory doesn't grow with the number of repositories
+    with ThreadPoolExecutor(clone_threads) as cloner, \
+            Pool(n_cores, initializer=metrics.configure, initargs=metrics.initargs()) as p, \
+            StreamingMerger(hercules_exec=hercules_exec, batch_size=batch_size,
+                            n_cores=merge_cores, engine=merge_engine,
+                            work_dir=result_filepath + MERGE_WORK_SUFFIX,
+                            timeout=timeout) as merger, \
+            ResultsLog(os.path.join(output, RESULTS_LOG_NAME)) as results, \
+            tqdm(unit="repo", desc="repositories") as progress:
+        cloning: Set[Future] = set()
+        # URL of each cloned repository which is waiting for analysis or being analysed
+        cloned = {}
+
+        def finish(record: Dict[str, Any], repo_url: str, dest: Optional[str]) -> None:
+            results.append({**record, "repo_url": repo_url, "dest": dest})
+            if record["stat_loc"]:
+                merger.add(record["stat_loc"])
+            if evict and dest:
+                shutil.rmtree(dest, ignore_errors=True)
+            progress.update()
+
+        def jobs() -> Iterator[Optional[Tuple[Dict[str, Any], int]]]:
+            listed = iter(repositories)
+            while True:
+                while listed is not None and len(cloning) + len(cloned) < max_in_flight:
+                    repo = next(listed, None)
+                    if repo is None:
+                        listed = None
+                        break
+                    cloning.add(cloner.submit(clone_and_triage, repo.git_url,
+                                              make_repo_dest_dir(repo, clones_dir)))
+                done = {future for future in cloning if future.done()}
+                if not done:
+                    if listed is None and not cloning:
+                        return
+                    # clones are in progress or analyses hold all slots of `max_in_flight`
+                    yield None
+                    continue
+                cloning.difference_update(done)
+                arguments = []
+                for future in done:
+                    repo_url, info = future.result()
+                    if info is None:
+                        finish({**ReportStat(repo_size=0, duration=0, repository=repo_url,
+                                             err="Cloning failed")._asdict(),
+                                "stat_loc": None}, repo_url, None)
+                        continue
+                    reason = skip_reason(info)
+                    if reason:
+                        finish(skipped_result(info, reason), repo_url, info.repository)
+                        continue
+                    cloned[info.repository] = repo_url
+                    arguments.append(job_arguments(info, repo_url, history, timeout, **options))
+                # the longest of cloned repositories go first, admitted within memory budget
+                yield from ordered_jobs(arguments, history, rate, ratio)
+
+        try:
+            for stat, stat_loc in admit_jobs(p, repository_statistics_multiprocessing, jobs(),
+                                             budget=memory_budget, max_in_flight=n_cores,
+                                             processes=job_processes):
+                finish({**stat._asdict(), "stat_loc": stat_loc}, cloned.pop(stat.repository),
+                       stat.repository)
+        finally:
+            outcomes.save()
+        log.info("Finish merging of statistics...")
+        final_stat = merger.finish(result_filepath)
+    n_total = n_cloned = n_analysed = 0
+    for record in results:
+        n_total += 1
+        if not record["dest"]:
+            continue
+        n_cloned += 1
+        stat = ReportStat(**{field: record[field] for field in ReportStat._fields})
+        n_analysed += not stat.err
+        metrics.emit("repository", repository=stat.repository, wall_time=stat.duration,
+                     exit_status=int(bool(stat.err)), repo_size=stat.repo_size, err=stat.err,
+                     analysed=stat.analysed)
+        if stat.analysed:
+            history.update(stat.repository, duration=stat.duration, repo_size=stat.repo_size,
+                           peak_rss=stat.peak_rss, first_parent=stat.first_parent,
+                           timed_out_key=stat.key if stat.timed_out else "",
+                           timed_out_after=timeout if stat.timed_out else 0)
+    history.save()
+    log.info(f"{n_cloned} repositories out of {n_total} cloned, {n_analysed} analysed "
+             f"successfully")
+    if not evict:
+        csv_loc = os.path.join(output, csv_name)
+        with ManifestWriter(csv_loc, url_field_name, directory_field_name) as manifest:
+            for record in results:
+                if record["dest"]:
+                    manifest.write(record["repo_url"], record["dest"])
+        log.info(f"{csv_loc} is written.")
+    if metrics_path and prometheus_textfile:
+        metrics.write_prometheus(metrics_path, prometheus_textfile)
+    if final_stat:
+        log.info("Success!")
+        log.info(f"Aggregated statistics is stored at {final_stat}")
+
+
+def add_pipeline_args(parser: argparse.ArgumentParser):
+    parser.add_argument("-n", "--organization", help="Organization name.", required=True)
+    parser.add_argument("-o", "--output", required=True,
+                        help="Path to the directory where to store repositories, statistics and "
+                             "aggregated statistics.")
+    parser.add_argument("-l", "--login", default=None, help="Login or token.")
+    parser.add_argument("-p", "--password", default=None, help="Password.")
+    parser.add_argument("--token-env", default=GITHUB_TOKEN_ENV_VAR,
+                        help="Environment variable for GitHub token.")
+    parser.add_argument("--clone-threads", default=CLONE_THREADS, type=int,
+                        help="Max number of concurrent clones - concurrency adapts to throughput "
+                             "and transient failures below it.")
+    parser.add_argument("--retries", default=CLONE_RETRIES, type=int,
+                        help="How many times to retry clone after transient failure.")
+    parser.add_argument("--backoff", default=CLONE_BACKOFF, type=float,
+                        help="Base delay before retry of clone in seconds - it's doubled with "
+                             "each attempt and randomized.")
+    parser.add_argument("-c", "--n-cores", default=N_CORES, type=int,
+                        help="Number of concurrent hercules processes. If <= 0 - all cores will "
+                             "be used.")
+    parser.add_argument("--max-in-flight", default=MAX_IN_FLIGHT, type=int,
+                        help="Max number of repositories which are being cloned or wait for "
+                             "analysis. If <= 0 - 2 * (clone threads + cores).")
+    parser.add_argument("--evict", action="store_true",
+                        help="Delete clone as soon as its statistics are calculated - disk usage "
+                             "is bounded by --max-in-flight repositories.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Clone repositories and calculate statistics again.")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Fetch new commits into already cloned repositories.")
+    parser.add_argument("--hercules-exec", default=HERCULES_EXEC, help="Hercules executable.")
+    parser.add_argument("-s", "--size-limit", default=SIZE_LIMIT, type=int,
+                        help="Max size of repo to process in bytes. If <= 0 no filtering will be "
+                             "applied.")
+    add_analysis_args(parser)
+    parser.add_argument("--timeout", default=TIMEOUT, type=float,
+                        help="Max duration of each hercules run (analysis or combine) in seconds. "
+                             "If <= 0 - no limit.")
+    parser.add_argument("--n-samples", "--merge-fan-in", default=-1, type=int,
+                        help="Max number of repos to combine together. "
+                             f"If <= 0 - {MERGE_BATCH_SIZE} is used.")
+    parser.add_argument("--merge-cores", default=MERGE_CORES, type=int,
+                        help="How many merges to run concurrently with analysis.")
+    parser.add_argument("--merge-engine", default=MERGE_ENGINE, choices=MERGE_ENGINES,
+                        help="\"hercules\" - merge with `hercules combine` subprocesses, "
+                             "\"python\" - merge in-process.")
+    parser.add_argument("--api-url", default=GITHUB_API_URL, help="Root of GitHub API.")
+    parser.add_argument("--listing-threads", default=LISTING_THREADS, type=int,
+                        help="Number of concurrent requests to list repositories.")
+    parser.add_argument("--listing-timeout", default=LISTING_TIMEOUT, type=float,
+                        help="Seconds to wait for connection and for each read of GitHub API "
+                             "response. Timed out requests are retried.")
+    add_metrics_args(parser)
+    parser.add_argument("--aggregated-statistics-name", default=AGGREGATED_STATISTICS_NAME,
+                        help="Name of file to store aggregated statistics.")
+    parser.add_argument("--csv-name", default=CSV_NAME,
+                        help="Name of csv with cloned repositories (not written with --evict).")
+    parser.add_argument("--url-field-name", default=URL_FIELD_NAME,
+                        help="Name of URL field in CSV (GitHub URL).")
+    parser.add_argument("--directory-field-name", default=DIRECTORY_FIELD_NAME,
+                        help="Name of directory field in CSV (it contains path to repository).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatterNoNone)
+    parser.add_argument("--log-level", default="INFO", choices=log._nameToLevel,
+                        help="Logging verbosity.")
+    add_pipeline_args(parser)
+    args = parser.parse_args()
+    log.getLogger().setLevel(args.log_level)
+    pipeline_kwargs = filter_kwargs(vars(args), pipeline_handler)
+    pipeline_handler(**pipeline_kwargs)
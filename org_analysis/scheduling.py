@@ -0,0 +1,57 @@
+"""Order hercules jobs to minimize total runtime (longest expected job first)."""
+from statistics import median
+from typing import Any, Dict, List, Sequence
+
+from org_analysis.defaults import SECONDS_PER_BYTE
+from org_analysis.history import RunHistory
+
+
+def seconds_per_byte(history: RunHistory, default: float = SECONDS_PER_BYTE) -> float:
+    """
+    Estimate processing speed from previous runs.
+
+    :param history: observations from previous runs.
+    :param default: value to use if there are no observations.
+    :return: median duration of processing per byte of repository.
+    """
+    rates = [record["duration"] / record["repo_size"] for record in history.records.values()
+             if record.get("repo_size") and "duration" in record]
+    return median(rates) if rates else default
+
+
+def expected_duration(repository: str, repo_size: int, history: RunHistory,
+                      rate: float) -> float:
+    """
+    Estimate duration of hercules run for repository.
+
+    :param repository: repository location.
+    :param repo_size: size of repository in bytes.
+    :param history: observations from previous runs.
+    :param rate: seconds per byte for repositories without observations.
+    :return: expected duration in seconds.
+    """
+    record = history.get(repository)
+    if "duration" in record:
+        # scale previous duration if repository has grown since then
+        if record.get("repo_size"):
+            return record["duration"] * max(repo_size / record["repo_size"], 1)
+        return record["duration"]
+    return repo_size * rate
+
+
+def longest_first(arguments: Sequence[Dict[str, Any]], history: RunHistory,
+                  rate: float = None) -> List[Dict[str, Any]]:
+    """
+    Sort arguments of `repository_statistics` by expected duration in descending order, so huge
+    repositories don't become stragglers at the end of the run.
+
+    :param arguments: arguments of `repository_statistics` with `repo_loc` and `repo_size`.
+    :param history: observations from previous runs.
+    :param rate: seconds per byte for repositories without observations. If None - it's estimated
+                 from `history`.
+    :return: sorted arguments.
+    """
+    rate = seconds_per_byte(history) if rate is None else rate
+    return sorted(arguments, reverse=True,
+                  key=lambda kwargs: expected_duration(kwargs["repo_loc"], kwargs["repo_size"],
+                                                       history, rate))
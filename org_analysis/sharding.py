@@ -0,0 +1,215 @@
+"""Analysis of repositories over the size limit split by history into parallel hercules runs.
+
+Developers statistics are additive over commits, so `--devs` is calculated for segments of the
+first-parent history in parallel (`hercules --commits`). Hercules treats the first commit of a run
+as if it added the whole tree, so every segment starts with the last commit of the previous one
+(its base) and statistics of the first tick of the segment are dropped. History is cut only after
+ticks which separate it - every earlier commit is in an earlier tick and every later commit is in
+a later one - so the first tick of a segment holds only its base, and the other commits get the
+same ticks as in a single run. Identities of developers are detected over the whole history the
+same way as hercules does and passed to every segment with `--people-dict`, so commits of one
+developer are matched across segments.
+
+Burndown and couples depend on the whole history of every line and hercules can't start from a
+state of lines at a boundary of segments - they are calculated by one more run over the whole
+first-parent history in parallel with the segments.
+
+Stitched statistics are equivalent to a single run with `--first-parent`. Identities merged by
+`.mailmap` can't be reproduced, so a repository with `.mailmap` in HEAD is analysed by one run.
+"""
+from bisect import bisect_left
+import logging as log
+import os
+import shutil
+import subprocess
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from org_analysis.triage import git_output
+from org_analysis.utils import check_call_with_rusage, check_calls_with_rusage
+
+DEVS_FLAG = "--devs"
+WHOLE_HISTORY_FLAGS = ("--burndown", "--burndown-people", "--couples")  # not decomposable
+
+
+class Commit(NamedTuple):
+    hash: str
+    tick: int  # committer time in ticks since epoch - hercules' ticks are counted by it
+    name: str  # author
+    email: str
+
+
+def first_parent_history(repo_loc: str, tick: int) -> List[Commit]:
+    """
+    First-parent history of HEAD from the oldest commit.
+
+    :param repo_loc: location of repository.
+    :param tick: duration of tick in seconds.
+    :return: commits.
+    """
+    history = []
+    for line in git_output(repo_loc, "log", "--first-parent", "--reverse",
+                           "--format=%H%x00%ct%x00%an%x00%ae", "HEAD").splitlines():
+        hash, timestamp, name, email = line.split("\0")
+        history.append(Commit(hash, int(timestamp) // tick, name, email))
+    return history
+
+
+def has_mailmap(repo_loc: str) -> bool:
+    """Check if HEAD of repository has `.mailmap`."""
+    try:
+        git_output(repo_loc, "cat-file", "-e", "HEAD:.mailmap")
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def people_dict(history: Sequence[Commit]) -> List[str]:
+    """
+    Detect identities of developers like hercules does without `--people-dict`: lowercase names
+    and emails of authors are matched in order of history.
+
+    :param history: commits from the oldest one.
+    :return: identities in order of hercules' index of developers - sorted names and sorted emails
+             joined with "|" (the same as names of developers in hercules output).
+    """
+    ids, names, emails = {}, [], []
+    for commit in history:
+        name, email = commit.name.lower(), commit.email.lower()
+        if email in ids:
+            if name not in ids:
+                ids[name] = ids[email]
+                names[ids[email]].append(name)
+        elif name in ids:
+            ids[email] = ids[name]
+            emails[ids[name]].append(email)
+        else:
+            ids[email] = ids[name] = len(names)
+            names.append([name])
+            emails.append([email])
+    return ["|".join(sorted(group_names) + sorted(group_emails))
+            for group_names, group_emails in zip(names, emails)]
+
+
+def segments(history: Sequence[Commit], n_segments: int
+             ) -> List[Tuple[Optional[Commit], List[Commit]]]:
+    """
+    Split history into segments of similar length between ticks which separate it.
+
+    :param history: commits from the oldest one.
+    :param n_segments: max number of segments. There are fewer if history has fewer such ticks.
+    :return: (base commit - the last commit of the previous segment or None, commits) of each
+             segment. Commits of segment start with its base commit.
+    """
+    # base may end segment if its tick is the latest so far and is before the rest of history
+    latest, earliest = [], []
+    for commit in history:
+        latest.append(max(commit.tick, latest[-1]) if latest else commit.tick)
+    for commit in reversed(history):
+        earliest.append(min(commit.tick, earliest[-1]) if earliest else commit.tick)
+    earliest.reverse()
+    bases = [i for i in range(len(history) - 1)
+             if history[i].tick == latest[i] < earliest[i + 1]]
+    cuts = set()
+    for i in range(1, max(n_segments, 1)):
+        target = len(history) * i // n_segments - 1
+        pos = bisect_left(bases, target)
+        nearest = [bases[j] for j in (pos - 1, pos) if 0 <= j < len(bases)]
+        if nearest:
+            cuts.add(min(nearest, key=lambda base: abs(base - target)))
+    starts = [0] + sorted(cuts)
+    ends = sorted(cuts) + [len(history) - 1]
+    return [(history[start] if i else None, list(history[start:end + 1]))
+            for i, (start, end) in enumerate(zip(starts, ends))]
+
+
+def sharded_processes(cmd: Sequence[str], n_segments: int) -> int:
+    """Max number of concurrent hercules runs of `sharded_statistics`."""
+    if DEVS_FLAG not in cmd or n_segments < 2:
+        return 1
+    return n_segments + any(flag in cmd for flag in WHOLE_HISTORY_FLAGS)
+
+
+def _run(cmd: List[str], output: str, timeout: float) -> int:
+    with open(output, "wb") as f:
+        rusage = check_call_with_rusage(cmd, stdout=f, timeout=timeout)
+    return rusage.ru_maxrss * 1024
+
+
+def _lines_file(work_dir: str, name: str, lines: Sequence[str]) -> str:
+    path = os.path.join(work_dir, name)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def sharded_statistics(cmd: List[str], repo_loc: str, stat_loc: str, n_segments: int,
+                       timeout: float = None) -> int:
+    """
+    Calculate statistics of repository with parallel hercules runs and stitch them.
+
+    :param cmd: hercules command without repository location (with `--pb`).
+    :param repo_loc: location of repository.
+    :param stat_loc: where to store stitched statistics.
+    :param n_segments: max number of segments of history to calculate developers statistics (see
+                       `sharded_processes` for the number of runs).
+    :param timeout: max duration of each hercules run in seconds. If <= 0 - no limit.
+    :return: sum of peak RSS of hercules runs in bytes (they run concurrently).
+    :raises subprocess.CalledProcessError: if one of hercules runs failed (the rest are killed).
+    :raises subprocess.TimeoutExpired: if one of hercules runs was killed because of timeout.
+    :raises UnsupportedStatistics: if statistics can't be stitched in-process.
+    """
+    from org_analysis.pb_merge import DAY, Devs, message_types, read_statistics, \
+        write_statistics
+
+    message_types()  # fail early if statistics can't be decoded
+    history = first_parent_history(repo_loc, DAY)
+    parts = []
+    if DEVS_FLAG in cmd and n_segments > 1:
+        if has_mailmap(repo_loc):
+            log.warning(f"{repo_loc}: identities of .mailmap can't be matched across segments "
+                        f"of history - analysing it by one run")
+        else:
+            parts = segments(history, n_segments)
+    if len(parts) < 2:
+        return _run(cmd + ["--first-parent", repo_loc], stat_loc, timeout)
+    work_dir = stat_loc + ".segments"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    try:
+        runs, added = [], []
+        whole_history = any(flag in cmd for flag in WHOLE_HISTORY_FLAGS)
+        if whole_history:
+            whole = [arg for arg in cmd if arg != DEVS_FLAG]
+            runs.append((whole + ["--first-parent", repo_loc], os.path.join(work_dir, "whole.pb")))
+        identities = people_dict(history)
+        devs = [arg for arg in cmd if arg not in WHOLE_HISTORY_FLAGS]
+        devs += ["--people-dict", _lines_file(work_dir, "people", identities)]
+        for i, (_, commits) in enumerate(parts):
+            added.append(os.path.join(work_dir, f"segment_{i}.pb"))
+            commits_file = _lines_file(work_dir, f"segment_{i}", [c.hash for c in commits])
+            runs.append((devs + ["--commits", commits_file, repo_loc], added[-1]))
+        log.info(f"{repo_loc}: {len(added)} segments of history are analysed in parallel")
+        peak_rss = sum(rusage.ru_maxrss * 1024
+                       for rusage in check_calls_with_rusage(runs, timeout=timeout))
+        if whole_history:
+            aggregate = read_statistics([runs[0][1]])
+        else:
+            # header of the whole history from the first and the last segments
+            aggregate = read_statistics([added[0]])
+            last = read_statistics([added[-1]])
+            aggregate.end, aggregate.commits = last.end, len(history)
+        stitched = Devs()
+        for (base, _), location in zip(parts, added):
+            segment = read_statistics([location])
+            devs = segment.analyses.get("Devs", Devs())
+            if base is not None:
+                # base was analysed as if it added the whole tree - its tick is the first one
+                devs.drop_tick(segment.begin // segment.tick)
+            stitched.update(devs)
+        # developers of `--people-dict` are named by their first name
+        stitched.rename({identity.split("|")[0]: identity for identity in identities})
+        aggregate.analyses["Devs"] = stitched
+        write_statistics(aggregate, stat_loc)
+        return peak_rss
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,133 @@
+"""Cheap per-repository metadata collected with git before running hercules."""
+from datetime import datetime
+import multiprocessing
+from multiprocessing import Pool
+import subprocess
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Tuple
+
+import tqdm
+
+from org_analysis import metrics
+from org_analysis.defaults import N_CORES, TRIAGE_CHUNKSIZE
+
+RepoInfo = NamedTuple("RepoInfo",
+                      (("repository", str),
+                       ("size", int),
+                       ("n_commits", int),
+                       ("first_commit", int),
+                       ("last_commit", int),
+                       ("empty", bool),
+                       ("err", str)))
+
+
+def git_output(repo_loc: str, *args: str) -> str:
+    """
+    Run git command against repository and return its standard output.
+
+    :param repo_loc: location of (bare) repository.
+    :param args: git subcommand and its arguments.
+    :return: decoded standard output.
+    """
+    cmd = ["git", "--git-dir", repo_loc]
+    cmd.extend(args)
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode("utf-8", "replace")
+
+
+def packed_size(repo_loc: str) -> int:
+    """
+    Measure size of repository objects using git's own accounting (loose and packed objects).
+
+    :param repo_loc: location of repository.
+    :return: size in bytes.
+    """
+    stats = {}
+    for line in git_output(repo_loc, "count-objects", "-v").splitlines():
+        key, _, value = line.partition(":")
+        stats[key.strip()] = value.strip()
+    # both values are reported in KiB
+    return (int(stats.get("size", 0)) + int(stats.get("size-pack", 0))) * 1024
+
+
+def has_head(repo_loc: str) -> bool:
+    """Check if HEAD of repository points to a commit (it doesn't in empty repository)."""
+    return subprocess.run(["git", "--git-dir", repo_loc, "rev-parse", "--verify", "-q",
+                           "HEAD^{commit}"], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).returncode == 0
+
+
+def triage_repository(repo_loc: str) -> RepoInfo:
+    """
+    Collect size, number of commits and first/last commit dates of repository. Commits are
+    counted over the history of HEAD - hercules analyses it, other refs don't affect results.
+
+    :param repo_loc: location of repository.
+    :return: RepoInfo. `err` is not empty if git failed - other fields are zeros in this case.
+    """
+    try:
+        with metrics.measure("sizing", repository=repo_loc):
+            size = packed_size(repo_loc)
+            timestamps = []
+            if has_head(repo_loc):
+                timestamps = [int(ts) for ts in git_output(repo_loc, "log", "--format=%ct",
+                                                           "HEAD").split()]
+    except (subprocess.CalledProcessError, ValueError) as e:
+        err = f"Repository {repo_loc} failed with exception {e} at triage step"
+        return RepoInfo(repository=repo_loc, size=0, n_commits=0, first_commit=0, last_commit=0,
+                        empty=False, err=err)
+    return RepoInfo(repository=repo_loc, size=size, n_commits=len(timestamps),
+                    first_commit=min(timestamps, default=0),
+                    last_commit=max(timestamps, default=0), empty=not timestamps, err="")
+
+
+def skip_reason(info: RepoInfo) -> str:
+    """
+    Decide if repository should not be passed to hercules.
+
+    :param info: result of `triage_repository`.
+    :return: reason to skip repository or empty string if it should be analysed.
+    """
+    if info.err:
+        return info.err
+    if info.empty:
+        return f"Repository {info.repository} has no commits at HEAD - skipping"
+    if datetime.utcfromtimestamp(info.first_commit).strftime("%Y-%m-%d") == "1970-01-01":
+        return f"Bad date at repository {info.repository} - skipping"
+    return ""
+
+
+def triage_repositories(repo_locs: Iterable[str], n_cores: int = N_CORES,
+                        chunksize: int = TRIAGE_CHUNKSIZE) -> Dict[str, RepoInfo]:
+    """
+    Collect metadata for multiple repositories in parallel.
+
+    :param repo_locs: locations of repositories.
+    :param n_cores: how many cores to use. If <= 0 - all cores will be used.
+    :param chunksize: number of repositories sent to worker at once.
+    :return: mapping from repository location to RepoInfo.
+    """
+    repo_locs = list(repo_locs)
+    n_cores = n_cores if n_cores > 0 else multiprocessing.cpu_count()
+    with Pool(n_cores, initializer=metrics.configure, initargs=metrics.initargs()) as p:
+        return {info.repository: info
+                for info in tqdm.tqdm(p.imap_unordered(triage_repository, repo_locs,
+                                                       chunksize=chunksize),
+                                      total=len(repo_locs), desc="triage")}
+
+
+def _triage_entry(entry: Tuple[str, Any]) -> Tuple[RepoInfo, Any]:
+    repo_loc, payload = entry
+    return triage_repository(repo_loc), payload
+
+
+def iter_triage(entries: Iterable[Tuple[str, Any]], pool: Pool,
+                chunksize: int = TRIAGE_CHUNKSIZE) -> Iterator[Tuple[RepoInfo, Any]]:
+    """
+    Collect metadata for repositories as they are read, in order of completion.
+
+    :param entries: locations of repositories with arbitrary payload passed through.
+    :param pool: process pool. It consumes `entries` eagerly, so pass bounded windows of them.
+    :param chunksize: number of repositories sent to worker at once.
+    :return: iterator over (RepoInfo, payload).
+    """
+    return pool.imap_unordered(_triage_entry, entries, chunksize=chunksize)
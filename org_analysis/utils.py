@@ -1,19 +1,25 @@
 import argparse
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import inspect
 import io
 import os
 import logging as log
-import requests
+import multiprocessing
+import resource
 import shutil
+import signal
 from shutil import copyfileobj
 import subprocess
 import tarfile
+import tempfile
+import threading
+from time import time
+from typing import List, Sequence, Set, Tuple
 from urllib.request import urlopen
 import gzip
 
-from github import Github
-
-from org_analysis.defaults import GITHUB_TOKEN_ENV_VAR, HERCULES_EXEC
+from org_analysis import metrics
+from org_analysis.defaults import HERCULES_EXEC, START_METHOD, WORKER_MODULES
 
 
 class ArgumentDefaultsHelpFormatterNoNone(argparse.ArgumentDefaultsHelpFormatter):
@@ -27,48 +33,284 @@ class ArgumentDefaultsHelpFormatterNoNone(argparse.ArgumentDefaultsHelpFormatter
         return super()._get_help_string(action)
 
 
-def init_github(login_or_token: str = None, password: str = None,
-                token_env: str = GITHUB_TOKEN_ENV_VAR) -> Github:
+def add_metrics_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics", dest="metrics_path", default=None,
+                        help="JSONL file to append metrics of each stage to (wall and CPU time, "
+                             "peak RSS, bytes read/written, exit status).")
+    parser.add_argument("--prometheus-textfile", default=None,
+                        help="Prometheus textfile to write metrics of the run aggregated by stage "
+                             "to. Requires --metrics.")
+
+
+def add_start_method_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--start-method", default=START_METHOD,
+                        choices=multiprocessing.get_all_start_methods(),
+                        help="How worker processes are started. Workers started by forkserver "
+                             "fork from a server which imported worker modules once. Default of "
+                             "platform is used if not given.")
+
+
+def configure_workers(start_method: str = START_METHOD,
+                      preload: Sequence[str] = WORKER_MODULES) -> None:
     """
-    Initialize entrypoint to access Github API v3.
+    Choose how worker processes of pools are started (call it before pools are created).
 
-    :param login_or_token: user/login or token.
-    :param password: password.
-    :param token_env: Environment variable for GitHub token.
-    :return: entrypoint to access Github API v3.
+    :param start_method: "fork", "spawn" or "forkserver". If None - default of platform is kept.
+    :param preload: modules imported once by forkserver before it forks workers.
     """
-    if login_or_token is None:
-        # Try to load token
-        login_or_token = os.getenv(token_env)
-    return Github(login_or_token=login_or_token, password=password)
+    if start_method is None:
+        return
+    multiprocessing.set_start_method(start_method, force=True)
+    if start_method == "forkserver":
+        multiprocessing.set_forkserver_preload(list(preload))
+
+
+FETCH_REFSPECS = ("+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+
+
+def run_git(cmd: List[str], usage: List[resource.struct_rusage]) -> None:
+    """
+    Run git command with output discarded and collect its resource usage.
+
+    :param cmd: command to run.
+    :param usage: resource usage of the command is appended to it (after failure too).
+    :raises subprocess.CalledProcessError: if command failed (its standard error is in `stderr`
+                                           attribute of exception).
+    """
+    # standard error goes to file - `check_call_with_rusage` doesn't read pipes while waiting
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            usage.append(check_call_with_rusage(cmd, stdout=subprocess.DEVNULL, stderr=stderr))
+        except subprocess.CalledProcessError as e:
+            usage.append(e.rusage)
+            stderr.seek(0)
+            e.stderr = stderr.read()
+            raise
+
+
+def total_rusage(usage: Sequence[resource.struct_rusage]) -> resource.struct_rusage:
+    """Resource usage of commands which ran one after another (None if there were none)."""
+    if not usage:
+        return None
+    values = [sum(values) for values in zip(*usage)]
+    values[2] = max(rusage.ru_maxrss for rusage in usage)
+    return resource.struct_rusage(values)
 
 
-def clone_repo(repo_url: str, dest: str = "", force: bool = True) -> str:
+def fetch_repo(repo_url: str, dest: str, usage: List[resource.struct_rusage] = None) -> bool:
+    """
+    Incrementally fetch all refs of repository into existing bare clone and prune deleted ones.
+
+    :param repo_url: repository URL.
+    :param dest: location of existing bare clone.
+    :param usage: resource usage of git commands is appended to it.
+    :return: True if repository was updated, False if existing clone is corrupted.
+    :raises subprocess.CalledProcessError: if fetch failed but existing clone is fine.
+    """
+    usage = usage if usage is not None else []
+    git = ["git", "--git-dir", dest]
+    try:
+        run_git(git + ["rev-parse", "--git-dir"], usage)
+    except subprocess.CalledProcessError:
+        return False
+    cmd = git + ["fetch", "--prune", "--force", "--quiet", repo_url]
+    cmd.extend(FETCH_REFSPECS)
+    try:
+        run_git(cmd, usage)
+        return True
+    except subprocess.CalledProcessError as e:
+        # only a clone with broken objects deserves full re-clone - network errors are reported
+        try:
+            run_git(git + ["fsck", "--connectivity-only", "--no-progress"], usage)
+        except subprocess.CalledProcessError:
+            return False
+        raise e
+
+
+def clone_repo(repo_url: str, dest: str = "", force: bool = True, update: bool = False,
+               reference: str = None, check: bool = False) -> str:
     """
     Clone repository to destination (if it was given).
 
     :param repo_url: repository URL.
     :param dest: destination directory.
     :param force: force to clone repository even if it's exist already.
+    :param update: if repository exists already (and not force) - fetch new objects and refs into
+                   it. Repository is cloned again only if existing clone is corrupted.
+    :param reference: shared object store to borrow objects from (via git alternates) - only
+                      missing objects are downloaded.
+    :param check: raise `subprocess.CalledProcessError` in case of errors instead of returning
+                  None (to decide if it's worth retrying).
     :return (destination location or None in case of errors, repo_url).
     """
-    cmd = f"git clone --bare {repo_url} {dest}".split()
+    cmd = ["git", "clone", "--bare"]
+    if reference:
+        cmd.extend(["--reference-if-able", reference])
+    cmd.extend([repo_url, dest])
+    # clones run on threads, so resource usage is collected per git process instead of
+    # RUSAGE_CHILDREN of the whole process
+    usage = []
+    start = time()
+    dest_dir = None
+    try:
+        dest_dir = _clone_repo(repo_url, dest, cmd, force=force, update=update, check=check,
+                               usage=usage)
+    finally:
+        metrics.emit("clone", repository=repo_url, wall_time=time() - start,
+                     rusage=total_rusage(usage), exit_status=int(dest_dir is None))
+    return dest_dir
+
+
+def _clone_repo(repo_url: str, dest: str, cmd: List[str], force: bool, update: bool,
+                check: bool, usage: List[resource.struct_rusage]) -> str:
     if os.path.isdir(dest):
         if force:
             shutil.rmtree(dest)
+        elif update:
+            try:
+                if fetch_repo(repo_url, dest, usage):
+                    return dest
+            except subprocess.CalledProcessError as e:
+                if check:
+                    raise
+                err = f"Repository {repo_url} failed with exception {e} at fetching step"
+                log.error(err)
+                log.error(e.stderr)
+                return None
+            log.warning(f"Repository {dest} is corrupted - clone it again")
+            shutil.rmtree(dest)
         else:
             return dest
     try:
-        subprocess.check_call(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        run_git(cmd, usage)
         return dest
     except subprocess.CalledProcessError as e:
+        if check:
+            raise
         err = f"Repository {repo_url} failed with exception {e} at clonning step"
         log.error(err)
-        log.error(e.stdout)
         log.error(e.stderr)
         return None
 
 
+# process groups of commands started by `check_call_with_rusage` which are still running
+_process_groups = set()
+KILL_POLL_INTERVAL = 0.1  # seconds between kills of commands which outlive failed sibling
+
+
+def kill_process_groups(pgids: Set[int] = _process_groups) -> None:
+    """
+    Kill commands started by `check_call_with_rusage` (with their children).
+
+    :param pgids: process groups to kill - all of this process by default.
+    """
+    for pgid in list(pgids):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _terminate(signum, frame) -> None:
+    kill_process_groups()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def kill_process_groups_on_sigterm() -> None:
+    """
+    Kill running commands when process is terminated. They run in their own sessions, so
+    otherwise they outlive pool worker killed by `Pool.terminate()`.
+    """
+    signal.signal(signal.SIGTERM, _terminate)
+
+
+def check_call_with_rusage(cmd, stdout=None, timeout: float = None, stderr=None,
+                           pgids: Set[int] = None) -> resource.struct_rusage:
+    """
+    Run command and collect resource usage of this child process only.
+
+    :param cmd: command to run.
+    :param stdout: where to redirect standard output.
+    :param timeout: max duration in seconds - the whole process group is killed after it. If None
+                    or <= 0 - no limit.
+    :param stderr: where to redirect standard error (not a pipe - it isn't read while waiting).
+    :param pgids: set to keep process group of command in while it runs, so it can be killed.
+    :return: resource usage of process (`ru_maxrss` is in kilobytes).
+    :raises subprocess.CalledProcessError: if command failed (resource usage is in `rusage`
+                                           attribute of exception).
+    :raises subprocess.TimeoutExpired: if command was killed because of timeout (resource usage is
+                                       in `rusage` attribute of exception).
+    """
+    # new session makes process a leader of its own group, so its children are killed too
+    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, start_new_session=True)
+    _process_groups.add(proc.pid)
+    if pgids is not None:
+        pgids.add(proc.pid)
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = None
+    if timeout is not None and timeout > 0:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    finally:
+        _process_groups.discard(proc.pid)
+        if pgids is not None:
+            pgids.discard(proc.pid)
+        if timer is not None:
+            timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if killed.is_set():
+        e = subprocess.TimeoutExpired(cmd, timeout)
+        e.rusage = rusage
+        raise e
+    if proc.returncode:
+        e = subprocess.CalledProcessError(proc.returncode, cmd)
+        e.rusage = rusage
+        raise e
+    return rusage
+
+
+def check_calls_with_rusage(runs: Sequence[Tuple[Sequence[str], str]],
+                            timeout: float = None) -> List[resource.struct_rusage]:
+    """
+    Run commands concurrently. Once one of them fails or times out the rest are killed - their
+    output is useless without it.
+
+    :param runs: (command, location to write its standard output) of each command.
+    :param timeout: max duration of each command in seconds. If None or <= 0 - no limit.
+    :return: resource usage of each command (see `check_call_with_rusage`).
+    :raises subprocess.CalledProcessError: if one of commands failed.
+    :raises subprocess.TimeoutExpired: if one of commands was killed because of timeout.
+    """
+    running = set()
+
+    def run(cmd: Sequence[str], output: str) -> resource.struct_rusage:
+        with open(output, "wb") as f:
+            return check_call_with_rusage(cmd, stdout=f, timeout=timeout, pgids=running)
+
+    with ThreadPoolExecutor(len(runs)) as executor:
+        futures = [executor.submit(run, *args) for args in runs]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [future for future in futures if future in done and future.exception()]
+        # commands which were just starting are killed on the next round
+        while failed and pending:
+            kill_process_groups(running)
+            done, pending = wait(pending, timeout=KILL_POLL_INTERVAL)
+        if failed:
+            raise failed[0].exception()
+        return [future.result() for future in futures]
+
+
 def filter_kwargs(kwargs, func):
     """
     Filter kwargs based on signature of function.
@@ -88,6 +330,8 @@ def download_hercules(output_dir, hercules_exec=HERCULES_EXEC):
     :param output_dir: output directory to store results.
     :return: path to executable.
     """
+    import requests
+
     hercules_output = os.path.join(output_dir, hercules_exec)
     os.makedirs(output_dir, exist_ok=True)
     url = "https://api.github.com/repos/src-d/hercules/releases/latest"
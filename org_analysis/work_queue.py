@@ -0,0 +1,290 @@
+"""Lease-based work queue in SQLite database shared by several nodes."""
+import json
+import logging as log
+import os
+import socket
+import sqlite3
+import threading
+from time import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from org_analysis.defaults import LEASE_SECONDS, MAX_ATTEMPTS
+
+HEARTBEAT_RETRY_DELAY = 1.0  # seconds before the first retry of failed heartbeat, then doubled
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    heartbeat REAL NOT NULL,
+    partial TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_node_id() -> str:
+    """Identifier of current node: host name and process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Queue of jobs which nodes claim for `lease_seconds`. Nodes renew leases of their jobs with
+    heartbeats, jobs of nodes which stopped sending heartbeats are claimed again by other nodes.
+
+    Database may be on a shared filesystem. Every thread should use its own `WorkQueue` object.
+    """
+
+    def __init__(self, path: str, node_id: str = None, lease_seconds: float = LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS):
+        """
+        :param path: location of SQLite database. It's created if it doesn't exist.
+        :param node_id: identifier of current node.
+        :param lease_seconds: duration of lease - it has to be renewed before it expires.
+        :param max_attempts: job is marked as failed after so many expired leases.
+        """
+        self.path = path
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # transactions are managed explicitly
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _transaction(self):
+        # take write lock at the beginning, so concurrent claims don't deadlock
+        self._db.execute("BEGIN IMMEDIATE")
+        return self._db
+
+    def add(self, jobs: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """
+        Add jobs if they are not in the queue yet (every node may add the same jobs).
+
+        :param jobs: (unique key, JSON-serializable arguments) of each job.
+        :return: number of added jobs.
+        """
+        db = self._transaction()
+        try:
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO jobs (key, payload) VALUES (?, ?)",
+                           ((key, json.dumps(payload)) for key, payload in jobs))
+            added = db.total_changes - before
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Claim pending job or job with expired lease.
+
+        :return: (key, arguments) or None if there is nothing to claim now.
+        """
+        now = time()
+        db = self._transaction()
+        try:
+            db.execute("UPDATE jobs SET state = 'failed', result = ? WHERE state = 'leased' AND "
+                       "lease_expires < ? AND attempts >= ?",
+                       (json.dumps({"err": "lease expired too many times"}), now,
+                        self.max_attempts))
+            row = db.execute("SELECT key, payload FROM jobs WHERE state = 'pending' OR "
+                             "(state = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT 1",
+                             (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, "
+                           "attempts = attempts + 1 WHERE key = ?",
+                           (self.node_id, now + self.lease_seconds, row[0]))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def complete(self, key: str, result: Dict[str, Any], failed: bool = False) -> bool:
+        """
+        Store result of job claimed by current node.
+
+        :param key: key of job.
+        :param result: JSON-serializable result.
+        :param failed: job failed and shouldn't be retried.
+        :return: False if job was re-leased to other node meanwhile - result should be dropped.
+        """
+        cursor = self._db.execute("UPDATE jobs SET state = ?, result = ? WHERE key = ? AND "
+                                  "owner = ? AND state = 'leased'",
+                                  ("failed" if failed else "done", json.dumps(result), key,
+                                   self.node_id))
+        return cursor.rowcount == 1
+
+    def fail_done(self, keys: Iterable[str], err: str) -> int:
+        """
+        Mark jobs completed by current node as failed after all, e.g. when their statistics were
+        lost in a failed merge. Their results are kept with the error.
+
+        :param keys: keys of jobs.
+        :param err: error to store in results.
+        :return: number of jobs marked as failed.
+        """
+        db = self._transaction()
+        try:
+            failed = []
+            for key in keys:
+                row = db.execute("SELECT result FROM jobs WHERE key = ? AND owner = ? AND "
+                                 "state = 'done'", (key, self.node_id)).fetchone()
+                if row is not None:
+                    failed.append((json.dumps({**json.loads(row[0]), "err": err}), key))
+            db.executemany("UPDATE jobs SET state = 'failed', result = ? WHERE key = ?", failed)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return len(failed)
+
+    def heartbeat(self, state: str = "working") -> None:
+        """Renew leases of jobs of current node and mark node as alive."""
+        now = time()
+        self._db.execute("UPDATE jobs SET lease_expires = ? WHERE owner = ? AND state = 'leased'",
+                         (now + self.lease_seconds, self.node_id))
+        self._db.execute("INSERT INTO nodes (node, state, heartbeat) VALUES (?, ?, ?) "
+                         "ON CONFLICT(node) DO UPDATE SET heartbeat = excluded.heartbeat",
+                         (self.node_id, state, now))
+
+    def remaining(self) -> int:
+        """Number of jobs which are not finished yet (pending or leased)."""
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')"
+                                ).fetchone()[0]
+
+    def finish_node(self, partial: Optional[str]) -> None:
+        """
+        Mark current node as finished.
+
+        :param partial: location of partial aggregate of jobs completed by node.
+        """
+        self._db.execute("INSERT INTO nodes (node, state, heartbeat, partial) VALUES "
+                         "(?, 'merged', ?, ?) ON CONFLICT(node) DO UPDATE SET state = 'merged', "
+                         "heartbeat = excluded.heartbeat, partial = excluded.partial",
+                         (self.node_id, time(), partial))
+
+    def working_nodes(self) -> List[str]:
+        """Nodes which are alive and haven't finished yet."""
+        return [row[0] for row in self._db.execute(
+            "SELECT node FROM nodes WHERE state = 'working' AND heartbeat >= ?",
+            (time() - self.lease_seconds,))]
+
+    def finished_nodes(self) -> Dict[str, Optional[str]]:
+        """Mapping from finished node to its partial aggregate (None if it completed no jobs)."""
+        return dict(self._db.execute("SELECT node, partial FROM nodes WHERE state = 'merged'"))
+
+    def results(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """Key, owner and result of each done or failed job."""
+        return [(key, owner, json.loads(result)) for key, owner, result in self._db.execute(
+            "SELECT key, owner, result FROM jobs WHERE state IN ('done', 'failed')")]
+
+    def reset_finished(self, role: str) -> bool:
+        """
+        Empty the queue if it holds a finished run: nothing is pending or leased and `role` (the
+        last step of the run) was acquired. Database keeps jobs, nodes and roles of a run, so
+        otherwise the next run against it sees every job done and the role taken.
+
+        :param role: name of the role acquired at the end of run.
+        :return: True if the queue was emptied.
+        """
+        db = self._transaction()
+        try:
+            finished = db.execute("SELECT COUNT(*) FROM meta WHERE key = ?",
+                                  (role,)).fetchone()[0] and \
+                not db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')"
+                               ).fetchone()[0]
+            if finished:
+                for table in ("jobs", "nodes", "meta"):
+                    db.execute(f"DELETE FROM {table}")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return bool(finished)
+
+    def acquire(self, name: str) -> bool:
+        """
+        Acquire named role (e.g. final merge) - only one node succeeds.
+
+        :param name: name of role.
+        :return: True if current node got the role.
+        """
+        cursor = self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                                  (name, self.node_id))
+        return cursor.rowcount == 1
+
+
+class Heartbeat:
+    """
+    Background thread which renews leases of current node until stopped. Failed renewals (e.g.
+    "database is locked" on a busy shared filesystem) are retried with backoff. If leases can't be
+    renewed before they expire, other nodes may claim the jobs - `lost` is set then and the node
+    has to stop working on them.
+    """
+
+    def __init__(self, path: str, node_id: str, lease_seconds: float = LEASE_SECONDS):
+        self._queue_args = (path, node_id, lease_seconds)
+        self._stop = threading.Event()
+        self.lost = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        lease_seconds = self._queue_args[2]
+        # leases are valid until this time since the last successful renewal
+        expires = time() + lease_seconds
+        delay = HEARTBEAT_RETRY_DELAY
+        queue = None
+        try:
+            while True:
+                try:
+                    if queue is None:
+                        queue = WorkQueue(*self._queue_args)
+                    queue.heartbeat()
+                    expires = time() + lease_seconds
+                    delay = HEARTBEAT_RETRY_DELAY
+                    wait = lease_seconds / 3
+                except sqlite3.Error as e:
+                    # renewal has to succeed before leases expire, the last try is a bit earlier
+                    left = expires - time() - HEARTBEAT_RETRY_DELAY
+                    if left <= 0:
+                        log.error(f"Leases of node {self._queue_args[1]} couldn't be renewed "
+                                  f"before they expired: {e}")
+                        self.lost.set()
+                        return
+                    log.warning(f"Heartbeat failed with exception {e} - retry in {delay:.1f}s")
+                    wait = min(delay, left)
+                    delay *= 2
+                if self._stop.wait(wait):
+                    break
+        finally:
+            if queue is not None:
+                queue.close()
@@ -0,0 +1,111 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from org_analysis.cloning import RetryPolicy
+from org_analysis.listing import get, list_repositories, make_session, Repo
+
+OWNER = "acme"
+PAGES = {page: [{"full_name": f"{OWNER}/repo{page}_{i}",
+                 "git_url": f"git://example.com/{OWNER}/repo{page}_{i}.git",
+                 "clone_url": f"https://example.com/{OWNER}/repo{page}_{i}.git",
+                 "fork": False} for i in range(3)]
+         for page in (1, 2)}
+
+
+class GitHubHandler(BaseHTTPRequestHandler):
+    """Organization with two pages of repositories, pages have ETags."""
+
+    requests = []  # (path, If-None-Match)
+    delays = []  # seconds to stall before each of the next responses
+
+    def do_GET(self):
+        type(self).requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.delays:
+            sleep(self.delays.pop(0))
+        url = urlparse(self.path)
+        if url.path == f"/orgs/{OWNER}":
+            return self._send(200, {"login": OWNER})
+        if url.path != f"/orgs/{OWNER}/repos":
+            return self._send(404, {})
+        page = int(parse_qs(url.query)["page"][0])
+        etag = f'"page{page}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, None)
+        last = f"http://{self.headers['Host']}{url.path}?per_page=100&page={len(PAGES)}"
+        self._send(200, PAGES[page], {"ETag": etag, "Link": f'<{last}>; rel="last"'})
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        try:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except OSError:
+            pass  # client gave up waiting
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    GitHubHandler.requests, GitHubHandler.delays = [], []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GitHubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def expected_repos():
+    return sorted(Repo(**repo) for page in PAGES.values() for repo in page)
+
+
+def test_unchanged_pages_are_not_modified(api_url, tmp_path):
+    cache_path = str(tmp_path / "cache.json")
+    first = list_repositories(OWNER, make_session(), api_url=api_url, cache_path=cache_path)
+    assert sorted(first) == expected_repos()
+    GitHubHandler.requests = []
+
+    second = list_repositories(OWNER, make_session(), api_url=api_url, cache_path=cache_path)
+    assert sorted(second) == expected_repos()
+    pages = [etag for path, etag in GitHubHandler.requests if "/repos?" in path]
+    assert sorted(pages) == ['"page1"', '"page2"']
+
+
+def test_changed_cache_is_fetched_again(api_url, tmp_path):
+    cache_path = tmp_path / "cache.json"
+    list(list_repositories(OWNER, make_session(), api_url=api_url, cache_path=str(cache_path)))
+    cache = json.loads(cache_path.read_text())
+    for page in cache.values():
+        page["etag"] = '"stale"'
+    cache_path.write_text(json.dumps(cache))
+
+    repos = list_repositories(OWNER, make_session(), api_url=api_url, cache_path=str(cache_path))
+    assert sorted(repos) == expected_repos()
+    assert json.loads(cache_path.read_text()) != cache
+
+
+def test_timed_out_request_is_retried(api_url):
+    GitHubHandler.delays = [1.0]
+    response = get(make_session(), f"{api_url}/orgs/{OWNER}", timeout=0.2,
+                   policy=RetryPolicy(retries=1, backoff=0))
+    assert response.status_code == 200
+    assert len(GitHubHandler.requests) == 2
+
+
+def test_timeout_is_raised_after_retries(api_url):
+    GitHubHandler.delays = [1.0, 1.0]
+    with pytest.raises(requests.Timeout):
+        get(make_session(), f"{api_url}/orgs/{OWNER}", timeout=0.2,
+            policy=RetryPolicy(retries=1, backoff=0))
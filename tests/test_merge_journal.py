@@ -0,0 +1,161 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from benchmarks import fake_hercules
+from org_analysis.hercules_statistics import checkpointed_merge, StreamingMerger
+from org_analysis.merge_journal import chunks, file_digest, JOURNAL_NAME, MergeJournal, node_id
+
+
+@pytest.fixture
+def hercules(tmp_path):
+    """`hercules` stand-in which logs its commands."""
+    path = tmp_path / "hercules"
+    path.write_text(f"#!/bin/sh\necho \"$@\" >> {tmp_path / 'commands'}\n"
+                    f"exec {sys.executable} {fake_hercules.__file__} \"$@\"\n")
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+def combines(tmp_path):
+    path = tmp_path / "commands"
+    if not path.exists():
+        return 0
+    n = sum(line.startswith("combine") for line in path.read_text().splitlines())
+    path.unlink()
+    return n
+
+
+def statistics(directory, n):
+    os.makedirs(directory, exist_ok=True)
+    locations = []
+    for i in range(n):
+        locations.append(os.path.join(directory, f"repo{i:02d}.pb"))
+        with open(locations[-1], "wb") as f:
+            f.write(fake_hercules.header(f"repo{i}", 1500000000 + i, 1500000100 + i, i + 1) +
+                    fake_hercules.field(2, bytes([i]) * 8))
+    return locations
+
+
+def test_journaled_merge_is_reused(tmp_path):
+    work_dir = str(tmp_path / "work")
+    inputs = statistics(str(tmp_path / "inputs"), 2)
+    with MergeJournal(work_dir) as journal:
+        node = node_id([journal.digest(loc) for loc in inputs], "v1")
+        assert journal.lookup(node) is None
+        with open(journal.location(node), "wb") as f:
+            f.write(b"merged")
+        journal.record(node, inputs)
+
+    with MergeJournal(work_dir) as journal:
+        assert node_id([journal.digest(loc) for loc in inputs], "v1") == node
+        assert journal.lookup(node) == journal.location(node)
+        assert journal.merges[node]["inputs"] == inputs
+        # the same inputs with other hercules version are a different merge
+        assert journal.lookup(node_id([journal.digest(loc) for loc in inputs], "v2")) is None
+
+
+def test_corrupted_intermediate_is_rejected(tmp_path):
+    work_dir = str(tmp_path / "work")
+    with MergeJournal(work_dir) as journal:
+        node = node_id(["a", "b"], "v1")
+        with open(journal.location(node), "wb") as f:
+            f.write(b"merged")
+        journal.record(node, ["a", "b"])
+    with open(os.path.join(work_dir, node + ".pb"), "ab") as f:
+        f.write(b"garbage")
+
+    with MergeJournal(work_dir) as journal:
+        assert journal.lookup(node) is None
+
+
+def test_digest_follows_changes(tmp_path):
+    path = tmp_path / "stat.pb"
+    path.write_bytes(b"first")
+    with MergeJournal(str(tmp_path / "work")) as journal:
+        assert journal.digest(str(path)) == file_digest(str(path))
+        path.write_bytes(b"second version")
+        assert journal.digest(str(path)) == file_digest(str(path))
+
+
+def test_cleanup_only_after_success(tmp_path):
+    work_dir = tmp_path / "work"
+    with MergeJournal(str(work_dir)) as journal:
+        used, unused = node_id(["a"], "v1"), node_id(["b"], "v1")
+        for node in (used, unused):
+            with open(journal.location(node), "wb") as f:
+                f.write(node.encode())
+            journal.record(node, [node])
+    (work_dir / "notes.txt").write_text("not owned by journal")
+
+    with pytest.raises(RuntimeError):
+        with MergeJournal(str(work_dir)) as journal:
+            journal.lookup(used)
+            raise RuntimeError("crash")
+    assert (work_dir / f"{unused}.pb").exists()
+
+    with MergeJournal(str(work_dir)) as journal:
+        journal.lookup(used)
+    assert sorted(os.listdir(work_dir)) == sorted([f"{used}.pb", JOURNAL_NAME, "notes.txt"])
+    with MergeJournal(str(work_dir)) as journal:
+        assert list(journal.merges) == [used]
+
+
+def test_chunks_are_bounded_and_stable():
+    items = [(f"key{i:03d}", f"loc{i}") for i in range(200)]
+    batches = chunks(items, 8, level=0)
+    assert [item for batch in batches for item in batch] == items
+    assert all(2 <= len(batch) <= 8 for batch in batches[:-1])
+    # inserted input changes only batches up to the next content-defined boundary
+    changed = chunks(items[:100] + [("key099x", "new")] + items[100:], 8, level=0)
+    new = [batch for batch in changed if batch not in batches]
+    assert 1 <= len(new) <= 3
+    assert len(changed) - len(new) >= len(batches) - 3
+
+
+def test_checkpointed_merge_reuses_intermediates(tmp_path, hercules):
+    inputs = statistics(str(tmp_path / "inputs"), 24)
+    output = str(tmp_path / "aggregated.pb")
+    work_dir = str(tmp_path / "aggregated.pb.merge")
+    merge = dict(output_filepath=output, work_dir=work_dir, hercules_exec=hercules, n_samples=4,
+                 n_cores=2)
+
+    assert checkpointed_merge(inputs, **merge) == output
+    with open(output, "rb") as f:
+        expected = f.read()
+    assert combines(tmp_path) > 2
+
+    # everything but the final combine is reused
+    assert checkpointed_merge(inputs, **merge) == output
+    assert combines(tmp_path) == 1
+
+    # corrupted intermediate is merged again, its ancestors are reused
+    intermediate = next(os.path.join(work_dir, name) for name in sorted(os.listdir(work_dir))
+                        if name.endswith(".pb"))
+    with open(intermediate, "ab") as f:
+        f.write(b"garbage")
+    assert checkpointed_merge(inputs, **merge) == output
+    assert combines(tmp_path) == 2
+    with open(output, "rb") as f:
+        assert f.read() == expected
+
+
+def test_streaming_merge_reuses_intermediates(tmp_path, hercules):
+    inputs = statistics(str(tmp_path / "inputs"), 9)
+    output = str(tmp_path / "aggregated.pb")
+
+    def merge(locations):
+        with StreamingMerger(hercules_exec=hercules, batch_size=3, n_cores=2,
+                             engine="hercules", work_dir=output + ".merge") as merger:
+            for loc in locations:
+                merger.add(loc)
+            return merger.finish(output)
+
+    assert merge(inputs) == output
+    # 3 batches of repositories, a batch of their merges and the final combine
+    assert combines(tmp_path) == 5
+    # statistics arrive in other order - merges are reused once all their inputs arrive
+    assert merge(inputs[::-1]) == output
+    assert combines(tmp_path) == 1
@@ -0,0 +1,56 @@
+import numpy as np
+
+from org_analysis.pb_merge import add_term, resample, Term, TermSum, update_terms
+
+
+def test_resample_spreads_bands_and_repeats_samples():
+    term = Term(offset=0, granularity=2, sampling=2, matrix=np.array([[4, 0], [2, 6]]))
+    # lines of each band are spread over its 2 ticks, each sample is repeated for 2 ticks, the
+    # last one - after the matrix ends
+    expected = [[2, 2, 0, 0, 0],
+                [2, 2, 0, 0, 0],
+                [1, 1, 3, 3, 0],
+                [1, 1, 3, 3, 0],
+                [1, 1, 3, 3, 0]]
+    result = resample([term], origin=0, length=5, granularity=1, sampling=1)
+    np.testing.assert_allclose(result, expected)
+
+
+def test_resample_shifts_later_repository():
+    early = Term(offset=0, granularity=2, sampling=2, matrix=np.array([[4, 0], [2, 6]]))
+    late = Term(offset=2, granularity=1, sampling=1, matrix=np.array([[5]]))
+    # the late repository has no samples before its first tick, its band falls into the second
+    # band of the output
+    result = resample([early, late], origin=0, length=4, granularity=2, sampling=2)
+    np.testing.assert_allclose(result, [[4, 0], [2, 11]])
+
+
+def test_term_sum_keeps_last_sample_of_ended_matrix():
+    first = Term(offset=0, granularity=2, sampling=2, matrix=np.array([[1, 0], [3, 4]]))
+    second = Term(offset=2, granularity=2, sampling=2, matrix=np.array([[10], [20]]))
+    expected = [[1, 0], [3, 14], [3, 24]]
+    for terms in ([first, second], [second, first]):
+        term_sum = TermSum(2, 2, terms[0].offset)
+        for term in terms:
+            term_sum.add(term)
+        summed = term_sum.term()
+        assert (summed.offset, summed.granularity, summed.sampling) == (0, 2, 2)
+        np.testing.assert_allclose(summed.matrix, expected)
+
+
+def test_term_sums_are_merged_by_grid():
+    terms = [Term(0, 2, 2, np.array([[1, 0], [3, 4]])),
+             Term(2, 2, 2, np.array([[10], [20]])),
+             Term(1, 1, 1, np.array([[7]]))]
+    left, right = {}, {}
+    add_term(left, terms[0])
+    add_term(right, terms[1])
+    add_term(right, terms[2])
+    update_terms(left, right)
+    assert sorted(left) == [(1, 1, 0), (2, 2, 0)]
+    np.testing.assert_allclose(left[2, 2, 0].term().matrix, [[1, 0], [3, 14], [3, 24]])
+
+    # summing on the grid doesn't change resampled result
+    grid = dict(origin=0, length=6, granularity=1, sampling=1)
+    np.testing.assert_allclose(resample([s.term() for s in left.values()], **grid),
+                               resample(terms, **grid))
@@ -0,0 +1,65 @@
+from time import sleep
+
+import pytest
+
+from org_analysis.work_queue import WorkQueue
+
+LEASE = 0.2
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+def node(path, name, **kwargs):
+    return WorkQueue(path, node_id=name, lease_seconds=LEASE, **kwargs)
+
+
+def test_expired_lease_is_claimed_again(path):
+    a, b = node(path, "a"), node(path, "b")
+    assert a.add([("job", {"repo_loc": "repo"})]) == 1
+    assert a.claim() == ("job", {"repo_loc": "repo"})
+    assert b.claim() is None
+    assert b.remaining() == 1
+
+    sleep(LEASE * 1.5)
+    assert b.claim() == ("job", {"repo_loc": "repo"})
+    # result of the node which lost the lease is dropped
+    assert not a.complete("job", {"stat_loc": "a.pb"})
+    assert b.complete("job", {"stat_loc": "b.pb"})
+    assert a.remaining() == 0
+    assert a.results() == [("job", "b", {"stat_loc": "b.pb"})]
+
+
+def test_heartbeat_renews_lease(path):
+    a, b = node(path, "a"), node(path, "b")
+    a.add([("job", {})])
+    a.claim()
+    for _ in range(3):
+        sleep(LEASE / 2)
+        a.heartbeat()
+    assert b.claim() is None
+    assert a.complete("job", {})
+
+
+def test_job_fails_after_max_attempts(path):
+    nodes = [node(path, name, max_attempts=2) for name in ("a", "b", "c")]
+    nodes[0].add([("job", {})])
+    for queue in nodes[:2]:
+        assert queue.claim() is not None
+        sleep(LEASE * 1.5)
+    assert nodes[2].claim() is None
+    assert nodes[2].remaining() == 0
+    assert nodes[2].results() == [("job", "b", {"err": "lease expired too many times"})]
+
+
+def test_fail_done_marks_only_own_done_jobs(path):
+    a, b = node(path, "a"), node(path, "b")
+    a.add([("a1", {}), ("a2", {}), ("b1", {})])
+    a.claim(), a.claim(), b.claim()
+    a.complete("a1", {"stat_loc": "a1.pb"})
+    b.complete("b1", {"stat_loc": "b1.pb"})
+    assert a.fail_done(["a1", "a2", "b1"], "merge failed") == 1
+    assert sorted(a.results()) == [("a1", "a", {"stat_loc": "a1.pb", "err": "merge failed"}),
+                                   ("b1", "b", {"stat_loc": "b1.pb"})]